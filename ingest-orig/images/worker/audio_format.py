@@ -0,0 +1,265 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Just enough of the MPEG audio and ADTS (AAC) frame formats to tell what
+# kind of audio a chunk of bytes holds and where its frames start, without
+# any decoding. Chunks are cut from a live stream at arbitrary byte offsets,
+# so none of this assumes the data starts at the beginning of anything.
+
+# kbps by (version, layer) and bitrate index; version is 1 for MPEG-1 and 2
+# for MPEG-2 and 2.5, which share tables
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Hz by the header's version bits (0 = MPEG-2.5, 2 = MPEG-2, 3 = MPEG-1)
+MPEG_SAMPLE_RATES = {
+    0: [11025, 12000, 8000],
+    2: [22050, 24000, 16000],
+    3: [44100, 48000, 32000],
+}
+
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000,
+                     22050, 16000, 12000, 11025, 8000, 7350]
+
+TS_PACKET_SIZE = 188
+
+def frame_header(data, pos=0):
+    '''
+    Parse the MPEG audio or ADTS frame header at data[pos:], returning
+    (codec, frame_length) with codec one of 'mp1', 'mp2', 'mp3' or 'aac',
+    or None if there isn't a valid header there.
+    '''
+    if len(data) < pos + 7:
+        return None
+
+    b0, b1, b2, b3 = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version_bits = (b1 >> 3) & 0x03
+    layer_bits = (b1 >> 1) & 0x03
+
+    # ADTS has a 12-bit sync word and a layer of 0, which MPEG audio
+    # doesn't allow
+    if layer_bits == 0:
+        if (b1 & 0xF0) != 0xF0:
+            return None
+
+        sf_index = (b2 >> 2) & 0x0F
+        if sf_index >= len(ADTS_SAMPLE_RATES):
+            return None
+
+        length = ((b3 & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        if length < 7:
+            return None
+
+        return 'aac', length
+
+    if version_bits == 1:
+        return None # reserved
+
+    bitrate_index = (b2 >> 4) & 0x0F
+    sr_index = (b2 >> 2) & 0x03
+    padding = (b2 >> 1) & 0x01
+
+    # free-format streams have no fixed frame length; we don't handle them
+    if bitrate_index in (0, 15) or sr_index == 3:
+        return None
+
+    layer = 4 - layer_bits
+    version = 1 if version_bits == 3 else 2
+
+    bitrate = 1000 * MPEG_BITRATES[(version, layer)][bitrate_index]
+    sample_rate = MPEG_SAMPLE_RATES[version_bits][sr_index]
+
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and version == 2:
+        length = 72 * bitrate // sample_rate + padding
+    else:
+        length = 144 * bitrate // sample_rate + padding
+
+    return 'mp%s' % (layer,), length
+
+def find_frame(data, start=0, confirm=3, limit=None):
+    '''
+    Offset of the first frame at or after start that's followed by at least
+    confirm - 1 more frames of the same codec back to back (or by at least
+    one, and then the end of the data), so that stray 0xFF bytes in the
+    audio aren't mistaken for headers. None if there's no such frame before
+    limit.
+    '''
+    end = len(data) if limit is None else min(len(data), limit)
+    pos = data.find(b'\xff', start, end)
+
+    while pos != -1:
+        hdr = frame_header(data, pos)
+
+        if hdr is not None:
+            codec, nxt, count = hdr[0], pos + hdr[1], 1
+
+            while count < confirm and nxt < len(data):
+                follow = frame_header(data, nxt)
+                if follow is None or follow[0] != codec:
+                    break
+
+                nxt, count = nxt + follow[1], count + 1
+
+            # a lone header claiming a frame that runs off the end of the
+            # data proves nothing
+            if count >= confirm or (count > 1 and nxt >= len(data)):
+                return pos
+
+        pos = data.find(b'\xff', pos + 1, end)
+
+    return None
+
+def last_frame_end(data, start=0, limit=None):
+    '''
+    Offset just past the last complete frame ending at or before limit in
+    the chain of frames that starts at start (which should come from
+    find_frame)
+    '''
+    end = len(data) if limit is None else min(len(data), limit)
+    pos = start
+
+    while True:
+        hdr = frame_header(data, pos)
+        if hdr is None or pos + hdr[1] > end:
+            return pos
+
+        pos += hdr[1]
+
+def find_packet(data, start=0, confirm=3):
+    'Offset of the first MPEG-TS packet at or after start, or None'
+    pos = data.find(b'\x47', start)
+
+    while pos != -1:
+        following = range(pos, pos + confirm * TS_PACKET_SIZE, TS_PACKET_SIZE)
+
+        if all(x >= len(data) or data[x] == 0x47 for x in following):
+            return pos
+
+        pos = data.find(b'\x47', pos + 1)
+
+    return None
+
+def find_boundary(codec, data, start=0):
+    '''
+    The first place at or after start that a stream of the given codec can
+    be cut and still be playable from there, or None. For formats we don't
+    parse, that's just start.
+    '''
+    if codec in ('mp1', 'mp2', 'mp3', 'aac'):
+        return find_frame(data, start)
+    elif codec == 'mpegts':
+        return find_packet(data, start)
+    else:
+        return start
+
+def last_boundary(codec, data, limit):
+    '''
+    The last place at or before limit that data, which begins part way
+    through a stream, can be cut so that it ends on a whole frame or packet
+    '''
+    if codec in ('mp1', 'mp2', 'mp3', 'aac'):
+        pos = find_frame(data)
+        if pos is None:
+            return limit
+
+        # Follow the chain of frames as far as it goes; where it breaks on
+        # a corrupt frame, pick it up again at the next good one, so one
+        # bad frame doesn't cost the rest of the data
+        while True:
+            pos = last_frame_end(data, pos, limit)
+
+            nxt = find_frame(data, pos, limit=limit)
+            if nxt is None or nxt == pos:
+                return pos
+
+            pos = nxt
+    elif codec == 'mpegts':
+        first = find_packet(data)
+        if first is None or first > limit:
+            return limit
+
+        return first + (limit - first) // TS_PACKET_SIZE * TS_PACKET_SIZE
+    else:
+        return limit
+
+def _id3_length(data):
+    # ID3v2 tags store their size as a 28-bit "synchsafe" integer
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def _sniff_ogg(data, pos):
+    # the codec's identification header is in the first packet of the
+    # stream; mid-stream we may only see audio pages, so fall back to 'ogg'
+    for marker, codec in ((b'OpusHead', 'opus'), (b'\x01vorbis', 'vorbis'),
+                          (b'\x7fFLAC', 'flac')):
+        if data.find(marker, pos) != -1:
+            return 'ogg/' + codec
+
+    return 'ogg'
+
+def _is_mpegts(data, count=5):
+    for offset in range(min(TS_PACKET_SIZE, len(data))):
+        positions = range(offset, offset + count * TS_PACKET_SIZE, TS_PACKET_SIZE)
+
+        if positions[-1] >= len(data):
+            break
+
+        if all(data[x] == 0x47 for x in positions):
+            return True
+
+    return False
+
+def sniff_format(data, window=2**16):
+    '''
+    Guess the codec or container of a chunk of audio from its bytes. Returns
+    one of 'mp1', 'mp2', 'mp3', 'aac' (ADTS), 'mpegts', 'ogg' or 'ogg/<codec>',
+    'flac', 'wav', 'mp4', 'webm', or None if we can't tell.
+    '''
+    data = bytes(data[:window])
+
+    # things identified by a signature at the very start
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        return 'wav'
+    elif data[:4] == b'fLaC':
+        return 'flac'
+    elif data[4:8] == b'ftyp':
+        return 'mp4'
+    elif data[:4] == b'\x1a\x45\xdf\xa3':
+        return 'webm'
+
+    # an ID3 tag in front of MPEG audio (or sometimes ADTS)
+    skip = _id3_length(data)
+
+    # things we can find part way through
+    pos = data.find(b'OggS\x00', skip)
+    if pos != -1:
+        return _sniff_ogg(data, pos)
+
+    if _is_mpegts(data[skip:]):
+        return 'mpegts'
+
+    pos = find_frame(data, skip)
+    if pos is not None:
+        return frame_header(data, pos)[0]
+
+    return None
@@ -1,17 +1,12 @@
 import os
-import sys
 import re
 import json
+import time
 import logging
-import tempfile
 import itertools as it
-import subprocess as sp
-import configparser as cp
+import concurrent.futures as cf
 import urllib.parse as urlparse
-import mimetypes as mt
 
-import bs4
-import m3u8
 import requests as rq
 
 import exceptions as ex
@@ -23,23 +18,54 @@ DEFAULT_USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) ' \
                      'Chrome/111.0.0.0 Safari/537.36'
 
 def grouper(iterable, n):
-    'Collect data into fixed-length chunks or blocks'
+    'Collect byte strings into blocks of n bytes'
     assert n > 0
 
-    ret = []
+    ret = bytearray()
 
     for obj in iterable:
-        if len(ret) == n:
-            yield b''.join(ret)
-            ret = []
+        ret += obj
 
-        if len(ret) < n:
-            ret += [obj]
+        while len(ret) >= n:
+            yield bytes(ret[:n])
+            del ret[:n]
 
     # at this point, we're out of
-    # objects but len(ret) < n
+    # input but len(ret) < n
     if len(ret) > 0:
-        yield b''.join(ret)
+        yield bytes(ret)
+
+# Ways of choosing among the renditions of an HLS master playlist; 'all'
+# is the old behavior of ingesting every variant back to back
+VARIANT_POLICIES = ('all', 'lowest', 'highest', 'codec', 'bitrate')
+
+def rank_variants(playlists, policy='highest', codec=None, bitrate=None):
+    'Order the variants of a master playlist by preference under a policy'
+    if policy not in VARIANT_POLICIES:
+        raise ValueError("Bad variant policy %s" % (policy,))
+
+    def bandwidth(pls):
+        bw = pls.stream_info.average_bandwidth or pls.stream_info.bandwidth
+        return bw if bw is not None else 0
+
+    def has_codec(pls):
+        codecs = pls.stream_info.codecs or ''
+        return codec is not None and codec.lower() in codecs.lower()
+
+    playlists = list(playlists)
+
+    if policy == 'all':
+        return playlists
+    elif policy == 'lowest':
+        return sorted(playlists, key=bandwidth)
+    elif policy == 'highest':
+        return sorted(playlists, key=bandwidth, reverse=True)
+    elif policy == 'codec':
+        # variants with the preferred codec first, best quality first
+        # within each group
+        return sorted(playlists, key=lambda x: (not has_codec(x), -bandwidth(x)))
+    else: # closest to a target bitrate
+        return sorted(playlists, key=lambda x: abs(bandwidth(x) - bitrate))
 
 # AudioStream represents 'what to do' and this class
 # represents 'how to do it'. Fetching and parsing logic
@@ -74,6 +100,13 @@ class MediaIterator(object):
     def _refresh(self):
         raise NotImplementedError("Subclasses must define _refresh")
 
+    def _on_error(self):
+        # Called after a failed read, so subclasses can avoid picking the
+        # same source again. Returning True means there's another source
+        # to switch to, and we refresh onto it without counting the failure
+        # against retry_error_max
+        return False
+
     def __iter__(self):
         return self
 
@@ -83,6 +116,11 @@ class MediaIterator(object):
                 return next(self.content)
             except rq.exceptions.RequestException as e:
                 logger.exception("Failed to get next chunk")
+
+                if self._on_error():
+                    self._refresh()
+                    continue
+
                 self.retry_error_cnt += 1
 
                 if self.retry_error_cnt <= self.stream.retry_error_max:
@@ -132,6 +170,10 @@ class DirectStreamIterator(MediaIterator):
         self.content = self.conn.iter_content(chunk_size=self.stream.chunk_size)
 
 class PlaylistIterator(MediaIterator):
+    # Whether the entries in this kind of playlist can be alternative
+    # sources for the same stream rather than consecutive segments
+    supports_mirrors = False
+
     def _get_component_urls(self, txt):
         msg = "Subclasses must implement _get_component_urls"
         raise NotImplementedError(msg)
@@ -151,19 +193,128 @@ class PlaylistIterator(MediaIterator):
         if 'retry_on_close' in args.keys():
             args['retry_on_close'] = False
 
-        components = [AudioStream(**dict(args, url=x)) for x in comps]
+        if self.supports_mirrors and self.stream.playlist_mode == 'mirror':
+            mirrors = self._rank_mirrors(comps)
+            self.content = self._iter_mirrors(mirrors, args)
+        else:
+            components = [AudioStream(**dict(args, url=x)) for x in comps]
+            self.content = grouper(it.chain(*components), self.stream.chunk_size)
 
-        self.content = grouper(it.chain(*components), self.stream.chunk_size)
+    def _probe_mirror(self, url):
+        # Open the stream, time how long the first byte takes to arrive and
+        # read a little more to estimate throughput. Returns None if the
+        # mirror doesn't work at all.
+        headers = {'User-Agent': self.user_agent}
+        start = time.time()
+
+        try:
+            with rq.get(url, stream=True, timeout=self.timeout,
+                        headers=headers) as resp:
+                resp.raise_for_status()
+
+                nbytes, ttfb = 0, None
+                for piece in resp.iter_content(chunk_size=2**10):
+                    if ttfb is None:
+                        ttfb = time.time() - start
+                    nbytes += len(piece)
+
+                    if nbytes >= self.stream.mirror_probe_bytes:
+                        break
+
+                elapsed = time.time() - start
+                advertised = resp.headers.get('icy-br', '').split(',')[0]
+        except Exception as e:
+            logger.warning("Mirror %s failed probe: %s" % (url, e))
+            return None
+
+        if ttfb is None:
+            return None
+
+        try:
+            kbps = int(advertised)
+        except ValueError:
+            kbps = 0
+
+        return {
+            'url': url,
+            'ttfb': ttfb,
+            'kbps': kbps,
+            'throughput': nbytes / max(elapsed - ttfb, 1e-3)
+        }
+
+    def _rank_mirrors(self, urls):
+        if len(urls) < 2:
+            return urls
+
+        with cf.ThreadPoolExecutor(max_workers=len(urls)) as pool:
+            probes = list(pool.map(self._probe_mirror, urls))
+
+        # Prefer whatever delivered fastest in the probe, then whatever
+        # responded first; mirrors carry the same audio, and many don't
+        # send icy-br at all, so what they advertise is only logged.
+        # Mirrors that failed the probe go last rather than being dropped,
+        # in case the failure was transient.
+        live = [x for x in probes if x is not None]
+        live = sorted(live, key=lambda x: (-x['throughput'], x['ttfb']))
+
+        for probe in live:
+            msg = "Mirror %s: ttfb %.3fs, %s kbps advertised, %.0f bytes/s"
+            vals = (probe['url'], probe['ttfb'], probe['kbps'],
+                    probe['throughput'])
+            logger.debug(msg % vals)
+
+        ranked = [x['url'] for x in live]
+        return ranked + [x for x in urls if x not in ranked]
+
+    def _iter_mirrors(self, urls, args):
+        # Read from one mirror at a time, moving to the next one if it fails
+        # or closes. Only once all of them are exhausted do we fall back to
+        # MediaIterator's retry logic and a full _refresh.
+        for i, url in enumerate(urls):
+            stream = None
+
+            try:
+                stream = AudioStream(**dict(args, url=url))
+
+                for chunk in stream:
+                    yield chunk
+            except rq.exceptions.RequestException as e:
+                if i == len(urls) - 1:
+                    raise
+
+                msg = "Mirror %s failed; failing over to %s"
+                vals = (url, urls[i+1])
+                logger.warning(msg % vals)
+            else:
+                if i < len(urls) - 1:
+                    msg = "Mirror %s closed; failing over to %s"
+                    vals = (url, urls[i+1])
+                    logger.warning(msg % vals)
+            finally:
+                if stream is not None:
+                    stream.close()
+
+# The parsers used by the extractors below are only imported when an
+# extractor first runs. Most stations are direct streams that never need
+# them, and we run a lot of worker processes.
 
 class AsxIterator(PlaylistIterator):
+    supports_mirrors = True
+
     def _get_component_urls(self, txt):
+        import bs4
+
         soup = bs4.BeautifulSoup(txt)
         hrefs = [ x['href'] for x in soup.find_all('ref') ]
 
         return hrefs
 
 class PlsIterator(PlaylistIterator):
+    supports_mirrors = True
+
     def _get_component_urls(self, txt):
+        import configparser as cp
+
         prs = cp.ConfigParser(interpolation=None)
         prs.read_string(txt)
 
@@ -181,10 +332,43 @@ class PlsIterator(PlaylistIterator):
         return urls
 
 class M3uIterator(PlaylistIterator):
-    def _get_component_urls(self, txt, i=0):
+    def __init__(self, **kwargs):
+        # _refresh runs in the superclass constructor, so these have to
+        # exist before we call it
+        self._variant = None
+        self._variants = []
+        self._failed_variants = set()
+
+        super(M3uIterator, self).__init__(**kwargs)
+
+    def _on_error(self):
+        # another rendition of the same broadcast is worth trying before
+        # the failure counts as one
+        if self._variant is None:
+            return False
+
+        self._failed_variants.add(self._variant)
+
+        untried = [x for x in self._variants if x not in self._failed_variants]
+        if len(untried) > 0:
+            logger.warning("Variant %s failed; switching renditions" % (self._variant,))
+            return True
+
+        return False
+
+    def _refresh(self):
+        self._variant = None
+        super(M3uIterator, self)._refresh()
+
+    def _get_component_urls(self, txt, i=0, base=None):
         if i >= 10:
             raise ex.IngestException("m3u playlists nested too deeply")
 
+        import m3u8
+
+        if base is None:
+            base = self.stream.url
+
         pls = m3u8.loads(txt)
 
         if not pls.is_variant:
@@ -195,15 +379,63 @@ class M3uIterator(PlaylistIterator):
                 for seg in segs:
                     pls.add_segment(m3u8.Segment(uri=seg, base_uri=pls.base_uri))
 
-            urls = [x.uri for x in pls.segments]
-        else:
+            urls = [urlparse.urljoin(base, x.uri) for x in pls.segments]
+        elif self.stream.variant_policy == 'all':
             urls = []
             for subpls in pls.playlists:
-                subtxt = self._fetch_url_stream_safe(subpls.uri)
-                urls += self._get_component_urls(subtxt.decode(), i=i+1)
+                suburl = urlparse.urljoin(base, subpls.uri)
+                subtxt = self._fetch_url_stream_safe(suburl)
+                urls += self._get_component_urls(subtxt.decode(), i=i+1,
+                                                 base=suburl)
+        else:
+            urls = self._get_variant_urls(pls, i=i, base=base)
 
         return urls
 
+    def _get_variant_urls(self, pls, i=0, base=None):
+        # These are renditions of the same broadcast, so we only want one
+        # of them. Try them in order of preference, skipping any that have
+        # failed on us before; if they all have, start over rather than
+        # giving up on the station.
+        ranked = rank_variants(pls.playlists, self.stream.variant_policy,
+                               codec=self.stream.variant_codec,
+                               bitrate=self.stream.variant_bitrate)
+        ranked = [(urlparse.urljoin(base, x.uri), x) for x in ranked]
+
+        candidates = [x for x in ranked if x[0] not in self._failed_variants]
+        if len(candidates) == 0:
+            self._failed_variants.clear()
+            candidates = ranked
+
+        for j, (suburl, subpls) in enumerate(candidates):
+            try:
+                subtxt = self._fetch_url_stream_safe(suburl)
+                urls = self._get_component_urls(subtxt.decode(), i=i+1,
+                                                base=suburl)
+            except rq.exceptions.RequestException as e:
+                self._failed_variants.add(suburl)
+
+                if j == len(candidates) - 1:
+                    raise
+                else:
+                    logger.warning("Failed to fetch variant %s; trying next" % (suburl,))
+                    continue
+
+            # if the chosen one was itself a master playlist, the nested
+            # call will already have picked a variant of it
+            if self._variant is None:
+                self._variant = suburl
+                self._variants = [x[0] for x in ranked]
+
+            msg = "Selected variant %s (bandwidth %s, codecs %s)"
+            vals = (suburl, subpls.stream_info.bandwidth,
+                    subpls.stream_info.codecs)
+            logger.debug(msg % vals)
+
+            return urls
+
+        return []
+
 class WebscrapeIterator(MediaIterator):
     retry_on_close = False
 
@@ -240,6 +472,8 @@ class IHeartIterator(WebscrapeIterator):
     retry_on_close = True
 
     def _webscrape_extract_media_url(self, txt):
+        import bs4
+
         # There's a chunk of json in the page with our URLs in it
         soup = bs4.BeautifulSoup(txt, 'lxml')
         script = soup.find_all('script', id='initialState')[0].text
@@ -289,6 +523,8 @@ class MediaUrl(object):
             self._ext = ext
         elif autodetect:
             try:
+                import mimetypes as mt
+
                 # Open a stream to it and guess by MIME type
                 args = {
                     'url': self.url,
@@ -405,6 +641,11 @@ class AudioStream(MediaUrl):
         self.retry_error_max = kwargs.pop('retry_error_max', 0)
         self.unknown_formats = kwargs.pop('unknown_formats', 'error')
         self.retry_on_close = kwargs.pop('retry_on_close', False)
+        self.variant_policy = kwargs.pop('variant_policy', 'highest')
+        self.variant_codec = kwargs.pop('variant_codec', None)
+        self.variant_bitrate = kwargs.pop('variant_bitrate', None)
+        self.playlist_mode = kwargs.pop('playlist_mode', 'sequential')
+        self.mirror_probe_bytes = kwargs.pop('mirror_probe_bytes', 2**14)
 
         super(AudioStream, self).__init__(**kwargs)
 
@@ -414,6 +655,19 @@ class AudioStream(MediaUrl):
             msg = "unknown_formats must be 'direct' or 'error'"
             raise ValueError(msg)
 
+        if self.playlist_mode not in ('mirror', 'sequential'):
+            msg = "playlist_mode must be 'mirror' or 'sequential'"
+            raise ValueError(msg)
+
+        if self.variant_policy not in VARIANT_POLICIES:
+            msg = "variant_policy must be one of %s"
+            vals = (', '.join(VARIANT_POLICIES),)
+            raise ValueError(msg % vals)
+        elif self.variant_policy == 'codec' and self.variant_codec is None:
+            raise ValueError("Must provide variant_codec with policy 'codec'")
+        elif self.variant_policy == 'bitrate' and self.variant_bitrate is None:
+            raise ValueError("Must provide variant_bitrate with policy 'bitrate'")
+
         cls = self._iterator_for_stream(self)
         if cls is not None:
             self._iterator = cls(stream=self)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+'''
+Report what importing each of the worker's modules and dependencies costs,
+in wall time and resident memory. Each import is done in a fresh interpreter
+so its cost isn't hidden by something an earlier import already loaded, and
+for the worker's own modules we also list which of the heavy dependencies
+they pull in at load time.
+
+Usage: ./bench_imports.py [-n REPEAT] [MODULE ...]
+'''
+
+import sys
+import json
+import argparse
+import statistics
+import subprocess as sp
+
+MODULES = [
+    # third-party dependencies
+    'requests', 'pyodbc', 'boto3', 'bs4', 'lxml', 'm3u8',
+
+    # standard library modules the worker only needs sometimes
+    'configparser', 'mimetypes', 'tarfile', 'csv', 'tempfile',
+
+    # the worker itself
+    'audio_stream', 'audio_format', 'radio_worker', 'radio_pool'
+]
+
+HEAVY = ['boto3', 'pyodbc', 'bs4', 'lxml', 'm3u8', 'configparser',
+         'mimetypes', 'tarfile', 'csv', 'tempfile']
+
+PROBE = '''
+import sys, json, time, resource
+
+before = set(sys.modules)
+rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t0 = time.perf_counter()
+
+import {module}
+
+elapsed = time.perf_counter() - t0
+rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+loaded = sorted(x for x in set(sys.modules) - before if '.' not in x)
+
+print(json.dumps({{
+    'seconds': elapsed,
+    'rss_kb': rss1 - rss0,
+    'loaded': loaded
+}}))
+'''
+
+def measure(module, repeat):
+    runs = []
+
+    for i in range(repeat):
+        proc = sp.run([sys.executable, '-c', PROBE.format(module=module)],
+                      stdout=sp.PIPE, stderr=sp.PIPE, check=False)
+
+        if proc.returncode != 0:
+            err = proc.stderr.decode().strip().split('\n')[-1]
+            return {'module': module, 'error': err}
+
+        runs += [json.loads(proc.stdout)]
+
+    return {
+        'module': module,
+        'seconds': statistics.median(x['seconds'] for x in runs),
+        'rss_kb': statistics.median(x['rss_kb'] for x in runs),
+        'heavy': [x for x in runs[0]['loaded'] if x in HEAVY and x != module]
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark module import cost')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help='Modules to import (default: the worker\'s)')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='Fresh interpreters per module; we report the median')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('%-14s %10s %10s  %s' % ('module', 'ms', 'rss (KB)', 'heavy deps loaded'))
+
+    for module in args.modules:
+        res = measure(module, args.repeat)
+
+        if 'error' in res:
+            print('%-14s %s' % (module, res['error']))
+        else:
+            vals = (module, 1000 * res['seconds'], res['rss_kb'],
+                    ', '.join(res['heavy']) or '-')
+            print('%-14s %10.1f %10d  %s' % vals)
@@ -0,0 +1,635 @@
+import os
+import logging
+import contextlib
+
+import pyodbc
+
+logger = logging.getLogger(__name__)
+
+# All the SQL the ingest workers run lives here, so that a worker talking to
+# Postgres directly and the DatabaseBroker doing it on workers' behalf run
+# exactly the same queries.
+class Database(object):
+    def __init__(self, **kwargs):
+        dsn = kwargs.pop('dsn', 'Database')
+
+        super(Database, self).__init__(**kwargs)
+
+        self.dsn = dsn
+
+        self.db = pyodbc.connect(dsn=self.dsn)
+        self.db.autocommit = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tp, val, traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self.db.close()
+        except Exception as e:
+            pass
+
+    def cursor(self):
+        return self.db.cursor()
+
+    def ping(self):
+        'Whether the connection still works'
+        try:
+            with self.db.cursor() as cur:
+                cur.execute('select 1;')
+                cur.fetchone()
+        except Exception as e:
+            return False
+
+        return True
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # We normally run in autocommit mode; turn it off for the duration
+        # so a batch of writes costs one commit rather than one per row
+        self.db.autocommit = False
+
+        try:
+            with self.db.cursor() as cur:
+                yield cur
+        except Exception as e:
+            self.db.rollback()
+            raise
+        else:
+            self.db.commit()
+        finally:
+            self.db.autocommit = True
+
+    ##
+    ## Job control
+    ##
+
+    def lock_task(self, chunk_error_threshold=None, exclude=(),
+                  max_kbps=None, default_kbps=128):
+        # Advisory locks are reentrant within a session, so a caller that
+        # holds several of them on one connection (like the broker does)
+        # has to tell us which stations it already has
+        exclude = '{' + ','.join(str(int(x)) for x in exclude) + '}'
+
+        # If max_kbps is given, only consider stations whose estimated
+        # bitrate fits in it; ones we haven't measured yet cost default_kbps
+        params = (
+            chunk_error_threshold is None,
+            chunk_error_threshold,
+            exclude,
+            max_kbps is None,
+            default_kbps,
+            max_kbps,
+            chunk_error_threshold is None,
+            chunk_error_threshold,
+            exclude,
+            max_kbps is None,
+            default_kbps,
+            max_kbps
+        )
+
+        with self.db.cursor() as cur:
+            cur.execute('''
+            -- SQL ported from https://github.com/chanks/que
+            with recursive job_locks as
+            (
+                select
+                    (j).*,
+                    pg_try_advisory_lock((j).station_id) as locked
+                from
+                (
+                    select
+                        j
+                    from app.jobs j
+                    where
+                        (
+                            ? or
+                            j.error_count < ?
+                        ) and
+                        j.station_id <> all(cast(? as integer[])) and
+                        (
+                            ? or
+                            coalesce(j.est_kbps, ?) <= ?
+                        )
+                    order by station_id
+                    limit 1
+                ) as t1
+
+                union all
+
+                (
+                    select
+                        (j).*,
+                        pg_try_advisory_lock((j).station_id) as locked
+                    from
+                    (
+                        select
+                        (
+                            select
+                                j
+                            from app.jobs j
+                            where
+                                j.station_id > job_locks.station_id and
+                                (
+                                    ? or
+                                    j.error_count < ?
+                                ) and
+                                j.station_id <> all(cast(? as integer[])) and
+                                (
+                                    ? or
+                                    coalesce(j.est_kbps, ?) <= ?
+                                )
+                            order by station_id
+                            limit 1
+                        ) as j
+                        from job_locks
+                        where
+                            job_locks.station_id is not null
+                        limit 1
+                    ) as t1
+                )
+            )
+            select
+                station_id
+            from job_locks
+            where
+                locked
+            limit 1;
+            ''', params)
+
+            res = cur.fetchall()
+            if len(res) > 0:
+                return res[0][0]
+            else:
+                return None
+
+    def release_lock(self, station_id):
+        with self.db.cursor() as cur:
+            cur.execute('''
+            delete from app.worker_status
+            where
+                station_id = ?;
+            ''', (station_id,))
+
+            cur.execute('''
+            select
+                pg_advisory_unlock(?);
+            ''', (station_id,))
+
+            return cur.fetchone()[0]
+
+    def relock(self, station_id):
+        # For taking back a lock we held on a connection that's since died,
+        # which took the lock with it; False if someone else got there first
+        with self.db.cursor() as cur:
+            cur.execute('''
+            select
+                pg_try_advisory_lock(?);
+            ''', (station_id,))
+
+            return bool(cur.fetchone()[0])
+
+    def get_station(self, station_id):
+        with self.db.cursor() as cur:
+            cur.execute('''
+            select
+                s.callsign || '-' || s.band as station,
+                s.stream_url,
+                j.est_kbps
+            from data.station s
+                left join app.jobs j using(station_id)
+            where
+                s.station_id = ?;
+            ''', (station_id,))
+
+            res = cur.fetchone()
+            return res[0], res[1], res[2]
+
+    def get_stop_conditions(self, station_id, chunk_error_threshold=None):
+        with self.db.cursor() as cur:
+            params = (
+                station_id,
+                station_id,
+                chunk_error_threshold
+            )
+
+            cur.execute('''
+            select
+                not exists(
+                    select
+                        1
+                    from app.jobs
+                    where
+                        station_id = ?
+                ) as deleted,
+
+                exists(
+                    select
+                        1
+                    from app.jobs
+                    where
+                        station_id = ? and
+                        error_count >= ?
+                ) as failed;
+            ''', params)
+
+            ret = cur.fetchone()
+            cols = [col[0] for col in cur.description]
+
+            return dict(zip(cols, ret))
+
+    def maintain_chunk_partitions(self, months_ahead=2, retention_days=None):
+        # Creates upcoming partitions of app.chunks and, given a retention,
+        # moves ones older than that to the archive schema. Safe to call
+        # from every node; the function takes a lock and only one runs it.
+        with self.db.cursor() as cur:
+            cur.execute('''
+            select
+                app.maintain_chunk_partitions(?, ? * interval '1 day');
+            ''', (months_ahead, retention_days))
+
+    ##
+    ## Placement
+    ##
+
+    def advertise_node(self, node_id, max_kbps, max_slots, cpu_count=None,
+                       load_kbps=0, running=0):
+        with self.db.cursor() as cur:
+            cur.execute('''
+            insert into app.nodes
+                (node_id, max_kbps, max_slots, cpu_count, load_kbps,
+                 running, heartbeat_dt)
+            values
+                (?, ?, ?, ?, ?, ?, now())
+            on conflict (node_id) do update
+            set
+                max_kbps = excluded.max_kbps,
+                max_slots = excluded.max_slots,
+                cpu_count = excluded.cpu_count,
+                load_kbps = excluded.load_kbps,
+                running = excluded.running,
+                heartbeat_dt = excluded.heartbeat_dt;
+            ''', (node_id, max_kbps, max_slots, cpu_count, load_kbps,
+                  running))
+
+    def remove_node(self, node_id):
+        with self.db.cursor() as cur:
+            cur.execute('''
+            delete from app.nodes
+            where
+                node_id = ?;
+            ''', (node_id,))
+
+    def get_fleet_load(self, max_age, chunk_error_threshold=None,
+                       default_kbps=128):
+        # Total capacity of the nodes that have checked in within max_age
+        # seconds, and the total estimated cost of the jobs they could run
+        with self.db.cursor() as cur:
+            params = (
+                max_age,
+                default_kbps,
+                chunk_error_threshold is None,
+                chunk_error_threshold
+            )
+
+            cur.execute('''
+            select
+                (
+                    select
+                        coalesce(sum(max_kbps), 0)
+                    from app.nodes
+                    where
+                        heartbeat_dt > now() - ? * interval '1 second'
+                ) as capacity_kbps,
+
+                (
+                    select
+                        coalesce(sum(coalesce(est_kbps, ?)), 0)
+                    from app.jobs
+                    where
+                        ? or
+                        error_count < ?
+                ) as demand_kbps;
+            ''', params)
+
+            ret = cur.fetchone()
+            cols = [col[0] for col in cur.description]
+
+            return dict(zip(cols, ret))
+
+    def set_bitrate(self, station_id, kbps, chunk_bytes=None):
+        self.set_bitrates([(station_id, kbps, chunk_bytes)])
+
+    def set_bitrates(self, rows):
+        # rows are (station_id, kbps, chunk_bytes) triples
+        params = [
+            (kbps, chunk_bytes, station_id)
+            for station_id, kbps, chunk_bytes in rows
+        ]
+
+        if len(params) == 0:
+            return
+
+        with self.transaction() as cur:
+            cur.executemany('''
+            update app.jobs
+            set
+                est_kbps = ?,
+                chunk_bytes = coalesce(?, chunk_bytes)
+            where
+                station_id = ?;
+            ''', params)
+
+    ##
+    ## Monitoring
+    ##
+
+    def heartbeat(self, station_id, node_id, pid, claim_ts, chunk_count,
+                  error_count, heartbeat_ts, heartbeat_interval):
+        self.heartbeats([(station_id, node_id, pid, claim_ts, chunk_count,
+                          error_count, heartbeat_ts, heartbeat_interval)])
+
+    def heartbeats(self, rows):
+        # rows are (station_id, node_id, pid, claim_ts, chunk_count,
+        # error_count, heartbeat_ts, heartbeat_interval) tuples, with times
+        # as unix timestamps and the interval in seconds
+        rows = list(rows)
+
+        if len(rows) == 0:
+            return
+
+        with self.transaction() as cur:
+            cur.executemany('''
+            insert into app.worker_status
+                (station_id, node_id, pid, claim_dt, chunk_count,
+                 error_count, heartbeat_dt, heartbeat_interval)
+            values
+                (?, ?, ?, to_timestamp(?), ?, ?, to_timestamp(?), ?)
+            on conflict (station_id) do update
+            set
+                node_id = excluded.node_id,
+                pid = excluded.pid,
+                claim_dt = excluded.claim_dt,
+                chunk_count = excluded.chunk_count,
+                error_count = excluded.error_count,
+                heartbeat_dt = excluded.heartbeat_dt,
+                heartbeat_interval = excluded.heartbeat_interval;
+            ''', rows)
+
+    def refresh_station_hourly(self):
+        with self.db.cursor() as cur:
+            cur.execute('''
+            select
+                app.refresh_station_hourly();
+            ''')
+
+    ##
+    ## Results
+    ##
+
+    def log_error(self, station_id, error):
+        self.log_errors([(station_id, error)])
+
+    def log_errors(self, rows):
+        # rows are (station_id, error) pairs; collapse them to one update
+        # per station, keeping the most recent error message
+        counts, last = {}, {}
+        for station_id, error in rows:
+            counts[station_id] = counts.get(station_id, 0) + 1
+            last[station_id] = error
+
+        if len(counts) == 0:
+            return
+
+        params = [(counts[x], last[x], x) for x in counts.keys()]
+
+        with self.transaction() as cur:
+            # this is concurrency-safe because whoever is logging errors
+            # for a station holds the lock on it
+            cur.executemany('''
+            update app.jobs
+            set
+                error_count = error_count + ?,
+                last_error = ?
+            where
+                station_id = ?;
+            ''', params)
+
+            cur.executemany('''
+            insert into app.station_hourly
+                (station_id, hour_dt, error_count)
+            values
+                (?, date_trunc('hour', now()), ?)
+            on conflict (station_id, hour_dt) do update
+            set
+                error_count = app.station_hourly.error_count +
+                              excluded.error_count;
+            ''', [(x, counts[x]) for x in counts.keys()])
+
+    def log_chunk(self, station_id, s3_url, byte_length=None, start_ts=None,
+                  end_ts=None, codec=None, kbps=None, sha256=None,
+                  stream_seq=None):
+        self.log_chunks([(station_id, s3_url, byte_length, start_ts, end_ts,
+                          codec, kbps, sha256, stream_seq)])
+
+    def log_chunks(self, rows, batch_size=500):
+        # rows are (station_id, s3_url, byte_length, start_ts, end_ts, codec,
+        # kbps, sha256, stream_seq) tuples with times as unix timestamps;
+        # insert them as a few multi-row statements rather than one each
+        rows = list(rows)
+
+        placeholder = '(?, ?, ?, to_timestamp(?), to_timestamp(?), ?, ?, ?, ?)'
+
+        with self.transaction() as cur:
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i:(i + batch_size)]
+
+                values = ','.join([placeholder] * len(batch))
+                params = [x for row in batch for x in row]
+
+                cur.execute('''
+                insert into app.chunks
+                    (station_id, s3_url, byte_length, start_dt, end_dt,
+                     codec, kbps, sha256, stream_seq)
+                values
+                    %s;
+                ''' % (values,), params)
+
+    ##
+    ## Retrieval
+    ##
+
+    def find_station(self, station):
+        'station_id for a station given as an id or a name like WXYZ-FM'
+        with self.db.cursor() as cur:
+            try:
+                cur.execute('''
+                select
+                    station_id
+                from data.station
+                where
+                    station_id = ?;
+                ''', (int(station),))
+            except ValueError:
+                cur.execute('''
+                select
+                    station_id
+                from data.station
+                where
+                    callsign || '-' || band = upper(?);
+                ''', (station,))
+
+            res = cur.fetchone()
+            return None if res is None else res[0]
+
+    def get_chunks(self, station_id, start_ts, end_ts, slack=3600):
+        # Chunks captured at least partly between start_ts and end_ts (unix
+        # timestamps), in order. A chunk's row is inserted after it's
+        # captured, so looking at create_dt up to slack seconds past the
+        # end keeps partition pruning and the (station_id, create_dt) index
+        # usable. Rows from before we recorded capture times only have
+        # create_dt to go on.
+        params = (
+            station_id,
+            start_ts,
+            end_ts,
+            slack,
+            end_ts,
+            start_ts
+        )
+
+        with self.db.cursor() as cur:
+            cur.execute('''
+            select
+                chunk_id,
+                s3_url,
+                byte_length,
+                extract(epoch from coalesce(start_dt, create_dt)) as start_ts,
+                extract(epoch from coalesce(end_dt, create_dt)) as end_ts,
+                codec,
+                stream_seq
+            from app.chunks
+            where
+                station_id = ? and
+                create_dt >= to_timestamp(?) and
+                create_dt < to_timestamp(?) + ? * interval '1 second' and
+                coalesce(start_dt, create_dt) < to_timestamp(?) and
+                coalesce(end_dt, create_dt) >= to_timestamp(?)
+            order by coalesce(start_dt, create_dt), chunk_id;
+            ''', params)
+
+            cols = [col[0] for col in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    ##
+    ## Setup
+    ##
+
+    def setup(self, db_setup):
+        # only needed here, and almost every process skips this entirely
+        import csv
+        import tarfile
+        import tempfile
+
+        import boto3
+
+        logger.info('Attempting database setup')
+
+        try:
+            cur = self.db.cursor()
+
+            # use the two-argument version to avoid overlapping with
+            # locks on station_id values
+            cur.execute('select pg_try_advisory_lock(0, 0);')
+
+            if not cur.fetchone()[0]:
+                return # someone else got there first
+
+            # Check this in case we wake up after someone else gets the
+            # lock and does setup; if we can lock it again and we can tell
+            # the work is already done, just exit
+            cur.execute('''
+            select
+                not exists(
+                    select
+                        1
+                    from information_schema.schemata
+                    where
+                        schema_name = 'app'
+                ) as needs_setup;
+            ''')
+
+            if not cur.fetchone()[0]:
+                logger.info("Database already set up; aborting")
+                return
+
+            tables_to_copy = (
+                ('main.csv', 'data.station'),
+            )
+
+            data_source_bucket = db_setup['data_source_s3_bucket']
+            data_source_key = db_setup['data_source_s3_key']
+
+            # Set up the schema to hold data we'll be fetching
+            cur.execute(db_setup['schema_sql'])
+            logger.info("Set up database schema")
+
+            # Fetch the data from S3 and extract it
+            # => main.csv, maps.csv, map_coordinates.csv
+            s3 = boto3.resource('s3')
+            bucket = s3.Bucket(data_source_bucket)
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with tempfile.NamedTemporaryFile(dir=tmpdir) as fn:
+                    bucket.download_file(data_source_key, fn.name)
+                    with tarfile.open(fn.name, 'r:gz') as tar:
+                        tar.extractall(path=tmpdir)
+
+                # Load the data we've extracted into the DB
+                for fname, tbl in tables_to_copy:
+                    pth = os.path.join(tmpdir, fname)
+
+                    with open(pth, 'rt') as f:
+                        reader = csv.reader(f, dialect='excel-tab')
+                        cols = next(reader)
+
+                        # NOTE: All this sql string munging isn't great, but
+                        # the assumption is we do control the input data
+                        placeholders = (tbl, ','.join(cols),
+                                        ','.join(['?'] * len(cols)))
+
+                        while cur.nextset():
+                            pass
+
+                        cur.executemany('''
+                        insert into %s
+                            (%s)
+                        values
+                            (%s)
+                        ''' % placeholders, reader)
+
+                        logger.info("Copied %s from %s" % (tbl, fname))
+
+            logger.info('Database successfully set up')
+        except Exception as e:
+            logger.exception("Failed to set up database")
+
+            try:
+                self.db.rollback()
+            except Exception as e:
+                logger.exception("Failed to roll back database set up")
+
+            raise
+        else:
+            try:
+                self.db.commit()
+            except Exception as e:
+                logger.exception("Failed to commit database set up")
+        finally:
+            try:
+                cur.close()
+            except Exception as e:
+                pass
@@ -0,0 +1,433 @@
+import os
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import multiprocessing.connection as mpc
+
+import exceptions as ex
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Without a broker, every worker holds its own Postgres connection for as long
+# as it runs, so the number of backends grows with the number of stations.
+# The broker runs inside the RadioPool process and does the workers' database
+# work for them over a small fixed set of connections: one session that holds
+# the advisory locks for every station on this node, a few more for reads,
+# and buffered writes for chunks and errors that get flushed in batches.
+class DatabaseBroker(object):
+    # What clients are allowed to ask us to do
+    methods = ('lock_task', 'release_lock', 'get_station',
+               'get_stop_conditions', 'log_error', 'log_chunk',
+               'set_bitrate', 'heartbeat')
+
+    def __init__(self, **kwargs):
+        dsn = kwargs.pop('dsn', 'Database')
+        n_connections = kwargs.pop('n_connections', 2)
+        flush_interval = kwargs.pop('flush_interval', 5)
+        flush_size = kwargs.pop('flush_size', 500)
+
+        super(DatabaseBroker, self).__init__(**kwargs)
+
+        if n_connections < 1:
+            raise ValueError("Must have at least one read connection")
+
+        self.dsn = dsn
+        self.n_connections = n_connections
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        # Session-level advisory locks belong to whichever connection took
+        # them, so all of them go through this one
+        self.lock_db = Database(dsn=self.dsn)
+        self.lock_mutex = threading.Lock()
+        self.held = set()
+
+        self.read_dbs = queue.Queue()
+        for i in range(self.n_connections):
+            self.read_dbs.put(Database(dsn=self.dsn))
+
+        self.write_mutex = threading.Lock()
+        self.pending_chunks = []
+        self.pending_errors = []
+        self.pending_bitrates = {}
+        self.pending_heartbeats = {}
+        self.flush_now = threading.Event()
+
+        self.closed = threading.Event()
+
+        self.sockdir = tempfile.mkdtemp(prefix='radio-broker-')
+        self.address = os.path.join(self.sockdir, 'broker.sock')
+        self.authkey = os.urandom(32)
+        self.listener = mpc.Listener(self.address, family='AF_UNIX',
+                                     authkey=self.authkey)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tp, val, traceback):
+        self.close()
+
+    @property
+    def client_args(self):
+        'What a worker needs to connect to us; picklable'
+        return {'address': self.address, 'authkey': self.authkey}
+
+    def start(self):
+        threads = [
+            threading.Thread(target=self._accept_loop, daemon=True),
+            threading.Thread(target=self._flush_loop, daemon=True)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        return self
+
+    def close(self):
+        self.closed.set()
+
+        try:
+            self.listener.close()
+        except Exception as e:
+            pass
+
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception("Failed to flush broker writes on close")
+
+        try:
+            self.lock_db.close()
+        except Exception as e:
+            pass
+
+        while True:
+            try:
+                self.read_dbs.get(block=False).close()
+            except queue.Empty:
+                break
+
+        shutil.rmtree(self.sockdir, ignore_errors=True)
+
+    ##
+    ## Serving clients
+    ##
+
+    def _accept_loop(self):
+        while not self.closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                if not self.closed.is_set():
+                    logger.exception("Broker failed to accept connection")
+                continue
+
+            thread = threading.Thread(target=self._serve, args=(conn,),
+                                      daemon=True)
+            thread.start()
+
+    def _serve(self, conn):
+        # the stations this client has locked through us, so we can let go
+        # of them if it dies without saying goodbye
+        held = set()
+
+        try:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                try:
+                    if method not in self.methods:
+                        raise ValueError("Unknown broker method %s" % (method,))
+
+                    res = getattr(self, method)(*args)
+
+                    if method == 'lock_task' and res is not None:
+                        held.add(res)
+                    elif method == 'release_lock':
+                        held.discard(args[0])
+                except Exception as e:
+                    logger.exception("Broker request %s failed" % (method,))
+                    conn.send(('error', repr(e)))
+                else:
+                    conn.send(('ok', res))
+        finally:
+            for station_id in held:
+                try:
+                    self.release_lock(station_id)
+                except Exception as e:
+                    logger.exception("Failed to release lock on %s" % (station_id,))
+
+            try:
+                conn.close()
+            except Exception as e:
+                pass
+
+    ##
+    ## Database operations on clients' behalf
+    ##
+
+    def lock_task(self, chunk_error_threshold=None, max_kbps=None,
+                  default_kbps=128):
+        with self.lock_mutex:
+            station_id = self._locking('lock_task', chunk_error_threshold,
+                                       exclude=self.held, max_kbps=max_kbps,
+                                       default_kbps=default_kbps)
+
+            if station_id is not None:
+                self.held.add(station_id)
+
+            return station_id
+
+    def release_lock(self, station_id):
+        # Whoever gets this station next should see everything its last
+        # worker wrote. If that fails the writes stay queued for the next
+        # flush, and the lock has to go regardless, or the station would
+        # stay locked as long as we're up
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception("Failed to flush writes releasing %s" % (station_id,))
+
+        with self.lock_mutex:
+            self.held.discard(station_id)
+            return self._locking('release_lock', station_id)
+
+    def _locking(self, method, *args, **kwargs):
+        # Run a lock_db method, with lock_mutex held. If it fails because
+        # the connection has died, every lock we held went with it: connect
+        # again, take back what locks we can, and try once more
+        try:
+            return getattr(self.lock_db, method)(*args, **kwargs)
+        except Exception as e:
+            if self.lock_db.ping():
+                raise
+
+            logger.exception("Lock connection failed; reconnecting")
+            self._reconnect_locks()
+
+            return getattr(self.lock_db, method)(*args, **kwargs)
+
+    def _reconnect_locks(self):
+        # call with lock_mutex held
+        self.lock_db.close()
+        self.lock_db = Database(dsn=self.dsn)
+
+        lost = set()
+        for station_id in self.held:
+            try:
+                if not self.lock_db.relock(station_id):
+                    lost.add(station_id)
+            except Exception as e:
+                logger.exception("Failed to relock %s" % (station_id,))
+                lost.add(station_id)
+
+        # Their workers are still running, but the stations may now be
+        # picked up elsewhere too
+        if len(lost) > 0:
+            msg = "Lost the locks on stations %s"
+            vals = (', '.join(str(x) for x in sorted(lost)),)
+            logger.error(msg % vals)
+
+        self.held -= lost
+
+    def _reconnect(self, db):
+        # a query failed, possibly because the connection did; swap in a
+        # fresh one so the pool doesn't fill up with dead connections
+        try:
+            new = Database(dsn=self.dsn)
+        except Exception as e:
+            logger.exception("Broker failed to reconnect")
+            return db
+
+        db.close()
+        return new
+
+    def _read(self, method, *args):
+        db = self.read_dbs.get()
+
+        try:
+            return getattr(db, method)(*args)
+        except Exception as e:
+            db = self._reconnect(db)
+            raise
+        finally:
+            self.read_dbs.put(db)
+
+    def get_station(self, station_id):
+        return self._read('get_station', station_id)
+
+    def get_stop_conditions(self, station_id, chunk_error_threshold=None):
+        # The error count has to include errors still waiting for a flush,
+        # or a worker would go on a flush_interval past its threshold
+        with self.write_mutex:
+            unflushed = any(x[0] == station_id for x in self.pending_errors)
+
+        if unflushed:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Failed to flush errors for %s" % (station_id,))
+
+        return self._read('get_stop_conditions', station_id,
+                          chunk_error_threshold)
+
+    def log_error(self, station_id, error):
+        with self.write_mutex:
+            self.pending_errors += [(station_id, error)]
+            self._maybe_flush()
+
+    def log_chunk(self, station_id, s3_url, *meta):
+        with self.write_mutex:
+            row = (station_id, s3_url) + meta
+            row += (None,) * (9 - len(row)) # any metadata not given
+
+            self.pending_chunks += [row]
+            self._maybe_flush()
+
+    def set_bitrate(self, station_id, kbps, chunk_bytes=None):
+        # only the latest estimate per station matters
+        with self.write_mutex:
+            self.pending_bitrates[station_id] = (kbps, chunk_bytes)
+
+    def heartbeat(self, station_id, *args):
+        # likewise only the latest
+        with self.write_mutex:
+            self.pending_heartbeats[station_id] = (station_id,) + args
+
+    ##
+    ## Batched writes
+    ##
+
+    def _maybe_flush(self):
+        # call with write_mutex held
+        pending = len(self.pending_chunks) + len(self.pending_errors)
+
+        if pending >= self.flush_size:
+            self.flush_now.set()
+
+    def _flush_loop(self):
+        while not self.closed.is_set():
+            self.flush_now.wait(self.flush_interval)
+            self.flush_now.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Failed to flush broker writes")
+
+    def flush(self):
+        with self.write_mutex:
+            chunks, self.pending_chunks = self.pending_chunks, []
+            errors, self.pending_errors = self.pending_errors, []
+            bitrates, self.pending_bitrates = self.pending_bitrates, {}
+            beats, self.pending_heartbeats = self.pending_heartbeats, {}
+
+        if len(chunks) + len(errors) + len(bitrates) + len(beats) == 0:
+            return
+
+        db = self.read_dbs.get()
+
+        try:
+            if len(chunks) > 0:
+                db.log_chunks(chunks)
+            if len(errors) > 0:
+                db.log_errors(errors)
+            if len(bitrates) > 0:
+                db.set_bitrates((k,) + v for k, v in bitrates.items())
+            if len(beats) > 0:
+                db.heartbeats(beats.values())
+        except Exception as e:
+            # put them back to retry on the next flush rather than
+            # losing track of chunks we've already uploaded
+            with self.write_mutex:
+                self.pending_chunks = chunks + self.pending_chunks
+                self.pending_errors = errors + self.pending_errors
+                bitrates.update(self.pending_bitrates)
+                self.pending_bitrates = bitrates
+                beats.update(self.pending_heartbeats)
+                self.pending_heartbeats = beats
+
+            db = self._reconnect(db)
+            raise
+        finally:
+            self.read_dbs.put(db)
+
+        msg = "Flushed %s chunk and %s error records"
+        vals = (len(chunks), len(errors))
+        logger.debug(msg % vals)
+
+# What workers use instead of a Database when there's a broker: same methods,
+# but each call is a round trip to the broker instead of to Postgres.
+class BrokerClient(object):
+    def __init__(self, **kwargs):
+        try:
+            address = kwargs.pop('address')
+            authkey = kwargs.pop('authkey')
+        except KeyError:
+            raise ValueError("Must provide broker address and authkey")
+
+        super(BrokerClient, self).__init__(**kwargs)
+
+        self.conn = mpc.Client(address, family='AF_UNIX', authkey=authkey)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tp, val, traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception as e:
+            pass
+
+    def _call(self, method, *args):
+        self.conn.send((method, args))
+        status, res = self.conn.recv()
+
+        if status != 'ok':
+            msg = "Broker call %s failed: %s"
+            vals = (method, res)
+            raise ex.BrokerException(msg % vals)
+
+        return res
+
+    def lock_task(self, chunk_error_threshold=None, max_kbps=None,
+                  default_kbps=128):
+        return self._call('lock_task', chunk_error_threshold, max_kbps,
+                          default_kbps)
+
+    def release_lock(self, station_id):
+        return self._call('release_lock', station_id)
+
+    def get_station(self, station_id):
+        return self._call('get_station', station_id)
+
+    def get_stop_conditions(self, station_id, chunk_error_threshold=None):
+        return self._call('get_stop_conditions', station_id,
+                          chunk_error_threshold)
+
+    def log_error(self, station_id, error):
+        return self._call('log_error', station_id, error)
+
+    def log_chunk(self, station_id, s3_url, byte_length=None, start_ts=None,
+                  end_ts=None, codec=None, kbps=None, sha256=None,
+                  stream_seq=None):
+        return self._call('log_chunk', station_id, s3_url, byte_length,
+                          start_ts, end_ts, codec, kbps, sha256, stream_seq)
+
+    def set_bitrate(self, station_id, kbps, chunk_bytes=None):
+        return self._call('set_bitrate', station_id, kbps, chunk_bytes)
+
+    def heartbeat(self, station_id, node_id, pid, claim_ts, chunk_count,
+                  error_count, heartbeat_ts, heartbeat_interval):
+        return self._call('heartbeat', station_id, node_id, pid, claim_ts,
+                          chunk_count, error_count, heartbeat_ts,
+                          heartbeat_interval)
@@ -7,3 +7,8 @@ class JobCancelledException(Exception):
 class TooManyFailuresException(Exception):
     pass
 
+class BrokerException(Exception):
+    pass
+
+class NoWorkException(Exception):
+    pass
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+'''
+Export the audio a station recorded over some time window as one file,
+or to stdout. The chunks covering the window are looked up in app.chunks,
+fetched from S3 in parallel (only the parts inside the window for the
+chunks at either end) and written out in order as they arrive, cut at
+frame boundaries so the result plays cleanly.
+
+Usage: ./export.py [-o OUTPUT] [-j JOBS] STATION START END
+
+STATION is a station_id or a name like WXYZ-FM; START and END are ISO 8601
+times, taken as UTC if they don't have a timezone.
+'''
+
+import sys
+import logging
+import argparse
+import datetime as dt
+import collections
+import urllib.parse as urlparse
+import concurrent.futures as cf
+
+import boto3
+
+from database import Database
+import audio_format as af
+
+logger = logging.getLogger(__name__)
+
+class Exporter(object):
+    def __init__(self, **kwargs):
+        dsn = kwargs.pop('dsn', 'Database')
+        jobs = kwargs.pop('jobs', 8)
+        pad = kwargs.pop('pad', 2**14)
+        gap_tolerance = kwargs.pop('gap_tolerance', 5)
+
+        super(Exporter, self).__init__(**kwargs)
+
+        if jobs < 1:
+            raise ValueError("Must have at least one job")
+
+        self.dsn = dsn
+        self.jobs = jobs
+
+        # Where a window boundary falls inside a chunk, we estimate the byte
+        # offset assuming a constant bitrate and fetch pad bytes either
+        # side of it to find a frame boundary in
+        self.pad = pad
+
+        # warn about gaps between chunks longer than this many seconds
+        self.gap_tolerance = gap_tolerance
+
+        self.db = Database(dsn=self.dsn)
+        self.s3 = boto3.client('s3')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tp, val, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def resolve(self, station, start_ts, end_ts):
+        'The chunks of a station covering a window, in order'
+        station_id = self.db.find_station(station)
+        if station_id is None:
+            raise ValueError("No such station %s" % (station,))
+
+        chunks = self.db.get_chunks(station_id, start_ts, end_ts)
+
+        for chunk in chunks:
+            chunk['start_ts'] = float(chunk['start_ts'])
+            chunk['end_ts'] = float(chunk['end_ts'])
+
+        for prev, chunk in zip(chunks, chunks[1:]):
+            if chunk['start_ts'] - prev['end_ts'] > self.gap_tolerance:
+                msg = "Gap of %.1fs in station %s's audio before chunk %s"
+                vals = (chunk['start_ts'] - prev['end_ts'], station,
+                        chunk['chunk_id'])
+                logger.warning(msg % vals)
+
+        return chunks
+
+    def _offset(self, chunk, ts):
+        # byte offset of time ts within a chunk, or None if we don't know
+        # enough about it to say
+        length, start, end = chunk['byte_length'], chunk['start_ts'], chunk['end_ts']
+
+        if length is None or end <= start:
+            return None
+
+        frac = (ts - start) / (end - start)
+        return int(length * min(1, max(0, frac)))
+
+    def plan(self, chunks, start_ts, end_ts):
+        '''
+        What to fetch for each chunk: (chunk, first_byte, last_byte, cut_start,
+        cut_end), with the byte range inclusive and None meaning the whole
+        object, and the cut flags saying whether that end needs trimming to
+        a frame boundary
+        '''
+        ret = []
+
+        for i, chunk in enumerate(chunks):
+            lo, hi = 0, None
+            cut_start, cut_end = False, False
+
+            if i == 0 and chunk['start_ts'] < start_ts:
+                offset = self._offset(chunk, start_ts)
+                if offset is not None:
+                    lo, cut_start = max(0, offset - self.pad), True
+
+            if i == len(chunks) - 1 and chunk['end_ts'] > end_ts:
+                offset = self._offset(chunk, end_ts)
+                if offset is not None:
+                    hi = min(chunk['byte_length'], offset + self.pad) - 1
+                    cut_end = True
+
+            ret += [(chunk, lo, hi, cut_start, cut_end)]
+
+        return ret
+
+    def fetch(self, piece, start_ts, end_ts):
+        chunk, lo, hi, cut_start, cut_end = piece
+
+        parsed = urlparse.urlparse(chunk['s3_url'])
+        args = {'Bucket': parsed.netloc, 'Key': parsed.path.lstrip('/')}
+
+        if lo > 0 or hi is not None:
+            args['Range'] = 'bytes=%s-%s' % (lo, '' if hi is None else hi)
+
+        data = self.s3.get_object(**args)['Body'].read()
+        codec = chunk['codec']
+
+        # Trim to the frames nearest the window's edges. We work on
+        # offsets relative to what we fetched, which may not start at the
+        # beginning of the object
+        first, last = 0, len(data)
+
+        if cut_end:
+            limit = self._offset(chunk, end_ts) - lo
+            last = af.last_boundary(codec, data, min(len(data), max(0, limit)))
+
+        if cut_start:
+            want = self._offset(chunk, start_ts) - lo
+            found = af.find_boundary(codec, data, want)
+            first = want if found is None else found
+
+        return data[first:max(first, last)]
+
+    def export(self, station, start_ts, end_ts, out):
+        '''
+        Write a station's audio from start_ts to end_ts (unix timestamps)
+        to the binary file object out; returns how many bytes were written
+        '''
+        chunks = self.resolve(station, start_ts, end_ts)
+        if len(chunks) == 0:
+            return 0
+
+        codecs = set(x['codec'] for x in chunks if x['codec'] is not None)
+        if len(codecs) > 1:
+            msg = "Station %s changed format during the window: %s"
+            vals = (station, ', '.join(sorted(codecs)))
+            logger.warning(msg % vals)
+
+        written = 0
+
+        # Fetch ahead of what we're writing, but only so far, so memory use
+        # stays bounded however long the window is
+        with cf.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            pending = collections.deque()
+
+            for piece in self.plan(chunks, start_ts, end_ts):
+                pending.append(pool.submit(self.fetch, piece, start_ts, end_ts))
+
+                if len(pending) >= 2 * self.jobs:
+                    data = pending.popleft().result()
+                    out.write(data)
+                    written += len(data)
+
+            while len(pending) > 0:
+                data = pending.popleft().result()
+                out.write(data)
+                written += len(data)
+
+        return written
+
+def parse_time(txt):
+    ret = dt.datetime.fromisoformat(txt)
+
+    if ret.tzinfo is None:
+        ret = ret.replace(tzinfo=dt.timezone.utc)
+
+    return ret.timestamp()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a station\'s audio for a time window')
+    parser.add_argument('station', help='station_id or name (e.g. WXYZ-FM)')
+    parser.add_argument('start', type=parse_time,
+                        help='ISO 8601 start time (UTC if no timezone)')
+    parser.add_argument('end', type=parse_time,
+                        help='ISO 8601 end time (UTC if no timezone)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='File to write to (default: stdout)')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Chunks to fetch in parallel')
+    parser.add_argument('--dsn', default='Database',
+                        help='ODBC data source name')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    args = parse_args()
+
+    if args.end <= args.start:
+        sys.exit('End time must be after start time')
+
+    with Exporter(dsn=args.dsn, jobs=args.jobs) as exporter:
+        if args.output == '-':
+            nbytes = exporter.export(args.station, args.start, args.end,
+                                     sys.stdout.buffer)
+        else:
+            with open(args.output, 'wb') as out:
+                nbytes = exporter.export(args.station, args.start, args.end,
+                                         out)
+
+    logger.info('Exported %s bytes' % (nbytes,))
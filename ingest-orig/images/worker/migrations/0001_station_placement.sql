@@ -0,0 +1,21 @@
+/*
+ * Bitrate-aware station placement: per-station cost estimates and the
+ * capacity each node advertises. Safe to run more than once.
+ */
+
+alter table app.jobs
+    add column if not exists est_kbps real;
+
+create table if not exists app.nodes
+(
+    node_id text not null primary key,
+
+    max_kbps real not null,
+    max_slots integer not null,
+    cpu_count integer,
+
+    load_kbps real not null default 0,
+    running integer not null default 0,
+
+    heartbeat_dt timestamptz not null default now()
+);
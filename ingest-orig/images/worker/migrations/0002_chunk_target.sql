@@ -0,0 +1,7 @@
+/*
+ * Duration-targeted chunk sizing: record the chunk size each station's
+ * worker is currently aiming for. Safe to run more than once.
+ */
+
+alter table app.jobs
+    add column if not exists chunk_bytes integer;
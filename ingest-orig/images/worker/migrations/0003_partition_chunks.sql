@@ -0,0 +1,152 @@
+/*
+ * Partition app.chunks by month on create_dt. The existing table is
+ * renamed, a partitioned one created in its place with partitions covering
+ * all of its data, the rows copied over and the old table dropped. Run it
+ * in one transaction while the workers are stopped.
+ */
+
+begin;
+
+alter table app.chunks rename to chunks_old;
+alter table app.chunks_old rename constraint chunks_pkey to chunks_old_pkey;
+
+create table app.chunks
+(
+    chunk_id bigint not null default nextval('app.chunks_chunk_id_seq'),
+
+    station_id integer not null
+               references data.station
+               on delete restrict,
+
+    create_dt timestamptz not null default now(),
+    s3_url text not null,
+
+    primary key (chunk_id, create_dt)
+) partition by range (create_dt);
+
+alter sequence app.chunks_chunk_id_seq owned by app.chunks.chunk_id;
+
+create index chunks_create_dt_brin
+on app.chunks
+    using brin (create_dt);
+
+create index chunks_station_id_create_dt
+on app.chunks
+    (station_id, create_dt);
+
+create table app.chunks_default
+partition of app.chunks default;
+
+create schema if not exists archive;
+
+-- Create the partition of app.chunks holding the month that month_dt falls
+-- in, if there isn't one yet. Rows for that month which already went to
+-- the default partition are moved into the new one so that it can attach.
+create or replace function app.create_chunk_partition(month_dt timestamptz)
+returns text
+language plpgsql
+as $$
+declare
+    lo timestamptz := date_trunc('month', month_dt);
+    hi timestamptz := date_trunc('month', month_dt) + interval '1 month';
+    part text := 'chunks_p' || to_char(date_trunc('month', month_dt), 'YYYYMM');
+begin
+    if to_regclass('app.' || part) is not null then
+        return part;
+    end if;
+
+    execute format('create table app.%I (like app.chunks including defaults)',
+                   part);
+
+    execute format('
+        with moved as
+        (
+            delete from app.chunks_default
+            where
+                create_dt >= %L and
+                create_dt < %L
+            returning *
+        )
+        insert into app.%I
+        select
+            *
+        from moved
+    ', lo, hi, part);
+
+    execute format('alter table app.chunks attach partition app.%I
+                    for values from (%L) to (%L)', part, lo, hi);
+
+    return part;
+end;
+$$;
+
+-- Make sure partitions exist for this month and the next months_ahead, and
+-- if retention is given, detach partitions entirely older than that and
+-- move them to the archive schema. The pool calls this periodically; only
+-- one caller at a time does anything.
+create or replace function app.maintain_chunk_partitions
+(
+    months_ahead integer default 2,
+    retention interval default null
+)
+returns void
+language plpgsql
+as $$
+declare
+    stale record;
+begin
+    -- two-argument form so as not to collide with locks on station_id
+    if not pg_try_advisory_xact_lock(0, 1) then
+        return;
+    end if;
+
+    for i in 0..months_ahead loop
+        perform app.create_chunk_partition(now() + i * interval '1 month');
+    end loop;
+
+    if retention is null then
+        return;
+    end if;
+
+    for stale in
+        select
+            c.relname
+        from pg_inherits inh
+            inner join pg_class c on c.oid = inh.inhrelid
+        where
+            inh.inhparent = 'app.chunks'::regclass and
+            c.relname ~ '^chunks_p[0-9]+$' and
+            to_date(substr(c.relname, 9), 'YYYYMM') + interval '1 month'
+                <= now() - retention
+    loop
+        execute format('alter table app.chunks detach partition app.%I',
+                       stale.relname);
+        execute format('alter table app.%I set schema archive', stale.relname);
+    end loop;
+end;
+$$;
+
+-- a partition for every month we have data for, plus the usual ones ahead
+select
+    app.create_chunk_partition(m)
+from generate_series
+(
+    date_trunc('month', (select min(create_dt) from app.chunks_old)),
+    now(),
+    interval '1 month'
+) m;
+
+select app.maintain_chunk_partitions();
+
+insert into app.chunks
+    (chunk_id, station_id, create_dt, s3_url)
+select
+    chunk_id,
+    station_id,
+    create_dt,
+    s3_url
+from app.chunks_old;
+
+drop table app.chunks_old;
+
+commit;
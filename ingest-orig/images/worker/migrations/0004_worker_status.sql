@@ -0,0 +1,167 @@
+/*
+ * Track worker liveness in app.worker_status instead of reading pg_locks,
+ * and keep an hourly per-station rollup of chunks and errors. The views
+ * are replaced with ones reading the new table. Workers running an older
+ * version don't heartbeat, so upgrade them all together.
+ */
+
+begin;
+
+-- What each running worker is doing, kept up to date by periodic
+-- heartbeats. Cheaper for monitoring to read than pg_locks, and rows whose
+-- heartbeat is old are ignored, so crashed workers drop out on their own.
+create table if not exists app.worker_status
+(
+    station_id integer not null primary key,
+
+    node_id text,
+    pid integer,
+
+    claim_dt timestamptz not null default now(),
+    heartbeat_dt timestamptz not null default now(),
+
+    -- since the worker claimed the station
+    chunk_count bigint not null default 0,
+    error_count integer not null default 0
+);
+
+-- Chunks and errors per station per hour, maintained incrementally by
+-- app.refresh_station_hourly() for chunks and as errors are logged for
+-- errors
+create table if not exists app.station_hourly
+(
+    station_id integer not null,
+    hour_dt timestamptz not null,
+
+    chunk_count integer not null default 0,
+    error_count integer not null default 0,
+
+    primary key (station_id, hour_dt)
+);
+
+-- how far app.refresh_station_hourly() has got through app.chunks
+create table if not exists app.rollup_state
+(
+    name text not null primary key,
+    watermark_dt timestamptz not null
+);
+
+-- Fold chunks created since the last call into app.station_hourly. Only
+-- chunks at least a minute old are counted, so that ones in transactions
+-- still open when we run aren't skipped over.
+create or replace function app.refresh_station_hourly()
+returns void
+language plpgsql
+as $$
+declare
+    lo timestamptz;
+    hi timestamptz := now() - interval '1 minute';
+begin
+    if not pg_try_advisory_xact_lock(0, 2) then
+        return;
+    end if;
+
+    select
+        watermark_dt
+    into lo
+    from app.rollup_state
+    where
+        name = 'station_hourly';
+
+    if lo is null then
+        select
+            coalesce(min(create_dt), hi)
+        into lo
+        from app.chunks;
+    end if;
+
+    if lo >= hi then
+        return;
+    end if;
+
+    insert into app.station_hourly
+        (station_id, hour_dt, chunk_count)
+    select
+        station_id,
+        date_trunc('hour', create_dt),
+        count(*)
+    from app.chunks
+    where
+        create_dt >= lo and
+        create_dt < hi
+    group by 1, 2
+    on conflict (station_id, hour_dt) do update
+    set
+        chunk_count = app.station_hourly.chunk_count + excluded.chunk_count;
+
+    insert into app.rollup_state
+        (name, watermark_dt)
+    values
+        ('station_hourly', hi)
+    on conflict (name) do update
+    set
+        watermark_dt = excluded.watermark_dt;
+end;
+$$;
+
+drop view if exists app.stats, app.running, app.waiting, app.failed;
+
+-- Workers that have checked in recently; the workers heartbeat every
+-- minute or so by default
+create or replace view app.live_workers as
+select
+    *
+from app.worker_status
+where
+    heartbeat_dt > now() - interval '5 minutes';
+
+-- Overall job status report
+create or replace view app.stats as
+select
+    count(*) as cnt,
+    count(w.station_id) as count_working,
+    sum((j.error_count > 0)::int) as count_failed,
+    max(j.error_count) as highest_error_count,
+    min(j.create_dt) as oldest_create_dt
+from app.jobs j
+    left join app.live_workers w using(station_id);
+
+-- Streams that are currently running correctly
+create or replace view app.running as
+select
+    j.station_id
+from app.jobs j
+    inner join app.live_workers w using(station_id);
+
+-- Streams in the queue that aren't currently running
+create or replace view app.waiting as
+select
+    j.station_id
+from app.jobs j
+    left join app.live_workers w using(station_id)
+where
+    w.station_id is null;
+
+-- Streams that have ever failed and whether they're currently running
+create or replace view app.failed as
+select
+    j.station_id,
+    (w.station_id is not null) as running
+from app.jobs j
+    left join app.live_workers w using(station_id)
+where
+    j.error_count > 0;
+
+-- Per-station throughput and error rates over the last day, from the rollup
+create or replace view app.station_rates as
+select
+    station_id,
+    sum(chunk_count) / 24.0 as chunks_per_hour,
+    sum(error_count) / 24.0 as errors_per_hour,
+    max(hour_dt) filter (where chunk_count > 0) as last_chunk_hour_dt
+from app.station_hourly
+where
+    hour_dt > now() - interval '24 hours'
+group by 1;
+
+commit;
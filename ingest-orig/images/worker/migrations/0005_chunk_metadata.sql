@@ -0,0 +1,14 @@
+/*
+ * Per-chunk metadata recorded by the workers. Older rows are left null.
+ * Adding the columns to app.chunks adds them to all its partitions. Safe to
+ * run more than once.
+ */
+
+alter table app.chunks
+    add column if not exists byte_length bigint,
+    add column if not exists start_dt timestamptz,
+    add column if not exists end_dt timestamptz,
+    add column if not exists codec text,
+    add column if not exists kbps real,
+    add column if not exists sha256 text,
+    add column if not exists stream_seq integer;
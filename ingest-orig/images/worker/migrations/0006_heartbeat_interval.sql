@@ -0,0 +1,21 @@
+/*
+ * Record how often each worker heartbeats, and count a worker as live if
+ * it's checked in within a few of its own intervals rather than within a
+ * fixed five minutes, which was too short for workers with a longer
+ * HEARTBEAT_INTERVAL or CHUNK_DURATION. Workers running an older version
+ * get the default of 60 seconds. Safe to run more than once.
+ */
+
+begin;
+
+alter table app.worker_status
+    add column if not exists heartbeat_interval integer not null default 60;
+
+create or replace view app.live_workers as
+select
+    *
+from app.worker_status
+where
+    heartbeat_dt > now() - 3 * heartbeat_interval * interval '1 second';
+
+commit;
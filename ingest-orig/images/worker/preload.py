@@ -0,0 +1,27 @@
+# Imported once by the forkserver process that RadioPool uses as a template
+# for its workers. Everything here is done a single time per node; every
+# worker forked afterwards inherits it instead of paying for it again on each
+# respawn.
+
+import requests
+import pyodbc
+import boto3
+
+# audio_stream only imports its parsers when a station needs them, so that
+# workers started any other way don't pay for them; here they cost nothing
+# per worker, and every worker forked from the template has them warm
+import bs4
+import lxml.etree
+import m3u8
+
+import radio_worker
+import audio_stream
+
+# Building a boto3 client is mostly loading and parsing botocore's JSON
+# service models and endpoint data, which botocore caches per session. Warm
+# the default session's cache so workers' boto3.client('s3') calls are cheap.
+# (We deliberately don't create a client here: that would resolve AWS
+# credentials in the template process.)
+boto3.setup_default_session()
+boto3.DEFAULT_SESSION._session.get_service_model('s3')
+boto3.DEFAULT_SESSION._session.get_data('endpoints')
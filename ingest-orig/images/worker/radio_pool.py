@@ -1,16 +1,50 @@
 import os
-import re
 import time
+import socket
+import queue
 import logging
 import multiprocessing as mp
+import multiprocessing.connection as mpc
 
-import pyodbc
-
-import exceptions as ex
-from radio_worker import RadioWorker, payload
+from database import Database
+from db_broker import DatabaseBroker
+from radio_worker import run_worker, NO_WORK_EXIT
 
 logger = logging.getLogger(__name__)
 
+# One of the pool's n_tasks places for a worker process, with the state we
+# need to decide when to restart it
+class Slot(object):
+    def __init__(self, index):
+        self.index = index
+
+        self.process = None
+        self.start_ts = None
+
+        # consecutive exits that came too soon after starting, and when
+        # we're next allowed to start a worker here
+        self.failures = 0
+        self.due_ts = 0
+
+        # seconds this slot had a live worker in the current report window
+        self.busy = 0
+
+        # what the worker is ingesting, as it reports back to us
+        self.station_id = None
+        self.kbps = None
+        self.claim_ts = None
+
+        # whether we stopped it ourselves to rebalance load
+        self.shed = False
+
+    @property
+    def running(self):
+        return self.process is not None
+
+    @property
+    def claimed(self):
+        return self.running and self.station_id is not None
+
 class RadioPool(object):
     def __init__(self, **kwargs):
         try:
@@ -23,16 +57,102 @@ class RadioPool(object):
         self.chunk_error_behavior = kwargs.pop('chunk_error_behavior', 'ignore')
         self.chunk_error_threshold = kwargs.pop('chunk_error_threshold', 10)
         self.chunk_size = kwargs.pop('chunk_size', 5 * 2**20)
+        self.chunk_duration = kwargs.pop('chunk_duration', 60)
+        self.min_chunk_size = kwargs.pop('min_chunk_size', 2**18)
+        self.max_chunk_size = kwargs.pop('max_chunk_size', 16 * 2**20)
+        self.read_size = kwargs.pop('read_size', 2**16)
         self.create_schema = kwargs.pop('create_schema', 1)
         self.db_setup = kwargs.pop('db_setup', None)
+        self.variant_policy = kwargs.pop('variant_policy', 'highest')
+        self.variant_codec = kwargs.pop('variant_codec', None)
+        self.variant_bitrate = kwargs.pop('variant_bitrate', None)
+        self.playlist_mode = kwargs.pop('playlist_mode', 'sequential')
 
         self.poll_interval = kwargs.pop('poll_interval', 300)
         self.n_tasks = kwargs.pop('n_tasks', 10)
 
+        # With 'forkserver', workers are forked from a template process that
+        # has already imported the modules in preload, so respawning one
+        # doesn't mean a cold start
+        self.start_method = kwargs.pop('start_method', 'forkserver')
+        self.preload = kwargs.pop('preload', ['preload'])
+        self.log_config = kwargs.pop('log_config', None)
+
+        # In 'broker' mode workers don't connect to the database themselves;
+        # a broker in this process does their queries over a few shared
+        # connections. In 'direct' mode each worker has its own.
+        self.db_mode = kwargs.pop('db_mode', 'broker')
+        self.broker_connections = kwargs.pop('broker_connections', 2)
+        self.broker_flush_interval = kwargs.pop('broker_flush_interval', 5)
+
+        # A worker that exits within min_uptime seconds of starting counts as
+        # a crash; consecutive crashes back off exponentially from
+        # backoff_base seconds up to backoff_max
+        self.min_uptime = kwargs.pop('min_uptime', 60)
+        self.backoff_base = kwargs.pop('backoff_base', 1)
+        self.backoff_max = kwargs.pop('backoff_max', 300)
+
+        # Placement: each node advertises node_max_kbps of capacity and
+        # claims stations to keep its load near its fair share of the
+        # fleet's total, give or take the hysteresis fraction. Stations we
+        # haven't measured yet are assumed to cost default_kbps, and we
+        # don't move a station that's been running less than min_residency
+        # seconds.
+        self.placement = kwargs.pop('placement', True)
+        self.default_kbps = kwargs.pop('default_kbps', 128)
+        self.node_max_kbps = kwargs.pop('node_max_kbps', None)
+        self.hysteresis = kwargs.pop('hysteresis', 0.2)
+        self.min_residency = kwargs.pop('min_residency', 1800)
+
+        # Every maintenance_interval seconds, make sure app.chunks has
+        # partitions for the next months_ahead months, and if
+        # retention_days is set, archive ones older than that
+        self.maintenance_interval = kwargs.pop('maintenance_interval', 3600)
+        self.partition_months_ahead = kwargs.pop('partition_months_ahead', 2)
+        self.partition_retention_days = kwargs.pop('partition_retention_days', None)
+
+        # how often workers report their status to app.worker_status
+        self.heartbeat_interval = kwargs.pop('heartbeat_interval', 60)
+
         super(RadioPool, self).__init__(**kwargs)
 
-        self.db = pyodbc.connect(dsn=self.dsn)
-        self.pool = mp.Pool(self.n_tasks, maxtasksperchild=1)
+        if self.start_method not in mp.get_all_start_methods():
+            msg = "Bad start method %s"
+            vals = (self.start_method,)
+            raise ValueError(msg % vals)
+
+        if self.db_mode not in ('broker', 'direct'):
+            raise ValueError("db_mode must be 'broker' or 'direct'")
+
+        # Forked children would inherit the broker's sockets and database
+        # connections, and could close them out from under it
+        if self.db_mode == 'broker' and self.start_method == 'fork':
+            raise ValueError("Broker mode requires start method other than 'fork'")
+
+        self.ctx = mp.get_context(self.start_method)
+        if self.start_method == 'forkserver':
+            self.ctx.set_forkserver_preload(self.preload)
+
+        self.db = Database(dsn=self.dsn)
+
+        if self.db_mode == 'broker':
+            self.broker = DatabaseBroker(
+                dsn=self.dsn,
+                n_connections=self.broker_connections,
+                flush_interval=self.broker_flush_interval
+            )
+        else:
+            self.broker = None
+
+        if self.node_max_kbps is None:
+            self.node_max_kbps = self.n_tasks * self.default_kbps
+
+        self.node_id = '%s-%s' % (socket.gethostname(), os.getpid())
+        self.target_kbps = None
+
+        self.events = self.ctx.Queue()
+        self.slots = [Slot(i) for i in range(self.n_tasks)]
+        self.worker_args = None
 
     def __enter__(self):
         return self
@@ -41,51 +161,353 @@ class RadioPool(object):
         self.close()
 
     def close(self):
+        try:
+            if self.placement:
+                self.db.remove_node(self.node_id)
+        except Exception as e:
+            pass
+
         try:
             self.db.close()
         except Exception as e:
             pass
 
+        for slot in self.slots:
+            try:
+                if slot.running:
+                    slot.process.terminate()
+                    slot.process.join(5)
+            except Exception as e:
+                pass
+
         try:
-            self.pool.terminate()
+            self.events.close()
         except Exception as e:
             pass
 
-    def run(self):
-        # Spawn initial set of tasks
-        results = []
+        try:
+            if self.broker is not None:
+                self.broker.close()
+        except Exception as e:
+            pass
+
+    def process_events(self):
+        slots = {
+            x.process.pid: x
+            for x in self.slots
+            if x.running
+        }
+
+        while True:
+            try:
+                event = self.events.get(block=False)
+            except queue.Empty:
+                break
+
+            slot = slots.get(event['pid'])
+
+            if event['event'] == 'claim' and slot is not None:
+                slot.station_id = event['station_id']
+                slot.kbps = event['kbps']
+                slot.claim_ts = time.time()
+            elif event['event'] == 'bitrate' and slot is not None:
+                slot.kbps = event['kbps']
+            elif event['event'] == 'startup':
+                msg = "Worker %s %s station_id %s: ready in %s, " \
+                      "stream open %.2fs after claim, %s total"
+                vals = (
+                    event['pid'],
+                    'respawned for' if event['respawn'] else 'started on',
+                    event['station_id'],
+                    self._fmt_seconds(event['ready']),
+                    event['to_stream'],
+                    self._fmt_seconds(event['total'])
+                )
+                logger.info(msg % vals)
+
+    @staticmethod
+    def _fmt_seconds(val):
+        return 'unknown' if val is None else '%.2fs' % (val,)
+
+    ##
+    ## Placement
+    ##
+
+    def load(self):
+        'Estimated kbps of the stations this node is running'
+        return sum(
+            self.default_kbps if x.kbps is None else x.kbps
+            for x in self.slots
+            if x.claimed
+        )
+
+    def budget(self):
+        'The most a newly started worker should take on, in kbps'
+        if not self.placement or self.target_kbps is None:
+            return None
+
+        # workers that haven't claimed anything yet will probably take
+        # about the default
+        pending = len([x for x in self.slots if x.running and not x.claimed])
+        load = self.load() + pending * self.default_kbps
+
+        if load < self.target_kbps:
+            # below our share, take anything we physically can, even if
+            # that overshoots; otherwise a station costlier than everyone's
+            # share would never be placed anywhere
+            budget = self.node_max_kbps - load
+        else:
+            budget = self.target_kbps * (1 + self.hysteresis) - load
+
+        return max(budget, 0)
 
-        args = {
+    def place(self):
+        # Advertise our capacity and load, then work out our fair share of
+        # the fleet's total demand
+        self.db.advertise_node(
+            node_id=self.node_id,
+            max_kbps=self.node_max_kbps,
+            max_slots=self.n_tasks,
+            cpu_count=os.cpu_count(),
+            load_kbps=self.load(),
+            running=len([x for x in self.slots if x.claimed])
+        )
+
+        fleet = self.db.get_fleet_load(
+            max_age=3 * self.poll_interval,
+            chunk_error_threshold=self.chunk_error_threshold,
+            default_kbps=self.default_kbps
+        )
+
+        capacity, demand = fleet['capacity_kbps'], fleet['demand_kbps']
+        share = min(1, demand / capacity) if capacity > 0 else 1
+        self.target_kbps = self.node_max_kbps * share
+
+        load = self.load()
+        msg = "Node %s load %.0f kbps, target %.0f kbps (fleet demand " \
+              "%.0f of %.0f kbps capacity)"
+        vals = (self.node_id, load, self.target_kbps, demand, capacity)
+        logger.info(msg % vals)
+
+        # Only shed when we're above the hysteresis band, and only a
+        # station whose removal leaves us at or above our target, so it
+        # can't just bounce back and forth between nodes
+        if load <= self.target_kbps * (1 + self.hysteresis):
+            return
+
+        now = time.time()
+        excess = load - self.target_kbps
+
+        candidates = [
+            x for x in self.slots
+            if x.claimed and
+               now - x.claim_ts >= self.min_residency and
+               (self.default_kbps if x.kbps is None else x.kbps) <= excess
+        ]
+
+        if len(candidates) == 0:
+            return
+
+        # one at a time, biggest first, to converge quickly without
+        # overcorrecting
+        slot = max(candidates, key=lambda x: x.kbps or self.default_kbps)
+
+        msg = "Shedding station_id %s (%.0f kbps) from slot %s to rebalance"
+        vals = (slot.station_id, slot.kbps or self.default_kbps, slot.index)
+        logger.info(msg % vals)
+
+        slot.shed = True
+        slot.process.terminate()
+
+    def maintain(self):
+        self.db.maintain_chunk_partitions(
+            months_ahead=self.partition_months_ahead,
+            retention_days=self.partition_retention_days
+        )
+
+        logger.debug('Maintained app.chunks partitions')
+
+    ##
+    ## Supervision
+    ##
+
+    def spawn(self, slot, respawn=False):
+        args = dict(self.worker_args, spawn_ts=time.time(), respawn=respawn,
+                    max_kbps=self.budget(), default_kbps=self.default_kbps)
+
+        slot.process = self.ctx.Process(
+            target=run_worker,
+            args=(args, self.events, self.log_config),
+            daemon=True
+        )
+        slot.process.start()
+        slot.start_ts = time.time()
+
+    def reap(self, slot, window_start):
+        # Called as soon as the slot's process has exited, to record how it
+        # went and schedule its replacement
+        now = time.time()
+
+        slot.process.join()
+        exitcode = slot.process.exitcode
+        uptime = now - slot.start_ts
+
+        slot.busy += now - max(slot.start_ts, window_start)
+        slot.process, slot.start_ts = None, None
+        slot.station_id, slot.kbps, slot.claim_ts = None, None, None
+
+        if exitcode == 0:
+            msg = "Incorrect termination by ingest worker"
+            raise ValueError(msg)
+
+        # Neither of these is a crash. A shed station should get a chance
+        # to be claimed elsewhere before we start another worker here.
+        if slot.shed:
+            slot.shed = False
+            slot.due_ts = now + self.poll_interval
+            return
+        elif exitcode == NO_WORK_EXIT:
+            slot.due_ts = now
+            return
+
+        if uptime < self.min_uptime:
+            slot.failures += 1
+        else:
+            slot.failures = 0
+
+        # respawn right away unless this slot is crash looping
+        if slot.failures < 2:
+            delay = 0
+        else:
+            delay = min(self.backoff_base * 2**(slot.failures - 2),
+                        self.backoff_max)
+        slot.due_ts = now + delay
+
+        msg = "Worker in slot %s exited with code %s after %.1fs; " \
+              "respawning in %.1fs"
+        vals = (slot.index, exitcode, uptime, delay)
+        logger.warning(msg % vals)
+
+    def report_utilization(self, window_start):
+        now = time.time()
+        window = now - window_start
+
+        for slot in self.slots:
+            if slot.running:
+                slot.busy += now - max(slot.start_ts, window_start)
+
+        busy = sum(slot.busy for slot in self.slots)
+        utilization = busy / (window * len(self.slots)) if window > 0 else 0
+
+        running = len([x for x in self.slots if x.running])
+        backing_off = len([x for x in self.slots if not x.running and x.due_ts > now])
+
+        msg = "Slot utilization over last %.0fs: %.1f%% " \
+              "(%s running, %s backing off, %s slots)"
+        vals = (window, 100 * utilization, running, backing_off,
+                len(self.slots))
+        logger.info(msg % vals)
+
+        for slot in self.slots:
+            slot.busy = 0
+
+    def run(self):
+        self.worker_args = {
             'dsn': self.dsn,
             's3_bucket': self.s3_bucket,
             's3_prefix': self.s3_prefix,
             'chunk_error_behavior': self.chunk_error_behavior,
             'chunk_error_threshold': self.chunk_error_threshold,
             'chunk_size': self.chunk_size,
+            'chunk_duration': self.chunk_duration,
+            'min_chunk_size': self.min_chunk_size,
+            'max_chunk_size': self.max_chunk_size,
+            'read_size': self.read_size,
             'poll_interval': self.poll_interval,
             'create_schema': self.create_schema,
-            'db_setup': self.db_setup
+            'db_setup': self.db_setup,
+            'variant_policy': self.variant_policy,
+            'variant_codec': self.variant_codec,
+            'variant_bitrate': self.variant_bitrate,
+            'playlist_mode': self.playlist_mode,
+            'node_id': self.node_id,
+            'heartbeat_interval': self.heartbeat_interval
         }
 
+        # With a broker, set up the database once here rather than having
+        # the workers race each other to do it
+        if self.broker is not None:
+            if self.create_schema:
+                self.db.setup(self.db_setup)
+
+            self.broker.start()
+            self.worker_args['broker'] = self.broker.client_args
+            self.worker_args['create_schema'] = 0
+
+        if self.placement:
+            self.place()
+
+        # Spawn initial set of tasks
         logger.debug('Spawning initial tasks')
-        for i in range(0, self.n_tasks):
-            results += [self.pool.apply_async(payload, (args,))]
+        for slot in self.slots:
+            self.spawn(slot)
         logger.debug('Spawned initial tasks')
 
+        # Rather than polling, block until some worker process exits (its
+        # sentinel becomes ready), a worker sends an event, a backed-off
+        # slot is due to restart or it's time to report. Events have to be
+        # read as they come: a worker exiting with some still in a full
+        # pipe blocks flushing them, and so never looks like it exited
+        window_start = time.time()
+        maintained_ts = None
+
         while True:
-            time.sleep(self.poll_interval)
-
-            for (i, res) in enumerate(results):
-                if res.ready():
-                    if res.successful():
-                        msg = "Incorrect termination by ingest worker"
-                        raise ValueError(msg)
-                    else:
-                        try:
-                            res.get()
-                        except Exception as e:
-                            logger.exception("Worker exited")
-
-                    # Respawn the task after it exited
-                    results[i] = self.pool.apply_async(payload, (args,))
+            now = time.time()
+
+            waits = [window_start + self.poll_interval - now]
+            waits += [x.due_ts - now for x in self.slots if not x.running]
+            timeout = max(0, min(waits))
+
+            sentinels = {
+                x.process.sentinel: x
+                for x in self.slots
+                if x.running
+            }
+
+            ready = mpc.wait(list(sentinels.keys()) + [self.events._reader],
+                             timeout)
+
+            for sentinel in ready:
+                if sentinel in sentinels:
+                    self.reap(sentinels[sentinel], window_start)
+
+            now = time.time()
+            for slot in self.slots:
+                if not slot.running and slot.due_ts <= now:
+                    self.spawn(slot, respawn=True)
+
+            self.process_events()
+
+            if now - window_start >= self.poll_interval:
+                self.report_utilization(window_start)
+                window_start = now
+
+                if self.placement:
+                    try:
+                        self.place()
+                    except Exception as e:
+                        logger.exception("Failed to update placement")
+
+                try:
+                    self.db.refresh_station_hourly()
+                except Exception as e:
+                    logger.exception("Failed to refresh station rollup")
+
+                if maintained_ts is None or \
+                   now - maintained_ts >= self.maintenance_interval:
+                    maintained_ts = now
 
+                    try:
+                        self.maintain()
+                    except Exception as e:
+                        logger.exception("Failed to maintain partitions")
@@ -2,32 +2,62 @@ import gc
 import io
 import os
 import sys
-import csv
 import time
-import json
 import random
-import tarfile
+import hashlib
 import logging
-import tempfile
 
 import boto3
-import pyodbc
 
 import exceptions as ex
+from database import Database
+from db_broker import BrokerClient
 from audio_stream import AudioStream
+from audio_format import sniff_format
 
 logger = logging.getLogger(__name__)
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 
+# Exit status for a worker that gave up because nothing fit its budget, as
+# distinct from one that crashed
+NO_WORK_EXIT = 3
+
+# Set in each worker process by init_worker; used to send timings and other
+# events back to the RadioPool that started us
+_events = None
+
+def init_worker(events=None, log_config=None):
+    global _events
+    _events = events
+
+    # Workers started from a forkserver don't inherit the parent's logging
+    # setup, so we need to redo it here
+    if log_config is not None:
+        logging.basicConfig(**log_config)
+
 def payload(args):
     try:
         with RadioWorker(**args) as worker:
             worker.run()
+    except ex.NoWorkException as e:
+        logger.debug(str(e))
+        raise
     except Exception as e:
         logger.exception("Error in station ingest")
         raise
 
+def run_worker(args, events=None, log_config=None):
+    # entry point for the worker processes RadioPool starts
+    init_worker(events, log_config)
+
+    try:
+        payload(args)
+    except ex.NoWorkException as e:
+        sys.exit(NO_WORK_EXIT)
+    except Exception as e:
+        sys.exit(1) # payload has already logged it
+
 class RadioWorker(object):
     def __init__(self, **kwargs):
         # No AWS creds - we assume they're in the environment
@@ -41,31 +71,82 @@ class RadioWorker(object):
         chunk_error_behavior = kwargs.pop('chunk_error_behavior', 'ignore')
         chunk_error_threshold = kwargs.pop('chunk_error_threshold', 10)
         chunk_size = kwargs.pop('chunk_size', 5 * 2**20)
+        chunk_duration = kwargs.pop('chunk_duration', 60)
+        min_chunk_size = kwargs.pop('min_chunk_size', 2**18)
+        max_chunk_size = kwargs.pop('max_chunk_size', 16 * 2**20)
+        read_size = kwargs.pop('read_size', 2**16)
         poll_interval = kwargs.pop('poll_interval', 300)
         create_schema = kwargs.pop('create_schema', 1)
         db_setup = kwargs.pop('db_setup', None)
+        variant_policy = kwargs.pop('variant_policy', 'highest')
+        variant_codec = kwargs.pop('variant_codec', None)
+        variant_bitrate = kwargs.pop('variant_bitrate', None)
+        playlist_mode = kwargs.pop('playlist_mode', 'sequential')
+        spawn_ts = kwargs.pop('spawn_ts', None)
+        respawn = kwargs.pop('respawn', False)
+        broker = kwargs.pop('broker', None)
+        max_kbps = kwargs.pop('max_kbps', None)
+        default_kbps = kwargs.pop('default_kbps', 128)
+        node_id = kwargs.pop('node_id', None)
+        heartbeat_interval = kwargs.pop('heartbeat_interval', 60)
 
         super(RadioWorker, self).__init__(**kwargs)
 
         if chunk_error_behavior not in ('exit', 'ignore'):
             raise ValueError("chunk_error_behavior must be 'exit' or 'ignore'")
 
+        if min_chunk_size > max_chunk_size:
+            raise ValueError("min_chunk_size must not exceed max_chunk_size")
+
         self.dsn = dsn
         self.s3_bucket = s3_bucket
         self.s3_prefix = s3_prefix
         self.chunk_error_behavior = chunk_error_behavior
         self.chunk_error_threshold = chunk_error_threshold
         self.chunk_size = chunk_size
+        self.chunk_duration = chunk_duration
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.read_size = read_size
         self.poll_interval = poll_interval
         self.create_schema = create_schema
         self.db_setup = db_setup
-
-        self.db = pyodbc.connect(dsn=self.dsn)
-        self.db.autocommit = True
+        self.variant_policy = variant_policy
+        self.variant_codec = variant_codec
+        self.variant_bitrate = variant_bitrate
+        self.playlist_mode = playlist_mode
+        self.spawn_ts = spawn_ts
+        self.respawn = respawn
+        self.broker = broker
+        self.max_kbps = max_kbps
+        self.default_kbps = default_kbps
+        self.node_id = node_id
+        self.heartbeat_interval = heartbeat_interval
+
+        self.start_ts = time.time()
+        self.claim_ts = None
+
+        # Either talk to the database ourselves or have the pool's broker
+        # do it for us; both have the same interface
+        if self.broker is not None:
+            self.db = BrokerClient(**self.broker)
+        else:
+            self.db = Database(dsn=self.dsn)
 
         self.station = None
         self.station_id = None
         self.stream_url = None
+        self.est_kbps = None
+        self.bitrate_changed = False
+
+        # for heartbeats
+        self.chunk_count = 0
+        self.error_count = 0
+        self.heartbeat_ts = None
+
+        # chunks read since we claimed the station, including ones that
+        # failed to upload, so gaps in the sequence show up in app.chunks
+        self.stream_seq = 0
 
     def __enter__(self):
         return self
@@ -73,85 +154,25 @@ class RadioWorker(object):
     def __exit__(self, tp, val, traceback):
         self.close()
 
+    def report(self, event, **kwargs):
+        if _events is None:
+            return
+
+        msg = dict(kwargs, event=event, station_id=self.station_id,
+                   pid=os.getpid())
+
+        try:
+            _events.put(msg, block=False)
+        except Exception as e:
+            logger.warning("Failed to report %s event to pool" % (event,))
+
     def lock_task(self):
-        params = (
-            self.chunk_error_threshold is None,
-            self.chunk_error_threshold,
-            self.chunk_error_threshold is None,
-            self.chunk_error_threshold
-        )
-
-        with self.db.cursor() as cur:
-            cur.execute('''
-            -- SQL ported from https://github.com/chanks/que
-            with recursive job_locks as
-            (
-                select
-                    (j).*,
-                    pg_try_advisory_lock((j).station_id) as locked
-                from
-                (
-                    select
-                        j
-                    from app.jobs j
-                    where
-                        ? or
-                        j.error_count < ?
-                    order by station_id
-                    limit 1
-                ) as t1
-
-                union all
-
-                (
-                    select
-                        (j).*,
-                        pg_try_advisory_lock((j).station_id) as locked
-                    from
-                    (
-                        select
-                        (
-                            select
-                                j
-                            from app.jobs j
-                            where
-                                j.station_id > job_locks.station_id and
-                                (
-                                    ? or
-                                    j.error_count < ?
-                                )
-                            order by station_id
-                            limit 1
-                        ) as j
-                        from job_locks
-                        where
-                            job_locks.station_id is not null
-                        limit 1
-                    ) as t1
-                )
-            )
-            select
-                station_id
-            from job_locks
-            where
-                locked
-            limit 1;
-            ''', params)
-
-            res = cur.fetchall()
-            if len(res) > 0:
-                return res[0][0]
-            else:
-                return None
+        return self.db.lock_task(self.chunk_error_threshold,
+                                 max_kbps=self.max_kbps,
+                                 default_kbps=self.default_kbps)
 
     def release_lock(self):
-        with self.db.cursor() as cur:
-            cur.execute('''
-            select
-                pg_advisory_unlock(?);
-            ''', (self.station_id,))
-
-            return cur.fetchone()[0]
+        return self.db.release_lock(self.station_id)
 
     def close(self):
         try:
@@ -168,175 +189,166 @@ class RadioWorker(object):
         self.stream_url = None
 
     def get_stop_conditions(self):
-        with self.db.cursor() as cur:
-            params = (
-                self.station_id,
-                self.station_id,
-                self.chunk_error_threshold
-            )
-
-            cur.execute('''
-            select
-                not exists(
-                    select
-                        1
-                    from app.jobs
-                    where
-                        station_id = ?
-                ) as deleted,
-
-                exists(
-                    select
-                        1
-                    from app.jobs
-                    where
-                        station_id = ? and
-                        error_count >= ?
-                ) as failed;
-            ''', params)
-
-            ret = cur.fetchone()
-            cols = [col[0] for col in cur.description]
-
-            return dict(zip(cols, ret))
+        return self.db.get_stop_conditions(self.station_id,
+                                           self.chunk_error_threshold)
 
     def do_db_setup(self):
-        logger.info('Attempting database setup')
-
         # So we don't have all the workers try to get the lock at once
         time.sleep(random.uniform(0, 2*self.poll_interval))
 
-        try:
-            cur = self.db.cursor()
-
-            # use the two-argument version to avoid overlapping with
-            # locks on station_id values
-            cur.execute('select pg_try_advisory_lock(0, 0);')
-
-            if not cur.fetchone()[0]:
-                return # someone else got there first
-
-            # Check this in case we wake up after someone else gets the
-            # lock and does setup; if we can lock it again and we can tell
-            # the work is already done, just exit
-            cur.execute('''
-            select
-                not exists(
-                    select
-                        1
-                    from information_schema.schemata
-                    where
-                        schema_name = 'app'
-                ) as needs_setup;
-            ''')
-
-            if not cur.fetchone()[0]:
-                logger.info("Database already set up; aborting")
-                return
-
-            tables_to_copy = (
-                ('main.csv', 'data.station'),
-            )
-
-            data_source_bucket = self.db_setup['data_source_s3_bucket']
-            data_source_key = self.db_setup['data_source_s3_key']
-
-            # Set up the schema to hold data we'll be fetching
-            cur.execute(self.db_setup['schema_sql'])
-            logger.info("Set up database schema")
-
-            # Fetch the data from S3 and extract it
-            # => main.csv, maps.csv, map_coordinates.csv
-            s3 = boto3.resource('s3')
-            bucket = s3.Bucket(data_source_bucket)
-
-            with tempfile.TemporaryDirectory() as tmpdir:
-                with tempfile.NamedTemporaryFile(dir=tmpdir) as fn:
-                    bucket.download_file(data_source_key, fn.name)
-                    with tarfile.open(fn.name, 'r:gz') as tar:
-                        tar.extractall(path=tmpdir)
-
-                # Load the data we've extracted into the DB
-                for fname, tbl in tables_to_copy:
-                    pth = os.path.join(tmpdir, fname)
-
-                    with open(pth, 'rt') as f:
-                        reader = csv.reader(f, dialect='excel-tab')
-                        cols = next(reader)
-
-                        # NOTE: All this sql string munging isn't great, but
-                        # the assumption is we do control the input data
-                        placeholders = (tbl, ','.join(cols),
-                                        ','.join(['?'] * len(cols)))
-
-                        while cur.nextset():
-                            pass
-
-                        cur.executemany('''
-                        insert into %s
-                            (%s)
-                        values
-                            (%s)
-                        ''' % placeholders, reader)
-
-                        logger.info("Copied %s from %s" % (tbl, fname))
-
-            logger.info('Database successfully set up')
-        except Exception as e:
-            logger.exception("Failed to set up database")
-
-            try:
-                self.db.rollback()
-            except Exception as e:
-                logger.exception("Failed to roll back database set up")
-
-            raise
-        else:
-            try:
-                self.db.commit()
-            except Exception as e:
-                logger.exception("Failed to commit database set up")
-        finally:
-            try:
-                cur.close()
-            except Exception as e:
-                pass
+        self.db.setup(self.db_setup)
 
     def acquire_task(self):
-        # in a high-concurrency situation,
-        # spread out the load on the DB
-        time.sleep(random.uniform(0, 2*self.poll_interval))
+        # in a high-concurrency situation, spread out the load on the DB;
+        # this only matters when the whole pool starts at once, so don't
+        # make respawned workers wait
+        if not self.respawn:
+            time.sleep(random.uniform(0, 2*self.poll_interval))
 
         # Use a spinlock; if there's nothing to work on, let's
         # wait around and keep checking if there is
         while True:
             res = self.lock_task()
-            if res is None: # nothing to lock
-                logger.debug('Nothing to work on; spinning')
-                time.sleep(self.poll_interval)
-                continue
-            else:
+            if res is not None:
                 break
+
+            # Our budget was fixed when the pool started us, so rather
+            # than spin on a stale one, exit and let the pool start a new
+            # worker with an up to date budget
+            if self.max_kbps is not None:
+                time.sleep(self.poll_interval)
+
+                msg = "Nothing to work on within %.0f kbps"
+                vals = (self.max_kbps,)
+                raise ex.NoWorkException(msg % vals)
+
+            logger.debug('Nothing to work on; spinning')
+            time.sleep(self.poll_interval)
         self.station_id = res
 
-        with self.db.cursor() as cur:
-            cur.execute('''
-            select
-                callsign || '-' || band as station,
-                stream_url
-            from data.station
-            where
-                station_id = ?;
-            ''', (self.station_id,))
+        res = self.db.get_station(self.station_id)
+        self.station, self.stream_url, self.est_kbps = res
+        self.bitrate_changed = False
 
-            res = cur.fetchone()
-            self.station = res[0]
-            self.stream_url = res[1]
+        self.claim_ts = time.time()
+        self.report('claim', kbps=self.est_kbps)
+        self.heartbeat(force=True)
 
         return self
 
+    @property
+    def chunk_target(self):
+        'How many bytes to put in the next chunk'
+        # without a target duration, every station gets the same size
+        if not self.chunk_duration:
+            return self.chunk_size
+
+        kbps = self.default_kbps if self.est_kbps is None else self.est_kbps
+        target = int(1000 * kbps / 8 * self.chunk_duration)
+
+        return max(self.min_chunk_size, min(target, self.max_chunk_size))
+
+    def read_chunk(self, it):
+        # With a target duration, the stream hands us small reads and we
+        # put them together into chunks here, so that the size can follow
+        # the bitrate as we learn it
+        if not self.chunk_duration:
+            return next(it)
+
+        target = self.chunk_target
+        buf = bytearray()
+
+        while len(buf) < target:
+            try:
+                buf += next(it)
+            except StopIteration:
+                # upload what we have; we'll hit the end again next time
+                if len(buf) > 0:
+                    break
+                raise
+
+        return bytes(buf)
+
+    def chunk_metadata(self, chunk, start_ts, end_ts):
+        'What we record about a chunk in app.chunks besides where it is'
+        elapsed = end_ts - start_ts
+
+        return {
+            'byte_length': len(chunk),
+            'start_ts': start_ts,
+            'end_ts': end_ts,
+            'codec': sniff_format(chunk),
+            'kbps': 8 * len(chunk) / 1000 / elapsed if elapsed > 0 else None,
+            'sha256': hashlib.sha256(chunk).hexdigest(),
+            'stream_seq': self.stream_seq
+        }
+
+    def update_bitrate(self, chunk, last_ts):
+        # Estimate the stream's bitrate from how fast chunks arrive. The
+        # first one usually comes faster than real time because servers
+        # send a burst of buffered audio to new listeners, so we start
+        # measuring from the second.
+        now = time.time()
+
+        if last_ts is not None and now > last_ts:
+            kbps = 8 * len(chunk) / 1000 / (now - last_ts)
+
+            if self.est_kbps is None:
+                self.est_kbps = kbps
+            else:
+                self.est_kbps = 0.8 * self.est_kbps + 0.2 * kbps
+
+            self.bitrate_changed = True
+
+        return now
+
+    def record_bitrate(self):
+        # Save the estimate from update_bitrate; only done once a chunk is
+        # safely uploaded, so a failure here can't cost us the chunk
+        if not self.bitrate_changed:
+            return
+
+        # record what the next chunk will aim for, too
+        chunk_bytes = self.chunk_target if self.chunk_duration else None
+
+        self.db.set_bitrate(self.station_id, self.est_kbps, chunk_bytes)
+        self.report('bitrate', kbps=self.est_kbps)
+        self.bitrate_changed = False
+
+    def heartbeat(self, force=False):
+        # Let monitoring know we're alive, at most every heartbeat_interval
+        # seconds; with a broker these are batched with our other writes
+        now = time.time()
+
+        if not force and self.heartbeat_ts is not None and \
+           now - self.heartbeat_ts < self.heartbeat_interval:
+            return
+
+        # we only get here once per chunk, so a chunk taking longer than
+        # heartbeat_interval stretches the time between heartbeats
+        interval = int(max(self.heartbeat_interval, self.chunk_duration or 0))
+
+        self.db.heartbeat(self.station_id, self.node_id, os.getpid(),
+                          self.claim_ts, self.chunk_count, self.error_count,
+                          now, interval)
+        self.heartbeat_ts = now
+
+    def report_startup(self, opened_ts):
+        # How long it took from the pool asking for this worker to us
+        # having a live stream, broken down into process startup and the
+        # part after we'd claimed a station
+        timings = {
+            'respawn': self.respawn,
+            'ready': self.start_ts - self.spawn_ts if self.spawn_ts else None,
+            'to_stream': opened_ts - self.claim_ts,
+            'total': opened_ts - self.spawn_ts if self.spawn_ts else None
+        }
+
+        self.report('startup', **timings)
+
     def run(self):
-        if self.create_schema:
+        # the schema will exist by the time anything respawns
+        if self.create_schema and not self.respawn:
             self.do_db_setup()
 
         self.acquire_task()
@@ -345,13 +357,21 @@ class RadioWorker(object):
         vals = (self.station_id, self.stream_url)
         logger.info(msg % vals)
 
+        # with a target duration, read_chunk does the chunking
+        read_size = self.read_size if self.chunk_duration else self.chunk_size
+
         args = {
             'url': self.stream_url,
-            'chunk_size': self.chunk_size
+            'chunk_size': read_size,
+            'variant_policy': self.variant_policy,
+            'variant_codec': self.variant_codec,
+            'variant_bitrate': self.variant_bitrate,
+            'playlist_mode': self.playlist_mode
         }
 
         s3 = boto3.client('s3')
         stream, it = None, None
+        opened_ts, chunk_ts = None, None
 
         while True:
             conds = self.get_stop_conditions()
@@ -371,7 +391,21 @@ class RadioWorker(object):
                     stream = AudioStream(**args)
                     it = iter(stream)
 
-                chunk = next(it)
+                    if opened_ts is None:
+                        opened_ts = time.time()
+                        self.report_startup(opened_ts)
+
+                read_ts = time.time()
+                chunk = self.read_chunk(it)
+                self.stream_seq += 1
+
+                # Capture is continuous from one chunk to the next unless
+                # something failed in between, and the stream buffers
+                # while we're uploading, so each chunk starts where the
+                # last one ended
+                start_ts = read_ts if chunk_ts is None else chunk_ts
+                chunk_ts = self.update_bitrate(chunk, chunk_ts)
+                meta = self.chunk_metadata(chunk, start_ts, chunk_ts)
 
                 # Put it into S3
                 tm = str(int(time.time() * 1000000))
@@ -385,17 +419,13 @@ class RadioWorker(object):
                 s3_url = 's3://' + self.s3_bucket + '/' + key
                 logger.info(msg % (s3_url,))
             except Exception as e:
-                with self.db.cursor() as cur:
-                    # log the failure; this is concurency-safe because
-                    # we have the lock on this station_id
-                    cur.execute('''
-                    update app.jobs
-                    set
-                        error_count = error_count + 1,
-                        last_error = ?
-                    where
-                        station_id = ?;
-                    ''', (str(sys.exc_info()), self.station_id))
+                # log the failure; this is concurency-safe because
+                # we have the lock on this station_id
+                self.db.log_error(self.station_id, str(sys.exc_info()))
+                self.error_count += 1
+
+                # there's probably a gap before whatever we read next
+                chunk_ts = None
 
                 if isinstance(e, StopIteration):
                     raise # no point continuing after we hit this
@@ -405,16 +435,21 @@ class RadioWorker(object):
                     logger.exception('Chunk failed; ignoring')
             else:
                 # log the success
-                with self.db.cursor() as cur:
-                    cur.execute('''
-                    insert into app.chunks
-                        (station_id, s3_url)
-                    values
-                        (?, ?);
-                    ''', (self.station_id, s3_url))
+                self.db.log_chunk(self.station_id, s3_url, **meta)
+                self.chunk_count += 1
+
+                try:
+                    self.record_bitrate()
+                except Exception as e:
+                    logger.warning("Failed to record bitrate")
             finally:
                 gc.collect()
 
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logger.warning("Failed to send heartbeat")
+
                 try:
                     stream.close()
                 except Exception as e:
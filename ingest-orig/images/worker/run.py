@@ -26,11 +26,13 @@ if __name__ == '__main__':
     except KeyError:
         LOG_LEVEL = logging.INFO
 
-    logging.basicConfig(
-        level=LOG_LEVEL,
-        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    LOG_CONFIG = {
+        'level': LOG_LEVEL,
+        'format': '%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        'datefmt': '%Y-%m-%d %H:%M:%S'
+    }
+
+    logging.basicConfig(**LOG_CONFIG)
 
     try:
         S3_BUCKET = os.environ['S3_BUCKET']
@@ -67,6 +69,24 @@ if __name__ == '__main__':
     except KeyError:
         CHUNK_SIZE = 5 * 2**20
 
+    # Size chunks to hold about CHUNK_DURATION seconds of audio at each
+    # station's measured bitrate, within MIN_CHUNK_SIZE and MAX_CHUNK_SIZE
+    # bytes; set CHUNK_DURATION to 0 to use CHUNK_SIZE for every station
+    try:
+        CHUNK_DURATION = float(os.environ['CHUNK_DURATION'])
+    except KeyError:
+        CHUNK_DURATION = 60
+
+    try:
+        MIN_CHUNK_SIZE = int(os.environ['MIN_CHUNK_SIZE'])
+    except KeyError:
+        MIN_CHUNK_SIZE = 2**18
+
+    try:
+        MAX_CHUNK_SIZE = int(os.environ['MAX_CHUNK_SIZE'])
+    except KeyError:
+        MAX_CHUNK_SIZE = 16 * 2**20
+
     try:
         CHUNK_ERROR_THRESHOLD = int(os.environ['CHUNK_ERROR_THRESHOLD'])
     except KeyError:
@@ -87,6 +107,114 @@ if __name__ == '__main__':
     except KeyError:
         DATA_SOURCE_S3_KEY = 'talk-radio/radio.tar.gz'
 
+    # How to pick among the renditions in an HLS master playlist: one of
+    # 'lowest', 'highest', 'codec' (prefer VARIANT_CODEC, e.g. mp4a.40.2),
+    # 'bitrate' (closest to VARIANT_BITRATE, in bits/sec) or 'all'
+    try:
+        VARIANT_POLICY = os.environ['VARIANT_POLICY']
+    except KeyError:
+        VARIANT_POLICY = 'highest'
+
+    try:
+        VARIANT_CODEC = os.environ['VARIANT_CODEC']
+    except KeyError:
+        VARIANT_CODEC = None
+
+    try:
+        VARIANT_BITRATE = int(os.environ['VARIANT_BITRATE'])
+    except KeyError:
+        VARIANT_BITRATE = None
+
+    # Whether entries in PLS/ASX playlists are alternative mirrors of one
+    # stream ('mirror') or consecutive pieces of it ('sequential', the old
+    # behavior and the default)
+    try:
+        PLAYLIST_MODE = os.environ['PLAYLIST_MODE']
+    except KeyError:
+        PLAYLIST_MODE = 'sequential'
+
+    # 'forkserver' starts workers from a template process with the heavy
+    # modules already imported; 'fork' and 'spawn' are also allowed
+    try:
+        START_METHOD = os.environ['START_METHOD']
+    except KeyError:
+        START_METHOD = 'forkserver'
+
+    # 'broker' multiplexes all workers' database traffic over a few shared
+    # connections; 'direct' gives each worker its own connection
+    try:
+        DB_MODE = os.environ['DB_MODE']
+    except KeyError:
+        DB_MODE = 'broker'
+
+    try:
+        BROKER_CONNECTIONS = int(os.environ['BROKER_CONNECTIONS'])
+    except KeyError:
+        BROKER_CONNECTIONS = 2
+
+    try:
+        BROKER_FLUSH_INTERVAL = int(os.environ['BROKER_FLUSH_INTERVAL'])
+    except KeyError:
+        BROKER_FLUSH_INTERVAL = 5
+
+    # Workers exiting sooner than MIN_UPTIME seconds after starting count as
+    # crashes; repeated crashes delay the slot's restart up to BACKOFF_MAX
+    try:
+        MIN_UPTIME = int(os.environ['MIN_UPTIME'])
+    except KeyError:
+        MIN_UPTIME = 60
+
+    try:
+        BACKOFF_MAX = int(os.environ['BACKOFF_MAX'])
+    except KeyError:
+        BACKOFF_MAX = 300
+
+    # Bitrate-aware placement across nodes: NODE_MAX_KBPS is the bandwidth
+    # this node advertises (default N_TASKS * DEFAULT_KBPS), DEFAULT_KBPS the
+    # assumed cost of a station we haven't measured, and HYSTERESIS the
+    # fraction over its fair share a node may run before shedding stations
+    try:
+        PLACEMENT = int(os.environ['PLACEMENT'])
+    except KeyError:
+        PLACEMENT = 1
+
+    try:
+        NODE_MAX_KBPS = float(os.environ['NODE_MAX_KBPS'])
+    except KeyError:
+        NODE_MAX_KBPS = None
+
+    try:
+        DEFAULT_KBPS = float(os.environ['DEFAULT_KBPS'])
+    except KeyError:
+        DEFAULT_KBPS = 128
+
+    try:
+        HYSTERESIS = float(os.environ['HYSTERESIS'])
+    except KeyError:
+        HYSTERESIS = 0.2
+
+    try:
+        MIN_RESIDENCY = int(os.environ['MIN_RESIDENCY'])
+    except KeyError:
+        MIN_RESIDENCY = 1800
+
+    # How many months ahead to create app.chunks partitions, and how many
+    # days to keep before archiving them (by default, keep everything)
+    try:
+        PARTITION_MONTHS_AHEAD = int(os.environ['PARTITION_MONTHS_AHEAD'])
+    except KeyError:
+        PARTITION_MONTHS_AHEAD = 2
+
+    try:
+        PARTITION_RETENTION_DAYS = int(os.environ['PARTITION_RETENTION_DAYS'])
+    except KeyError:
+        PARTITION_RETENTION_DAYS = None
+
+    try:
+        HEARTBEAT_INTERVAL = int(os.environ['HEARTBEAT_INTERVAL'])
+    except KeyError:
+        HEARTBEAT_INTERVAL = 60
+
     args = {
         's3_bucket': S3_BUCKET,
         's3_prefix': S3_PREFIX,
@@ -95,8 +223,30 @@ if __name__ == '__main__':
         'chunk_error_behavior': CHUNK_ERROR_BEHAVIOR,
         'poll_interval': POLL_INTERVAL,
         'chunk_size': CHUNK_SIZE,
+        'chunk_duration': CHUNK_DURATION,
+        'min_chunk_size': MIN_CHUNK_SIZE,
+        'max_chunk_size': MAX_CHUNK_SIZE,
         'chunk_error_threshold': CHUNK_ERROR_THRESHOLD,
         'create_schema': CREATE_SCHEMA,
+        'variant_policy': VARIANT_POLICY,
+        'variant_codec': VARIANT_CODEC,
+        'variant_bitrate': VARIANT_BITRATE,
+        'playlist_mode': PLAYLIST_MODE,
+        'start_method': START_METHOD,
+        'db_mode': DB_MODE,
+        'broker_connections': BROKER_CONNECTIONS,
+        'broker_flush_interval': BROKER_FLUSH_INTERVAL,
+        'min_uptime': MIN_UPTIME,
+        'backoff_max': BACKOFF_MAX,
+        'placement': PLACEMENT,
+        'node_max_kbps': NODE_MAX_KBPS,
+        'default_kbps': DEFAULT_KBPS,
+        'hysteresis': HYSTERESIS,
+        'min_residency': MIN_RESIDENCY,
+        'partition_months_ahead': PARTITION_MONTHS_AHEAD,
+        'partition_retention_days': PARTITION_RETENTION_DAYS,
+        'heartbeat_interval': HEARTBEAT_INTERVAL,
+        'log_config': LOG_CONFIG,
         'db_setup': {
             'data_source_s3_bucket': DATA_SOURCE_S3_BUCKET,
             'data_source_s3_key': DATA_SOURCE_S3_KEY
@@ -57,92 +57,323 @@ create table app.jobs
 
   create_dt timestamptz not null default now(),
   error_count integer not null default 0,
-  last_error text
+  last_error text,
+
+  -- observed bitrate, used as the station's cost when placing it on a node
+  est_kbps real,
+
+  -- size in bytes the worker currently aims for in this station's chunks,
+  -- derived from est_kbps and the target chunk duration
+  chunk_bytes integer
 );
 
+-- Ingest nodes (one per RadioPool) and the capacity they advertise, so that
+-- they can each claim a fair share of the total load
+drop table if exists app.nodes cascade;
+create table app.nodes
+(
+    node_id text not null primary key,
+
+    max_kbps real not null,
+    max_slots integer not null,
+    cpu_count integer,
+
+    load_kbps real not null default 0,
+    running integer not null default 0,
+
+    heartbeat_dt timestamptz not null default now()
+);
+
+-- What each running worker is doing, kept up to date by periodic
+-- heartbeats. Cheaper for monitoring to read than pg_locks, and rows whose
+-- heartbeat is old are ignored, so crashed workers drop out on their own.
+drop table if exists app.worker_status cascade;
+create table app.worker_status
+(
+    station_id integer not null primary key,
+
+    node_id text,
+    pid integer,
+
+    claim_dt timestamptz not null default now(),
+    heartbeat_dt timestamptz not null default now(),
+
+    -- how often, in seconds, the worker means to heartbeat
+    heartbeat_interval integer not null default 60,
+
+    -- since the worker claimed the station
+    chunk_count bigint not null default 0,
+    error_count integer not null default 0
+);
+
+-- Chunks and errors per station per hour, maintained incrementally by
+-- app.refresh_station_hourly() for chunks and as errors are logged for
+-- errors
+drop table if exists app.station_hourly cascade;
+create table app.station_hourly
+(
+    station_id integer not null,
+    hour_dt timestamptz not null,
+
+    chunk_count integer not null default 0,
+    error_count integer not null default 0,
+
+    primary key (station_id, hour_dt)
+);
+
+-- how far app.refresh_station_hourly() has got through app.chunks
+drop table if exists app.rollup_state cascade;
+create table app.rollup_state
+(
+    name text not null primary key,
+    watermark_dt timestamptz not null
+);
+
+-- Partitioned by month on create_dt, so that finding a station's chunks
+-- for some time range only touches the partitions covering it, and old
+-- months can be detached without a big delete
 drop table if exists app.chunks cascade;
 create table app.chunks
 (
-    chunk_id bigserial not null primary key,
+    chunk_id bigserial not null,
 
     station_id integer not null
                references data.station
                on delete restrict,
 
     create_dt timestamptz not null default now(),
-    s3_url text not null
-);
+    s3_url text not null,
+
+    -- what's in the chunk, computed by the worker as it captured it
+    byte_length bigint,
+    start_dt timestamptz,
+    end_dt timestamptz,
+    codec text,
+    kbps real,
+    sha256 text,
+    stream_seq integer,
+
+    primary key (chunk_id, create_dt)
+) partition by range (create_dt);
+
+create index chunks_create_dt_brin
+on app.chunks
+    using brin (create_dt);
+
+create index chunks_station_id_create_dt
+on app.chunks
+    (station_id, create_dt);
+
+-- catches anything outside the monthly partitions, e.g. if maintenance
+-- falls behind
+create table app.chunks_default
+partition of app.chunks default;
+
+-- where detached partitions go; not dropped on re-setup
+create schema if not exists archive;
+
+-- Create the partition of app.chunks holding the month that month_dt falls
+-- in, if there isn't one yet. Rows for that month which already went to
+-- the default partition are moved into the new one so that it can attach.
+create or replace function app.create_chunk_partition(month_dt timestamptz)
+returns text
+language plpgsql
+as $$
+declare
+    lo timestamptz := date_trunc('month', month_dt);
+    hi timestamptz := date_trunc('month', month_dt) + interval '1 month';
+    part text := 'chunks_p' || to_char(date_trunc('month', month_dt), 'YYYYMM');
+begin
+    if to_regclass('app.' || part) is not null then
+        return part;
+    end if;
+
+    execute format('create table app.%I (like app.chunks including defaults)',
+                   part);
+
+    execute format('
+        with moved as
+        (
+            delete from app.chunks_default
+            where
+                create_dt >= %L and
+                create_dt < %L
+            returning *
+        )
+        insert into app.%I
+        select
+            *
+        from moved
+    ', lo, hi, part);
+
+    execute format('alter table app.chunks attach partition app.%I
+                    for values from (%L) to (%L)', part, lo, hi);
+
+    return part;
+end;
+$$;
+
+-- Make sure partitions exist for this month and the next months_ahead, and
+-- if retention is given, detach partitions entirely older than that and
+-- move them to the archive schema. The pool calls this periodically; only
+-- one caller at a time does anything.
+create or replace function app.maintain_chunk_partitions
+(
+    months_ahead integer default 2,
+    retention interval default null
+)
+returns void
+language plpgsql
+as $$
+declare
+    stale record;
+begin
+    -- two-argument form so as not to collide with locks on station_id
+    if not pg_try_advisory_xact_lock(0, 1) then
+        return;
+    end if;
+
+    for i in 0..months_ahead loop
+        perform app.create_chunk_partition(now() + i * interval '1 month');
+    end loop;
+
+    if retention is null then
+        return;
+    end if;
+
+    for stale in
+        select
+            c.relname
+        from pg_inherits inh
+            inner join pg_class c on c.oid = inh.inhrelid
+        where
+            inh.inhparent = 'app.chunks'::regclass and
+            c.relname ~ '^chunks_p[0-9]+$' and
+            to_date(substr(c.relname, 9), 'YYYYMM') + interval '1 month'
+                <= now() - retention
+    loop
+        execute format('alter table app.chunks detach partition app.%I',
+                       stale.relname);
+        execute format('alter table app.%I set schema archive', stale.relname);
+    end loop;
+end;
+$$;
+
+select app.maintain_chunk_partitions();
+
+-- Fold chunks created since the last call into app.station_hourly. Only
+-- chunks at least a minute old are counted, so that ones in transactions
+-- still open when we run aren't skipped over.
+create or replace function app.refresh_station_hourly()
+returns void
+language plpgsql
+as $$
+declare
+    lo timestamptz;
+    hi timestamptz := now() - interval '1 minute';
+begin
+    if not pg_try_advisory_xact_lock(0, 2) then
+        return;
+    end if;
+
+    select
+        watermark_dt
+    into lo
+    from app.rollup_state
+    where
+        name = 'station_hourly';
+
+    if lo is null then
+        select
+            coalesce(min(create_dt), hi)
+        into lo
+        from app.chunks;
+    end if;
+
+    if lo >= hi then
+        return;
+    end if;
+
+    insert into app.station_hourly
+        (station_id, hour_dt, chunk_count)
+    select
+        station_id,
+        date_trunc('hour', create_dt),
+        count(*)
+    from app.chunks
+    where
+        create_dt >= lo and
+        create_dt < hi
+    group by 1, 2
+    on conflict (station_id, hour_dt) do update
+    set
+        chunk_count = app.station_hourly.chunk_count + excluded.chunk_count;
+
+    insert into app.rollup_state
+        (name, watermark_dt)
+    values
+        ('station_hourly', hi)
+    on conflict (name) do update
+    set
+        watermark_dt = excluded.watermark_dt;
+end;
+$$;
+
+
+-- Workers that have checked in recently, allowing each a few of its own
+-- heartbeat intervals
+create or replace view app.live_workers as
+select
+    *
+from app.worker_status
+where
+    heartbeat_dt > now() - 3 * heartbeat_interval * interval '1 second';
 
 -- Overall job status report
 create or replace view app.stats as
 select
     count(*) as cnt,
-    count(l.station_id) as count_working,
+    count(w.station_id) as count_working,
     sum((j.error_count > 0)::int) as count_failed,
     max(j.error_count) as highest_error_count,
     min(j.create_dt) as oldest_create_dt
 from app.jobs j
-    left join
-    (
-        select
-            objid as station_id
-        from pg_locks pli
-        where
-            pli.locktype = 'advisory' and
-            pli.classid = 0 and
-            pli."mode" = 'ExclusiveLock'
-    ) l using (station_id);
+    left join app.live_workers w using(station_id);
 
 -- Streams that are currently running correctly
 create or replace view app.running as
 select
     j.station_id
 from app.jobs j
-    inner join
-    (
-        select
-            pli.objid as station_id
-        from pg_locks pli
-        where
-            pli.locktype = 'advisory' and
-            pli.classid = 0 and
-            pli."mode" = 'ExclusiveLock'
-    ) pl using(station_id);
+    inner join app.live_workers w using(station_id);
 
 -- Streams in the queue that aren't currently running
 create or replace view app.waiting as
 select
     j.station_id
 from app.jobs j
-    left join
-    (
-        select
-            pli.objid as station_id
-        from pg_locks pli
-        where
-            pli.locktype = 'advisory' and
-            pli.classid = 0 and
-            pli."mode" = 'ExclusiveLock'
-    ) pl using(station_id)
+    left join app.live_workers w using(station_id)
 where
-    pl.station_id is null;
+    w.station_id is null;
 
 -- Streams that have ever failed and whether they're currently running
 create or replace view app.failed as
 select
     j.station_id,
-    (pl.station_id is not null) as running
+    (w.station_id is not null) as running
 from app.jobs j
-    left join
-    (
-        select
-            pli.objid as station_id
-        from pg_locks pli
-        where
-            pli.locktype = 'advisory' and
-            pli.classid = 0 and
-            pli."mode" = 'ExclusiveLock'
-    ) pl using(station_id)
+    left join app.live_workers w using(station_id)
 where
     j.error_count > 0;
 
+-- Per-station throughput and error rates over the last day, from the rollup
+create or replace view app.station_rates as
+select
+    station_id,
+    sum(chunk_count) / 24.0 as chunks_per_hour,
+    sum(error_count) / 24.0 as errors_per_hour,
+    max(hour_dt) filter (where chunk_count > 0) as last_chunk_hour_dt
+from app.station_hourly
+where
+    hour_dt > now() - interval '24 hours'
+group by 1;
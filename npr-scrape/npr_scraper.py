@@ -1,30 +1,80 @@
 #!/usr/bin/env python
 
 import os
-import re
-import time
-import random
-import shutil
 import logging
 import urlparse
 import datetime
-import sqlite3 as sq
-from StringIO import StringIO
+import threading
+from multiprocessing.pool import ThreadPool
 
 import us
-import boto3
 import requests as rq
 
 from dateutil import parser as dtp
 from bs4 import BeautifulSoup
 
+from throttle import HostThrottle
+from http_cache import HttpCache
+from download import Downloader
+from s3_sync import S3Sync
+from strain import strainer
+from search import TranscriptIndex
+from export import ShardExporter
+import storage
+
 logger = logging.getLogger(__name__)
 
+# How long cached pages stay fresh, in seconds (None = forever): archive
+# index pages get new episodes added, but episode, segment and transcript
+# pages don't change once they're up
+CACHE_RULES = [
+    (r'npr\.org/programs/[^/]+/archive', 3600),
+    (r'npr\.org/', None)
+]
+
+# The only parts of each kind of page we read; see strain.py
+ARCHIVE_PAGE = strainer(('article', 'class', 'program-show'),
+                        ('div', 'id', 'scrolllink'))
+
+SEGMENT_PAGE = strainer(('div', 'class', 'transcript'),
+                        ('li', 'class', 'audio-tool-transcript'),
+                        ('li', 'class', 'audio-tool-download'),
+                        ('time', 'class', 'audio-module-duration'))
+
+TRANSCRIPT_PAGE = strainer(('div', 'class', 'transcript'))
+
 class NPRScraper(object):
     def __init__(self, dbpath, audio_dir='.', initdb=False, min_cutoff_dt='2010-01-01',
-                 max_cutoff_dt=None):
+                 max_cutoff_dt=None, rate=0.5, burst=1, page_jobs=4,
+                 transcript_jobs=2, audio_jobs=4, cache_dir=None,
+                 range_jobs=4, part_size=8 * 2**20):
         self.audio_dir = audio_dir
 
+        # pages are fetched through an on-disk cache if given a directory
+        if cache_dir is not None:
+            self.cache = HttpCache(cache_dir, rules=CACHE_RULES, default_ttl=86400)
+        else:
+            self.cache = None
+
+        # At most rate requests per second to any one host, and at most
+        # this many of each kind of download in flight at once when
+        # scraping segments concurrently
+        self.throttle = HostThrottle(rate, burst)
+        self.slots = {
+            'page': threading.BoundedSemaphore(page_jobs),
+            'transcript': threading.BoundedSemaphore(transcript_jobs),
+            'audio': threading.BoundedSemaphore(audio_jobs)
+        }
+        self.jobs = page_jobs + transcript_jobs + audio_jobs
+
+        # requests sessions aren't safe to share between threads
+        self._local = threading.local()
+
+        # Audio files are downloaded in part_size pieces, range_jobs of them
+        # at a time, and resumed from the last whole piece if interrupted
+        self.downloader = Downloader(part_size=part_size, jobs=range_jobs,
+                                     get=self._get_audio)
+
         self.min_cutoff_dt = dtp.parse(min_cutoff_dt).date()
         
         if max_cutoff_dt is None:
@@ -36,14 +86,62 @@ class NPRScraper(object):
             raise ValueError("In-memory sqlite databases are not allowed")
         else:
             self.dbpath = dbpath
-            self.db = sq.connect(dbpath)
+            self.db = storage.connect(dbpath)
 
             if initdb:
                 # This is a separate method so that you can call it again
                 # to refresh the object state
                 self.initdb()
             else:
-                pass
+                self.upgradedb()
+
+    def upgradedb(self):
+        # Bring databases made by older versions up to date with initdb,
+        # without losing anything in them. A new, empty database has to be
+        # set up by initdb first
+        if len(storage.columns(self.db, 'program_show_segment')) == 0:
+            msg = "%s has no scraper tables; run initdb first"
+            raise ValueError(msg % (self.dbpath,))
+
+        self.db.executescript(self.crawl_state_ddl)
+
+        storage.add_columns(self.db, 'program_show_segment', [
+            ('audio_bytes', 'integer'),
+            ('audio_sha256', 'text')
+        ])
+
+        self.db.executescript(self.index_ddl)
+
+        self.codec = storage.Codec(self.db)
+
+        self.transcripts = TranscriptIndex(self.db)
+        self.transcripts.create()
+
+    # For looking up a program's shows by date and its segments by status
+    index_ddl = '''
+    create index if not exists program_show_program_id_show_date_idx
+        on program_show (program_id, show_date);
+
+    create index if not exists program_show_segment_status_idx
+        on program_show_segment (program_show_id, processed, successful);
+    '''
+
+    # How far back each program's archive has been crawled; see
+    # scrape_program
+    crawl_state_ddl = '''
+    create table if not exists crawl_state
+    (
+        program_id integer primary key,
+
+        newest_show_date text,
+        oldest_show_date text,
+
+        crawl_dt text,
+        deep_crawl_dt text,
+
+        foreign key(program_id) references program(program_id)
+    );
+    '''
 
     def initdb(self):
         cur = self.db.cursor()
@@ -52,7 +150,7 @@ class NPRScraper(object):
         drop table if exists program;
         create table program
         (
-            program_id integer primary key,
+            program_id integer primary key autoincrement,
 
             name text not null,
 
@@ -62,7 +160,7 @@ class NPRScraper(object):
         drop table if exists program_show;
         create table program_show
         (
-            program_show_id integer primary key,
+            program_show_id integer primary key autoincrement,
 
             show_date text not null,
             npr_id text not null,
@@ -78,7 +176,7 @@ class NPRScraper(object):
         drop table if exists program_show_segment;
         create table program_show_segment
         (
-            program_show_segment_id integer primary key,
+            program_show_segment_id integer primary key autoincrement,
 
             processed integer not null default 0,
             successful integer not null default 0,
@@ -86,7 +184,9 @@ class NPRScraper(object):
             
             audio_length_in_seconds integer,
             audio_path text,
-            transcript text,
+            audio_bytes integer,
+            audio_sha256 text,
+            transcript blob,
             
             program_show_id integer not null,
             foreign key(program_show_id) references program_show(program_show_id),
@@ -95,53 +195,205 @@ class NPRScraper(object):
             check(processed in (0, 1)),
             check(successful in (0, 1))
         );
+
+        drop table if exists crawl_state;
+        ''' + self.crawl_state_ddl + '''
+
+        drop table if exists upload_manifest;
+        ''' + S3Sync.manifest_ddl + self.index_ddl + '''
+
+        drop table if exists compression_dict;
+        drop table if exists transcript_fts;
         ''')
 
-    def programs(self):
+        self.codec = storage.Codec(self.db)
+
+        self.transcripts = TranscriptIndex(self.db)
+        self.transcripts.create()
+
+    # Big text columns, stored compressed; see storage.Codec
+    compressed_columns = [
+        ('program_show_segment', 'program_show_segment_id', 'transcript')
+    ]
+
+    def compress(self, train=False, vacuum=True):
+        '''
+        Compress values stored before compression was added, optionally
+        training a zstd dictionary on them first, and then give the space
+        back to the filesystem
+        '''
+        if train:
+            samples = []
+            for table, key, column in self.compressed_columns:
+                samples += storage.sample_column(self.db, self.codec, table, column)
+
+            self.codec.train(samples)
+
+        for table, key, column in self.compressed_columns:
+            storage.compress_column(self.db, self.codec, table, key, column)
+
+        if vacuum:
+            self.db.execute('vacuum;')
+
+            # with WAL, the file only shrinks once that's checkpointed
+            self.db.execute('pragma wal_checkpoint(truncate);')
+
+    def index_transcripts(self, rebuild=False):
+        '''
+        Add transcripts not yet in the search index to it, or rebuild it
+        from scratch. Only needed once for databases made before there was
+        an index; saving a segment keeps it up to date after that.
+        '''
+        return self.transcripts.build(self.codec, 'program_show_segment',
+                                      'program_show_segment_id', 'transcript',
+                                      rebuild=rebuild)
+
+    def search(self, query, program=None, min_dt=None, max_dt=None, limit=20):
+        '''
+        Segments whose transcripts match query, an FTS5 query string (words,
+        "quoted phrases", AND/OR/NOT, NEAR(...), prefix*), best matches
+        first. Returns a list of dicts of the segment's id, program, show
+        date, url, audio path and a snippet of the transcript around the
+        matches. Can be limited to one program and shows between two dates.
+        '''
         cur = self.db.cursor()
+        filters, params = self._segment_filters(program, min_dt, max_dt)
 
         cur.execute('''
         select
-            name
-        from program;
-        ''')
+            pss.program_show_segment_id,
+            p.name,
+            ps.show_date,
+            pss.url,
+            pss.audio_path,
+            %s
+        from transcript_fts
+            inner join program_show_segment pss
+                on pss.program_show_segment_id = transcript_fts.rowid
+            inner join program_show ps using(program_show_id)
+            inner join program p using(program_id)
+        where
+            transcript_fts match ?
+            %s
+        order by transcript_fts.rank
+        limit ?;
+        ''' % (self.transcripts.snippet(), filters),
+        [query] + params + [limit])
+
+        cols = ('program_show_segment_id', 'program', 'show_date', 'url',
+                'audio_path', 'snippet')
+
+        return [dict(zip(cols, x)) for x in cur.fetchall()]
+
+    def _segment_filters(self, program=None, min_dt=None, max_dt=None):
+        # SQL conditions, each starting with 'and', on the program (p) and
+        # show (ps) of segments, and their parameters
+        filters, params = [], []
+
+        if program is not None:
+            filters += ['p.name = ?']
+            params += [program]
+        if min_dt is not None:
+            filters += ['ps.show_date >= ?']
+            params += [str(dtp.parse(min_dt).date())]
+        if max_dt is not None:
+            filters += ['ps.show_date <= ?']
+            params += [str(dtp.parse(max_dt).date())]
+
+        return ''.join(' and ' + x for x in filters), params
+
+    def export(self, out_dir, program=None, min_dt=None, max_dt=None,
+               shard_size=2**30, jobs=4, fmt=None):
+        '''
+        Export successfully scraped segments, optionally only those of one
+        program and shows between two dates, as shards of audio and
+        metadata in out_dir; see export.py. Resumes an interrupted export
+        to the same directory with the same arguments. Returns the
+        manifest.
+        '''
+        cur = self.db.cursor()
+        filters, params = self._segment_filters(program, min_dt, max_dt)
 
-        return map(lambda x: x[0], cur.fetchall())
+        cur.execute('''
+        select
+            pss.program_show_segment_id,
+            pss.audio_path
+        from program_show_segment pss
+            inner join program_show ps using(program_show_id)
+            inner join program p using(program_id)
+        where
+            pss.processed = 1 and
+            pss.successful = 1
+            %s
+        order by ps.show_date, pss.program_show_segment_id;
+        ''' % (filters,), params)
+        items = cur.fetchall()
+
+        exporter = ShardExporter(out_dir, 'program_show_segment_id',
+                                 shard_size=shard_size, jobs=jobs, fmt=fmt,
+                                 params={'program': program, 'min_dt': min_dt,
+                                         'max_dt': max_dt})
 
-    def max_id_for_table(self, table):
+        return exporter.run(items, self._export_rows)
+
+    def _export_rows(self, program_show_segment_ids):
         cur = self.db.cursor()
-        
+
         cur.execute('''
         select
-            max({0}_id)
-        from {0};
-        '''.format(table))
-        
-        max_id = cur.fetchone()[0]
-        if max_id is None:
-            max_id = 0
+            pss.program_show_segment_id,
+            p.name,
+            ps.show_date,
+            ps.npr_id,
+            pss.url,
+            pss.audio_length_in_seconds,
+            pss.audio_bytes,
+            pss.audio_sha256,
+            pss.transcript
+        from program_show_segment pss
+            inner join program_show ps using(program_show_id)
+            inner join program p using(program_id)
+        where
+            pss.program_show_segment_id in (%s);
+        ''' % (','.join(['?'] * len(program_show_segment_ids)),),
+        program_show_segment_ids)
+
+        cols = ('program_show_segment_id', 'program', 'show_date', 'npr_id',
+                'url', 'audio_length_in_seconds', 'audio_bytes',
+                'audio_sha256', 'transcript')
+
+        rows = [dict(zip(cols, x)) for x in cur.fetchall()]
+        for row in rows:
+            row['transcript'] = self.codec.decompress(row['transcript'])
+
+        return rows
+
+    def programs(self):
+        cur = self.db.cursor()
 
-        return max_id
+        cur.execute('''
+        select
+            name
+        from program;
+        ''')
+
+        return map(lambda x: x[0], cur.fetchall())
 
     def add_programs(self, programs, duplicates='pass'):
         cur = self.db.cursor()
-        
-        max_id = self.max_id_for_table('program')
 
-        vals = map(lambda x: (max_id + x[0], x[1]), enumerate(programs))
-        
-        try:
+        # ids come from sqlite; existing programs are skipped unless we've
+        # been asked to fail on them
+        verb = 'insert' if duplicates == 'fail' else 'insert or ignore'
+        vals = map(lambda x: (x,), programs)
+
+        with self.db:
             cur.executemany('''
-            insert into program
-                (program_id, name)
+            %s into program
+                (name)
             values
-                (?, ?);
-            ''', vals)
-        except sq.IntegrityError:
-            if duplicates == 'fail':
-                raise
-            else:
-                pass
+                (?);
+            ''' % (verb,), vals)
 
     def has_program(self, program):
         cur = self.db.cursor()
@@ -257,7 +509,82 @@ class NPRScraper(object):
         res = cur.fetchall()
         return map(lambda x: x[0], res)
 
-    def scrape_program(self, program, mean_wait_time=2):
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = rq.Session()
+
+        return self._local.session
+
+    def _get(self, kind, url, **kwargs):
+        def fetch(headers):
+            # only requests that actually go out count against the limits
+            with self.slots[kind]:
+                self.throttle.wait(url)
+                return self._session().get(url, headers=headers, **kwargs)
+
+        if self.cache is None:
+            return fetch({})
+        else:
+            return self.cache.get(url, fetch)
+
+    def _get_audio(self, url, headers):
+        # for the downloader, which may call this from several threads for
+        # one file; each request waits its turn with the host
+        self.throttle.wait(url)
+        return self._session().get(url, headers=headers, stream=True,
+                                   timeout=(10, 60))
+
+    def crawl_state(self, program_id):
+        cur = self.db.cursor()
+
+        cur.execute('''
+        select
+            newest_show_date,
+            oldest_show_date,
+            crawl_dt,
+            deep_crawl_dt
+        from crawl_state
+        where
+            program_id = ?;
+        ''', (program_id,))
+
+        res = cur.fetchone()
+        if res is None:
+            res = (None, None, None, None)
+
+        cols = ('newest_show_date', 'oldest_show_date', 'crawl_dt', 'deep_crawl_dt')
+        return dict(zip(cols, res))
+
+    def _known_npr_ids(self, npr_ids):
+        cur = self.db.cursor()
+
+        cur.execute('''
+        select
+            npr_id
+        from program_show
+        where
+            npr_id in (%s);
+        ''' % (','.join(['?'] * len(npr_ids)),), npr_ids)
+
+        return set(map(lambda x: x[0], cur.fetchall()))
+
+    def _needs_deep_crawl(self, state, deep_every):
+        if deep_every is None:
+            return False
+        if state['deep_crawl_dt'] is None:
+            return True
+
+        last = dtp.parse(state['deep_crawl_dt']).date()
+        return (datetime.date.today() - last).days >= deep_every
+
+    def scrape_program(self, program, incremental=False, deep=False,
+                       deep_every=None):
+        # With incremental, stop following pagination at the first page
+        # whose episodes are all ones we already have - but only once a
+        # crawl has been all the way back to min_cutoff_dt, so that an
+        # interrupted first crawl gets finished. A deep crawl (asked for
+        # with deep, or due every deep_every days) goes all the way back
+        # regardless, to pick up anything missed.
         cur = self.db.cursor()
         
         if not self.has_program(program):
@@ -265,6 +592,19 @@ class NPRScraper(object):
         else:
             program_id = self._program_id(program)
 
+        state = self.crawl_state(program_id)
+
+        covered = state['oldest_show_date'] is not None and \
+                  state['oldest_show_date'] <= self.min_cutoff_dt.isoformat()
+
+        deep = deep or self._needs_deep_crawl(state, deep_every)
+        can_stop = incremental and covered and not deep
+
+        if deep:
+            logger.info('Deep crawl of %s' % (program,))
+
+        newest_dt, stopped = None, False
+
         # Initially, we fetch a url of this form; later, we follow
         # the provided pagination links
         init_pattern = 'https://www.npr.org/programs/{0}/archive?date={1}'
@@ -273,70 +613,120 @@ class NPRScraper(object):
         min_observed_dt = self.max_cutoff_dt
         
         while min_observed_dt >= self.min_cutoff_dt:
-            time.sleep(random.uniform(0, 2*mean_wait_time))
-
-            resp = rq.get(url)
-            soup = BeautifulSoup(resp.text, 'lxml')
+            resp = self._get('page', url)
+            soup = BeautifulSoup(resp.text, 'lxml', parse_only=ARCHIVE_PAGE)
             logger.debug('Fetched and rendered ' + url)
 
             articles = soup.find_all('article', class_='program-show')
 
+            # Parse the whole page first, then load it in one transaction
+            shows, segments, page_ids = [], [], []
+
             for a in articles:
-                # load the program_show row
-                header = a.find('h2', class_='program-show__title')
+                try:
+                    header = a.find('h2', class_='program-show__title')
 
-                ps_id = self.max_id_for_table('program_show') + 1
-                episode_date = dtp.parse(a['data-episode-date']).date()
-                episode_id = a['data-episode-id']
-                episode_url = header.a['href']
-                
-                if episode_date < min_observed_dt:
-                    min_observed_dt = episode_date
+                    episode_date = dtp.parse(a['data-episode-date']).date()
+                    episode_id = a['data-episode-id']
+                    episode_url = header.a['href']
 
-                if self.has_program_show(episode_id):
-                    continue
-                if episode_date < self.min_cutoff_dt:
-                    continue
+                    page_ids += [episode_id]
 
-                vals = (ps_id, episode_date.isoformat(), episode_id,
-                        episode_url, program_id)
+                    if episode_date < min_observed_dt:
+                        min_observed_dt = episode_date
+                    if newest_dt is None or episode_date > newest_dt:
+                        newest_dt = episode_date
 
-                try:
-                    cur.execute('''
-                    insert into program_show
-                        (program_show_id, show_date, npr_id, url, program_id)
-                    values
-                        (?, ?, ?, ?, ?);
-                    ''', vals)
+                    if episode_date < self.min_cutoff_dt:
+                        continue
 
-                    # load info for each segment
                     segments_list = a.find('section', class_='program-show__segments')
-                    segments = segments_list.find_all('article', class_='program-segment')
-                    for s in segments:
-                        pss_id = self.max_id_for_table('program_show_segment') + 1
-                        
-                        header = s.find_all('h3', class_='program-segment__title')[0]
-                        vals = (pss_id, header.a['href'], ps_id)
-
-                        cur.execute('''
-                        insert into program_show_segment
-                            (program_show_segment_id, url, program_show_id)
-                        values
-                            (?, ?, ?);
-                        ''', vals)
+                    segs = segments_list.find_all('article', class_='program-segment')
+                    seg_urls = [
+                        s.find_all('h3', class_='program-segment__title')[0].a['href']
+                        for s in segs
+                    ]
                 except:
-                    self.db.rollback()
-                else:
-                    self.db.commit()
+                    logger.exception('Failed to parse article on ' + url)
+                    continue
+
+                shows += [(episode_date.isoformat(), episode_id, episode_url,
+                           program_id)]
+                segments += [(episode_id, x) for x in seg_urls]
+
+                logger.debug('Parsed article %s from %s with %s segments' % (episode_id, episode_date, len(seg_urls)))
+
+            known = self._known_npr_ids(page_ids) if len(page_ids) > 0 else set()
+
+            # Shows and segments we already have are skipped by the unique
+            # constraints rather than by checking for each one
+            try:
+                with self.db:
+                    cur.executemany('''
+                    insert or ignore into program_show
+                        (show_date, npr_id, url, program_id)
+                    values
+                        (?, ?, ?, ?);
+                    ''', shows)
+
+                    cur.executemany('''
+                    insert or ignore into program_show_segment
+                        (url, program_show_id)
+                    select
+                        ?,
+                        program_show_id
+                    from program_show
+                    where
+                        npr_id = ?;
+                    ''', map(lambda x: (x[1], x[0]), segments))
+            except:
+                logger.exception('Failed to load articles from ' + url)
+            else:
+                logger.info('Loaded %s articles with %s segments from %s' % (len(shows), len(segments), url))
 
-                logger.info('Loaded article %s from %s with %s segments' % (episode_id, episode_date, len(segments)))
+            if can_stop and len(page_ids) > 0 and len(known) == len(set(page_ids)):
+                logger.info('Caught up with %s at %s' % (program, min_observed_dt))
+                stopped = True
+                break
+
+            # Finally, get the infinite scroll link and follow it; the last
+            # page of the archive has none
+            try:
+                link = soup.find('div', id='scrolllink').a['href']
+            except (AttributeError, KeyError, TypeError):
+                logger.info('Reached the end of %s at %s' % (program, min_observed_dt))
+                break
 
-            # Finally, get the infinite scroll link and follow it
-            link = soup.find('div', id='scrolllink').a['href']
             url = urlparse.urljoin('https://www.npr.org', link)
+
+        self._save_crawl_state(program_id, state, newest_dt, stopped, deep)
         
         return
 
+    def _save_crawl_state(self, program_id, state, newest_dt, stopped, deep):
+        now = datetime.datetime.now().isoformat()
+
+        newest = state['newest_show_date']
+        if newest_dt is not None and (newest is None or newest_dt.isoformat() > newest):
+            newest = newest_dt.isoformat()
+
+        # if we got all the way back, everything since min_cutoff_dt is
+        # covered; if we stopped early, it's whatever it was before
+        oldest = state['oldest_show_date']
+        if not stopped and (oldest is None or self.min_cutoff_dt.isoformat() < oldest):
+            oldest = self.min_cutoff_dt.isoformat()
+
+        deep_dt = now if deep and not stopped else state['deep_crawl_dt']
+
+        with self.db:
+            self.db.execute('''
+            insert or replace into crawl_state
+                (program_id, newest_show_date, oldest_show_date, crawl_dt,
+                 deep_crawl_dt)
+            values
+                (?, ?, ?, ?, ?);
+            ''', (program_id, newest, oldest, now, deep_dt))
+
     @staticmethod
     def get_transcript_from_soup(soup):
         div = soup.findAll('div', class_='transcript')[0]
@@ -351,7 +741,7 @@ class NPRScraper(object):
         
         return ts
 
-    def scrape_program_show_segment(self, program_show_segment_id):
+    def _segment_url(self, program_show_segment_id):
         cur = self.db.cursor()
 
         # Get the url, or die if this segment doesn't exist
@@ -363,13 +753,17 @@ class NPRScraper(object):
             program_show_segment_id = ?;
         ''', (program_show_segment_id,))
         res = cur.fetchone()
-        if len(res) == 0:
+        if res is None:
             raise ValueError("No such program show segment: %s" % (program_show_segment_id,))
         else:
-            url = res[0]
-
-        resp = rq.get(url)
-        soup = BeautifulSoup(resp.text, "lxml")
+            return res[0]
+
+    def fetch_program_show_segment(self, program_show_segment_id, url):
+        # Does all the network work for a segment without touching the
+        # database, so that it can run in any thread; returns the values
+        # for save_program_show_segment
+        resp = self._get('page', url)
+        soup = BeautifulSoup(resp.text, "lxml", parse_only=SEGMENT_PAGE)
         logger.debug('Fetched and rendered ' + url)
 
         successful = 1 #set to 0 later if things go wrong
@@ -380,8 +774,8 @@ class NPRScraper(object):
         except: # didn't work, try to find a transcript link and handle it
             try:
                 ts_url = soup.find('li', class_='audio-tool-transcript').a['href']
-                ts_resp = rq.get(ts_url)
-                ts_soup = BeautifulSoup(ts_resp.text, "lxml")
+                ts_resp = self._get('transcript', ts_url)
+                ts_soup = BeautifulSoup(ts_resp.text, "lxml", parse_only=TRANSCRIPT_PAGE)
                 logger.debug('Fetched and rendered ' + ts_url)
 
                 ts = self.get_transcript_from_soup(ts_soup)
@@ -394,7 +788,7 @@ class NPRScraper(object):
         try:
             tm = soup.find_all('time', class_='audio-module-duration')[0].text
             (mins, secs) = tm.split(':')
-            audio_length = 60 * mins + secs
+            audio_length = 60 * int(mins) + int(secs)
         except:
             audio_length = None
 
@@ -407,15 +801,30 @@ class NPRScraper(object):
                 ext = 'unknown'
             audio_path = os.path.abspath(os.path.join(self.audio_dir, str(program_show_segment_id) + ext))
 
-            r = rq.get(audio_url, stream=True)
-            with open(audio_path, 'wb') as f:
-                shutil.copyfileobj(r.raw, f)
+            # hold the slot for the whole download, not just the request
+            with self.slots['audio']:
+                audio_bytes, audio_sha256 = self.downloader.download(audio_url, audio_path)
         except:
             audio_path = ''
+            audio_bytes, audio_sha256 = None, None
             successful = 0
             logger.exception('Failed to save audio file')
 
-        vals = (successful, audio_length, audio_path, ts, program_show_segment_id)
+        if successful == 1:
+            msg = "Successfully scraped program show segment at %s"
+        else:
+            msg = "Unsuccessfully scraped program show segment at %s"
+            
+        logger.info(msg % (url,))
+        return (successful, audio_length, audio_path, audio_bytes, audio_sha256,
+                ts, program_show_segment_id)
+
+    def save_program_show_segment(self, vals, commit=True):
+        cur = self.db.cursor()
+
+        # the transcript is stored compressed, and indexed for search
+        transcript = vals[5]
+        vals = vals[:5] + (self.codec.compress(transcript),) + vals[6:]
 
         try:
             cur.execute('''
@@ -426,31 +835,82 @@ class NPRScraper(object):
                 
                 audio_length_in_seconds = ?,
                 audio_path = ?,
+                audio_bytes = ?,
+                audio_sha256 = ?,
                 transcript = ?
             where
                 program_show_segment_id = ?;
             ''', vals)
+
+            self.transcripts.put(vals[6], transcript)
         except:
-            self.db.rollback()
+            # a failed update leaves nothing behind, so there's only
+            # something to roll back if we're committing as we go
+            if commit:
+                self.db.rollback()
         else:
-            self.db.commit()
+            if commit:
+                self.db.commit()
+
+    def scrape_program_show_segment(self, program_show_segment_id):
+        url = self._segment_url(program_show_segment_id)
+
+        vals = self.fetch_program_show_segment(program_show_segment_id, url)
+        self.save_program_show_segment(vals)
 
-        if successful == 1:
-            msg = "Successfully scraped program show segment at %s"
-        else:
-            msg = "Unsuccessfully scraped program show segment at %s"
-            
-        logger.info(msg % (url,))
         return
 
-    def scrape(self, how='all'):
+    def _fetch_one(self, args):
+        # for the thread pool: failures are logged and the segment left
+        # unprocessed for a later run, rather than stopping everything
+        try:
+            return self.fetch_program_show_segment(*args)
+        except:
+            logger.exception('Failed to scrape program show segment at %s' % (args[1],))
+            return None
+
+    def scrape_program_show_segments(self, program_show_segment_ids,
+                                     concurrent=False, commit_every=50):
+        if not concurrent:
+            with storage.Batch(self.db, every=commit_every) as batch:
+                for s in program_show_segment_ids:
+                    url = self._segment_url(s)
+                    vals = self.fetch_program_show_segment(s, url)
+
+                    self.save_program_show_segment(vals, commit=False)
+                    batch.tick()
+
+            return
+
+        # Worker threads do the fetching; this thread is the only one that
+        # writes to the database, as results come back
+        work = [(s, self._segment_url(s)) for s in program_show_segment_ids]
+        pool = ThreadPool(self.jobs)
+
+        try:
+            with storage.Batch(self.db, every=commit_every) as batch:
+                for vals in pool.imap_unordered(self._fetch_one, work):
+                    if vals is None:
+                        continue
+
+                    self.save_program_show_segment(vals, commit=False)
+                    batch.tick()
+        finally:
+            pool.close()
+            pool.join()
+
+        return
+
+    def scrape(self, how='all', concurrent=False, incremental=False,
+               deep=False, deep_every=None):
         valid = ('all', 'programs', 'unprocessed_segments', 'failed_segments')
         if how not in valid:
             raise ValueError("Invalid value %s for argument how" % (how,))
         
         for program in self.programs():
             if how in ('all', 'programs'):
-                self.scrape_program(program)
+                self.scrape_program(program, incremental=incremental,
+                                    deep=deep, deep_every=deep_every)
 
             if how in ('all', 'unprocessed_segments', 'failed_segments'):
                 args = {'program': program}
@@ -466,30 +926,34 @@ class NPRScraper(object):
                     args['successful'] = 0
 
                 segments = self.segments_for_program(**args)
-                for s in segments:
-                    self.scrape_program_show_segment(s)
+                self.scrape_program_show_segments(segments, concurrent=concurrent)
 
         return
 
-    # AWS credentials are assumed to be in the environment
-    def s3_upload(self, bucket, prefix=''):
+    # AWS credentials are assumed to be in the environment. Objects already
+    # uploaded unchanged are skipped; see S3Sync
+    def s3_upload(self, bucket, prefix='', jobs=8):
         cur = self.db.cursor()
 
+        # Get the audio files and transcripts - we'll defer processing the
+        # transcripts into a WER-friendly format until it's time to actually
+        # compute the error rates
         cur.execute('''
         select
-            program_show_segment_id
+            audio_path,
+            audio_sha256,
+            transcript
         from program_show_segment pss
         where
             processed = 1 and
             successful = 1;
         ''')
 
-        ids = map(lambda x: x[0], cur.fetchall())
-
-        for i in ids:
-            self.s3_upload_segment(i, bucket, prefix)
+        sync = S3Sync(self.db, bucket, prefix, jobs=jobs)
+        for audio_path, audio_sha256, transcript in cur.fetchall():
+            self._queue_segment_upload(sync, audio_path, audio_sha256, transcript)
 
-        return
+        return sync.run()
 
     def s3_upload_segment(self, program_show_segment_id, bucket, prefix=''):
         cur = self.db.cursor()
@@ -497,28 +961,20 @@ class NPRScraper(object):
         if not self.has_program_show_segment(program_show_segment_id):
             raise ValueError("Bad segment id " + str(program_show_segment_id))
 
-        # Get the audio file and transcript - we'll defer processing the
-        # transcript into a WER-friendly format until it's time to actually
-        # compute the error rates
         cur.execute('''
         select
             audio_path,
+            audio_sha256,
             transcript
         from program_show_segment
         where
             program_show_segment_id = ?;
         ''', (program_show_segment_id,))
-        res = cur.fetchone()
-        audio_path, transcript = res[0], res[1]
+        audio_path, audio_sha256, transcript = cur.fetchone()
 
-        # Upload to S3
-        bs = os.path.basename(audio_path)
-        audio_key = os.path.join(prefix, bs)
-        transcript_key = os.path.join(prefix, bs + '.transcript')
-        
-        s3 = boto3.client('s3')
-        s3.upload_file(audio_path, bucket, audio_key)
-        s3.upload_fileobj(StringIO(transcript.encode('utf-8')), bucket, transcript_key)
+        sync = S3Sync(self.db, bucket, prefix, jobs=1)
+        self._queue_segment_upload(sync, audio_path, audio_sha256, transcript)
+        sync.run()
 
         # Log it
         msg = 'Uploaded audio and transcript for segment %s to %s'
@@ -528,3 +984,10 @@ class NPRScraper(object):
 
         return
 
+    def _queue_segment_upload(self, sync, audio_path, audio_sha256, transcript):
+        bs = os.path.basename(audio_path)
+
+        sync.add_file(bs, audio_path, checksum=audio_sha256)
+        transcript = self.codec.decompress(transcript)
+        sync.add_data(bs + '.transcript', transcript.encode('utf-8'))
+
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import sys
 import logging
 import argparse
 
+# shared with the other scrapers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scrape-common'))
+
 from npr_scraper import NPRScraper
 
 logger = logging.getLogger(__name__)
@@ -17,9 +23,14 @@ def parse_args():
     initdb_parser = subparsers.add_parser('initdb')
     scrape_parser = subparsers.add_parser('scrape')
     s3upload_parser = subparsers.add_parser('s3upload')
+    compress_parser = subparsers.add_parser('compress')
+    index_parser = subparsers.add_parser('index')
+    search_parser = subparsers.add_parser('search')
+    export_parser = subparsers.add_parser('export')
 
     # Common arguments
-    for p in [initdb_parser, scrape_parser, s3upload_parser]:
+    for p in [initdb_parser, scrape_parser, s3upload_parser, compress_parser,
+              index_parser, search_parser, export_parser]:
         p.add_argument('-f', '--dbfile', required=True, help='Target file path for sqlite db')
         p.add_argument('--debug', action='store_true', help='More verbose logging output')
     
@@ -31,10 +42,66 @@ def parse_args():
     scrape_parser.add_argument('--how', default='all', nargs='?',
                                choices=['all', 'programs', 'unprocessed_segments', 'failed_segments'],
                                help='Scraping mode')
+    scrape_parser.add_argument('-c', '--concurrent', action='store_true',
+                               help='Scrape segments with a pool of threads')
+    scrape_parser.add_argument('--rate', type=float, default=0.5,
+                               help='Max requests per second to any one host')
+    scrape_parser.add_argument('--burst', type=int, default=1,
+                               help='Requests allowed to a host at once before rate limiting')
+    scrape_parser.add_argument('--page-jobs', type=int, default=4,
+                               help='Max page fetches in flight with --concurrent')
+    scrape_parser.add_argument('--transcript-jobs', type=int, default=2,
+                               help='Max transcript fetches in flight with --concurrent')
+    scrape_parser.add_argument('--audio-jobs', type=int, default=4,
+                               help='Max audio downloads in flight with --concurrent')
+    scrape_parser.add_argument('--range-jobs', type=int, default=4,
+                               help='Byte ranges of one audio file to download in parallel')
+    scrape_parser.add_argument('--part-size', type=int, default=8 * 2**20,
+                               help='Size in bytes of the ranges audio files are downloaded in')
+    scrape_parser.add_argument('--cache-dir', default=None,
+                               help='Directory to cache fetched pages in')
+    scrape_parser.add_argument('--incremental', action='store_true',
+                               help='Stop paging through archives at already-seen episodes')
+    scrape_parser.add_argument('--deep-verify', action='store_true',
+                               help='Page through whole archives even with --incremental')
+    scrape_parser.add_argument('--deep-every', type=int, default=None,
+                               help='With --incremental, do a full crawl if the last was this many days ago')
 
     # S3 parser - we're assuming creds are in the environment
     s3upload_parser.add_argument('-b', '--bucket', help='S3 bucket to write to')
     s3upload_parser.add_argument('-r', '--prefix', default='', help='Prefix in the S3 bucket')
+    s3upload_parser.add_argument('-j', '--jobs', type=int, default=8,
+                                 help='Files to upload in parallel')
+
+    # Compression args
+    compress_parser.add_argument('--train-dict', action='store_true',
+                                 help='Train a zstd dictionary on the stored text first')
+    compress_parser.add_argument('--no-vacuum', action='store_true',
+                                 help='Don\'t vacuum the database afterwards')
+
+    # Search args
+    index_parser.add_argument('--rebuild', action='store_true',
+                              help='Rebuild the transcript index from scratch')
+    search_parser.add_argument('query', nargs='+',
+                               help='Words or phrases to find, in FTS5 query syntax')
+    search_parser.add_argument('-p', '--program', default=None, help='Only search this program')
+    search_parser.add_argument('-i', '--min-dt', default=None, help='Oldest shows to search')
+    search_parser.add_argument('-a', '--max-dt', default=None, help='Newest shows to search')
+    search_parser.add_argument('-n', '--limit', type=int, default=20,
+                               help='Max matches to show')
+
+    # Export args
+    export_parser.add_argument('-o', '--out-dir', required=True,
+                               help='Directory to write shards and manifest to')
+    export_parser.add_argument('-p', '--program', default=None, help='Only export this program')
+    export_parser.add_argument('-i', '--min-dt', default=None, help='Oldest shows to export')
+    export_parser.add_argument('-a', '--max-dt', default=None, help='Newest shows to export')
+    export_parser.add_argument('--shard-size', type=int, default=2**30,
+                               help='Max bytes of audio per shard')
+    export_parser.add_argument('--format', default=None, choices=['parquet', 'jsonl'],
+                               help='Metadata format (default parquet if pyarrow is installed)')
+    export_parser.add_argument('-j', '--jobs', type=int, default=4,
+                               help='Shards to write in parallel')
 
     return parser.parse_args()
 
@@ -54,16 +121,51 @@ if __name__ == '__main__':
         'dbpath': args.dbfile,
         'audio_dir': args.audio_dir if hasattr(args, 'audio_dir') else None,
         'min_cutoff_dt': args.min_cutoff_dt if hasattr(args, 'min_cutoff_dt') else '2010-01-01',
-        'max_cutoff_dt': args.max_cutoff_dt if hasattr(args, 'max_cutoff_dt') else None
+        'max_cutoff_dt': args.max_cutoff_dt if hasattr(args, 'max_cutoff_dt') else None,
+        'initdb': args.subcommand == 'initdb'
     }
 
+    if args.subcommand == 'scrape':
+        init_args['rate'] = args.rate
+        init_args['burst'] = args.burst
+        init_args['page_jobs'] = args.page_jobs
+        init_args['transcript_jobs'] = args.transcript_jobs
+        init_args['audio_jobs'] = args.audio_jobs
+        init_args['cache_dir'] = args.cache_dir
+        init_args['range_jobs'] = args.range_jobs
+        init_args['part_size'] = args.part_size
+
     scraper = NPRScraper(**init_args)
 
-    if args.subcommand == 'initdb':
-        scraper.initdb()
-    elif args.subcommand == 'scrape':
+    # for initdb, the constructor has already done everything
+    if args.subcommand == 'scrape':
         scraper.add_programs(args.program, duplicates='pass')
-        scraper.scrape(how=args.how)
+        scraper.scrape(how=args.how, concurrent=args.concurrent,
+                       incremental=args.incremental, deep=args.deep_verify,
+                       deep_every=args.deep_every)
     elif args.subcommand == 's3upload':
-        scraper.s3_upload(args.bucket, args.prefix)
+        scraper.s3_upload(args.bucket, args.prefix, jobs=args.jobs)
+    elif args.subcommand == 'compress':
+        scraper.compress(train=args.train_dict, vacuum=not args.no_vacuum)
+    elif args.subcommand == 'index':
+        scraper.index_transcripts(rebuild=args.rebuild)
+    elif args.subcommand == 'search':
+        matches = scraper.search(' '.join(args.query), program=args.program,
+                                 min_dt=args.min_dt, max_dt=args.max_dt,
+                                 limit=args.limit)
+
+        for m in matches:
+            line = u'%s %s segment %s: %s' % (m['show_date'], m['program'],
+                                             m['program_show_segment_id'],
+                                             m['audio_path'])
+
+            print(line.encode('utf-8'))
+            print((u'    ' + m['snippet']).encode('utf-8'))
+    elif args.subcommand == 'export':
+        manifest = scraper.export(args.out_dir, program=args.program, min_dt=args.min_dt,
+                                  max_dt=args.max_dt, shard_size=args.shard_size,
+                                  jobs=args.jobs, fmt=args.format)
+
+        msg = 'Exported %s shards to %s'
+        logger.info(msg % (len(manifest['shards']), args.out_dir))
 
@@ -3,39 +3,113 @@ import re
 import time
 import json
 import random
-import shutil
 import logging
 import urlparse
 import datetime
-import subprocess
-import tempfile
-import sqlite3 as sq
-from StringIO import StringIO
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import us
-import m3u8
-import boto3
 import requests as rq
 
 from dateutil import parser as dtp
 from bs4 import BeautifulSoup
 
+from throttle import HostThrottle
+from http_cache import HttpCache
+from hls import extract_audio
+from s3_sync import S3Sync
+from strain import strainer
+from search import TranscriptIndex
+from export import ShardExporter
+import storage
+
 logger = logging.getLogger(__name__)
 
+# How long cached pages stay fresh, in seconds (None = forever): the archive
+# index changes as episodes are added, but episode pages don't. The media
+# feed for an episode isn't cached at all, since the playlist URL in it is
+# tokenised and expires
+CACHE_RULES = [
+    (r'rushlimbaugh\.com/archives/', 3600),
+    (r'rushlimbaugh\.com/', None)
+]
+
+# The only parts of each kind of page we read; see strain.py
+ARCHIVE_PAGE = strainer(('div', 'id', 'main-content'),
+                        ('div', 'class', 'pagination'))
+
+EPISODE_PAGE = strainer(('div', 'class', 'entry-content'),
+                        ('div', 'class', 'custom-links-post'))
+
+LISTEN_RX = re.compile('listen', re.I)
+WATCH_RX = re.compile('watch', re.I)
+
+# The several URL formats the site uses for its audio/video links
+MEDIA_FRAG_RX = re.compile('\!?/([0-9])+/([0-9]+)(/.*)?', re.I)
+MEDIA_VIDEOS_PATH_RX = re.compile('/videos/([0-9])+/([0-9]+)(/.*)?', re.I)
+MEDIA_PATH_RX = re.compile('/([0-9])+/([0-9]+)(/.*)?', re.I)
+
 class RushScraper(object):
-    def __init__(self, dbpath, initdb=False):
+    def __init__(self, dbpath, initdb=False, cache_dir=None, rate=1, burst=2):
         if dbpath == ':memory:':
             raise ValueError("In-memory sqlite databases are not allowed")
+
+        # At most rate requests per second to the site, however many
+        # threads are fetching
+        self.throttle = HostThrottle(rate, burst)
+
+        # pages are fetched through an on-disk cache if given a directory
+        if cache_dir is not None:
+            self.cache = HttpCache(cache_dir, rules=CACHE_RULES, default_ttl=86400)
+        else:
+            self.cache = None
         
         self.dbpath = dbpath
-        self.db = sq.connect(dbpath)
+        self.db = storage.connect(dbpath)
 
         if initdb:
             # This is a separate method so that you can call it again
             # to refresh the object state
             self.initdb()
         else:
-            pass
+            self.upgradedb()
+
+    def upgradedb(self):
+        # Bring databases made by older versions up to date with initdb,
+        # without losing anything in them. A new, empty database has to be
+        # set up by initdb first, indexes and all
+        if len(storage.columns(self.db, 'stg_episode')) == 0:
+            msg = "%s has no scraper tables; run initdb first"
+            raise ValueError(msg % (self.dbpath,))
+
+        self.db.executescript(self.crawl_state_ddl + self.index_ddl)
+
+        self.codec = storage.Codec(self.db)
+
+        self.transcripts = TranscriptIndex(self.db)
+        self.transcripts.create()
+
+    # process works through the staging table newest first
+    index_ddl = '''
+    create index if not exists stg_episode_published_dt_idx
+        on stg_episode (published_dt);
+    '''
+
+    # How far back the archive has been spidered; see spider
+    crawl_state_ddl = '''
+    create table if not exists crawl_state
+    (
+        name text primary key,
+
+        newest_dt text,
+        oldest_dt text,
+
+        crawl_dt text,
+        deep_crawl_dt text
+    );
+    '''
 
     def initdb(self):
         cur = self.db.cursor()
@@ -47,7 +121,7 @@ class RushScraper(object):
             stg_episode_id integer primary key,
 
             url text not null,
-            html text not null,
+            html blob not null,
             published_dt text not null,
 
             constraint url_unique unique (url)
@@ -63,7 +137,7 @@ class RushScraper(object):
             rush_group_id integer,
             rush_episode_id integer,
 
-            transcript text,
+            transcript blob,
             
             media_url text,
             api_response_json text,
@@ -73,8 +147,166 @@ class RushScraper(object):
             constraint media_url_unique unique (media_url),
             constraint stg_episode_id_unique unique (stg_episode_id)
         );
+
+        drop table if exists crawl_state;
+        ''' + self.crawl_state_ddl + '''
+
+        drop table if exists upload_manifest;
+        ''' + S3Sync.manifest_ddl + self.index_ddl + '''
+
+        drop table if exists compression_dict;
+        drop table if exists transcript_fts;
         ''')
 
+        self.codec = storage.Codec(self.db)
+
+        self.transcripts = TranscriptIndex(self.db)
+        self.transcripts.create()
+
+    # Big text columns, stored compressed; see storage.Codec
+    compressed_columns = [
+        ('stg_episode', 'stg_episode_id', 'html'),
+        ('episode', 'episode_id', 'transcript')
+    ]
+
+    def compress(self, train=False, vacuum=True):
+        '''
+        Compress values stored before compression was added, optionally
+        training a zstd dictionary on them first, and then give the space
+        back to the filesystem
+        '''
+        if train:
+            samples = []
+            for table, key, column in self.compressed_columns:
+                samples += storage.sample_column(self.db, self.codec, table, column)
+
+            self.codec.train(samples)
+
+        for table, key, column in self.compressed_columns:
+            storage.compress_column(self.db, self.codec, table, key, column)
+
+        if vacuum:
+            self.db.execute('vacuum;')
+
+            # with WAL, the file only shrinks once that's checkpointed
+            self.db.execute('pragma wal_checkpoint(truncate);')
+
+    def index_transcripts(self, rebuild=False):
+        '''
+        Add transcripts not yet in the search index to it, or rebuild it
+        from scratch. Only needed once for databases made before there was
+        an index; processing an episode keeps it up to date after that.
+        '''
+        return self.transcripts.build(self.codec, 'episode', 'episode_id',
+                                      'transcript', rebuild=rebuild)
+
+    def search(self, query, min_dt=None, max_dt=None, limit=20):
+        '''
+        Episodes whose transcripts match query, an FTS5 query string (words,
+        "quoted phrases", AND/OR/NOT, NEAR(...), prefix*), best matches
+        first. Returns a list of dicts of the episode's id, publication
+        date, url, audio path and a snippet of the transcript around the
+        matches. Can be limited to episodes published between two dates.
+        '''
+        cur = self.db.cursor()
+        filters, params = self._episode_filters(min_dt, max_dt)
+
+        cur.execute('''
+        select
+            e.episode_id,
+            se.published_dt,
+            se.url,
+            e.media_local_path,
+            %s
+        from transcript_fts
+            inner join episode e
+                on e.episode_id = transcript_fts.rowid
+            inner join stg_episode se using(stg_episode_id)
+        where
+            transcript_fts match ?
+            %s
+        order by transcript_fts.rank
+        limit ?;
+        ''' % (self.transcripts.snippet(), filters),
+        [query] + params + [limit])
+
+        cols = ('episode_id', 'published_dt', 'url', 'media_local_path',
+                'snippet')
+
+        return [dict(zip(cols, x)) for x in cur.fetchall()]
+
+    def _episode_filters(self, min_dt=None, max_dt=None):
+        # SQL conditions, each starting with 'and', on the staging rows (se)
+        # of episodes, and their parameters
+        filters, params = [], []
+
+        if min_dt is not None:
+            filters += ['date(se.published_dt) >= ?']
+            params += [str(dtp.parse(min_dt).date())]
+        if max_dt is not None:
+            filters += ['date(se.published_dt) <= ?']
+            params += [str(dtp.parse(max_dt).date())]
+
+        return ''.join(' and ' + x for x in filters), params
+
+    def export(self, out_dir, min_dt=None, max_dt=None, shard_size=2**30,
+               jobs=4, fmt=None):
+        '''
+        Export episodes with audio, optionally only those published between
+        two dates, as shards of audio and metadata in out_dir; see
+        export.py. Resumes an interrupted export to the same directory with
+        the same arguments. Returns the manifest.
+        '''
+        cur = self.db.cursor()
+        filters, params = self._episode_filters(min_dt, max_dt)
+
+        cur.execute('''
+        select
+            e.episode_id,
+            e.media_local_path
+        from episode e
+            inner join stg_episode se using(stg_episode_id)
+        where
+            e.media_local_path != ''
+            %s
+        order by se.published_dt, e.episode_id;
+        ''' % (filters,), params)
+        items = cur.fetchall()
+
+        exporter = ShardExporter(out_dir, 'episode_id', shard_size=shard_size,
+                                 jobs=jobs, fmt=fmt,
+                                 params={'min_dt': min_dt, 'max_dt': max_dt})
+
+        return exporter.run(items, self._export_rows)
+
+    def _export_rows(self, episode_ids):
+        cur = self.db.cursor()
+
+        cur.execute('''
+        select
+            e.episode_id,
+            se.published_dt,
+            se.url,
+            e.rush_show_id,
+            e.rush_group_id,
+            e.rush_episode_id,
+            e.media_url,
+            e.transcript
+        from episode e
+            inner join stg_episode se using(stg_episode_id)
+        where
+            e.episode_id in (%s);
+        ''' % (','.join(['?'] * len(episode_ids)),), episode_ids)
+
+        cols = ('episode_id', 'published_dt', 'url', 'rush_show_id',
+                'rush_group_id', 'rush_episode_id', 'media_url', 'transcript')
+
+        rows = [dict(zip(cols, x)) for x in cur.fetchall()]
+        for row in rows:
+            row['transcript'] = self.codec.decompress(row['transcript'])
+
+        return rows
+
     def has_stg_episode_url(self, url):
         cur = self.db.cursor()
 
@@ -129,82 +361,257 @@ class RushScraper(object):
 
         return max_id
 
-    def spider(self, cutoff_dt='2010-01-01', mean_wait_time=2):
+    def _get(self, url, mean_wait_time=0, cache=True):
+        def fetch(headers):
+            # be polite, but only when we're actually going to the site
+            time.sleep(random.uniform(0, 2*mean_wait_time))
+            self.throttle.wait(url)
+
+            return rq.get(url, headers=headers)
+
+        if self.cache is None or not cache:
+            return fetch({})
+        else:
+            return self.cache.get(url, fetch)
+
+    def crawl_state(self, name='archives'):
         cur = self.db.cursor()
-        
-        if isinstance(cutoff_dt, basestring):
-            cutoff_dt = dtp.parse(cutoff_dt).date()
 
-        # Initially we fetch this url, and later we follow the provided
-        # pagination links
-        url = 'https://www.rushlimbaugh.com/archives/'
-        
-        min_observed_dt = datetime.date.today()
-        while min_observed_dt >= cutoff_dt:
-            time.sleep(random.uniform(0, 2*mean_wait_time))
+        cur.execute('''
+        select
+            newest_dt,
+            oldest_dt,
+            crawl_dt,
+            deep_crawl_dt
+        from crawl_state
+        where
+            name = ?;
+        ''', (name,))
+
+        res = cur.fetchone()
+        if res is None:
+            res = (None, None, None, None)
 
-            resp = rq.get(url)
-            soup = BeautifulSoup(resp.text, 'lxml')
-            logger.debug('Fetched and rendered ' + url)
+        cols = ('newest_dt', 'oldest_dt', 'crawl_dt', 'deep_crawl_dt')
+        return dict(zip(cols, res))
 
-            # The articles we're processing from the just-fetched page
-            mc = soup.find('div', id='main-content')
-            articles = mc.find_all('article', class_='post')
+    def _known_stg_episode_urls(self, urls):
+        cur = self.db.cursor()
 
-            for ar in articles:
-                # Get the values we need to insert
-                se_id = self.max_id_for_table('stg_episode') + 1
-                
-                article_dt = dtp.parse(ar.p.span.text).date()
-                article_url = ar.h2.a['href']
-                article_html = rq.get(article_url).text
-                logger.debug('Fetched ' + article_url)
+        cur.execute('''
+        select
+            url
+        from stg_episode
+        where
+            url in (%s);
+        ''' % (','.join(['?'] * len(urls)),), urls)
+
+        return set(map(lambda x: x[0], cur.fetchall()))
+
+    def _save_crawl_state(self, state, cutoff_dt, newest_dt, stopped, deep,
+                          name='archives'):
+        now = datetime.datetime.now().isoformat()
+
+        newest = state['newest_dt']
+        if newest_dt is not None and (newest is None or newest_dt.isoformat() > newest):
+            newest = newest_dt.isoformat()
+
+        # if we got all the way back, everything since cutoff_dt is
+        # covered; if we stopped early, it's whatever it was before
+        oldest = state['oldest_dt']
+        if not stopped and (oldest is None or cutoff_dt.isoformat() < oldest):
+            oldest = cutoff_dt.isoformat()
 
-                # if already loaded, don't try to insert again
-                if self.has_stg_episode_url(article_url):
+        deep_dt = now if deep and not stopped else state['deep_crawl_dt']
+
+        with self.db:
+            self.db.execute('''
+            insert or replace into crawl_state
+                (name, newest_dt, oldest_dt, crawl_dt, deep_crawl_dt)
+            values
+                (?, ?, ?, ?, ?);
+            ''', (name, newest, oldest, now, deep_dt))
+
+    def _archive_page(self, url, mean_wait_time):
+        resp = self._get(url, mean_wait_time)
+        soup = BeautifulSoup(resp.text, 'lxml', parse_only=ARCHIVE_PAGE)
+        logger.debug('Fetched and rendered ' + url)
+
+        return soup
+
+    def _fetch_article(self, article_url):
+        # for the thread pool: a failed fetch is logged and the article
+        # left for the next run, rather than stopping the spider
+        try:
+            resp = self._get(article_url)
+            resp.raise_for_status()
+        except:
+            logger.exception('Failed to fetch ' + article_url)
+            return None
+
+        logger.debug('Fetched ' + article_url)
+        return resp.text
+
+    def _load_articles(self, cur, pool, articles):
+        # Fetch articles, a list of (url, date), in the pool, and load
+        # them as they come back, in one commit
+        urls = [x[0] for x in articles]
+
+        with storage.Batch(self.db, every=len(articles) + 1) as batch:
+            for (article_url, article_dt), article_html in \
+                    zip(articles, pool.imap(self._fetch_article, urls)):
+                if article_html is None:
                     continue
-                
-                # ensure we don't go back further than the desired
-                # cutoff date
-                if article_dt < min_observed_dt:
-                    min_observed_dt = article_dt
-                if article_dt < cutoff_dt:
-                    break
 
+                # a failed insert leaves nothing behind to roll back, so
+                # the rest of the page's rows can still go in
                 try:
-                    vals = (se_id, article_url, article_html,
+                    vals = (article_url, self.codec.compress(article_html),
                             article_dt.isoformat())
 
                     cur.execute('''
                     insert into stg_episode
-                        (stg_episode_id, url, html, published_dt)
+                        (url, html, published_dt)
                     values
-                        (?, ?, ?, ?);
+                        (?, ?, ?);
                     ''', vals)
                 except:
-                    self.db.rollback()
                     logger.exception('Failed to load article row')
                 else:
-                    self.db.commit()
+                    batch.tick()
 
                 msg = 'Loaded article from %s at %s'
                 logger.info(msg % (article_dt.isoformat(), article_url))
 
-            # The page we should fetch next at the top of the loop
-            url = soup.find('div', class_='pagination').a['href']
+    def spider(self, cutoff_dt='2010-01-01', mean_wait_time=2,
+               incremental=False, deep=False, deep_every=None, jobs=4):
+        # With incremental, stop following pagination at the first page
+        # whose articles we already all have - once the archive has been
+        # spidered back to cutoff_dt at least once. A deep crawl (asked
+        # for with deep, or due every deep_every days) goes all the way.
+        cur = self.db.cursor()
+        
+        if isinstance(cutoff_dt, basestring):
+            cutoff_dt = dtp.parse(cutoff_dt).date()
+
+        state = self.crawl_state()
+
+        covered = state['oldest_dt'] is not None and \
+                  state['oldest_dt'] <= cutoff_dt.isoformat()
+
+        if deep_every is not None and not deep:
+            last = state['deep_crawl_dt']
+            deep = last is None or \
+                   (datetime.date.today() - dtp.parse(last).date()).days >= deep_every
+
+        can_stop = incremental and covered and not deep
+        newest_dt, stopped = None, False
+
+        # Initially we fetch this url, and later we follow the provided
+        # pagination links. Each page is fetched in the background while
+        # we're busy with the one before it, and the new articles on a page
+        # are fetched jobs at a time; the throttle keeps all of that polite
+        url = 'https://www.rushlimbaugh.com/archives/'
+
+        pool = ThreadPool(jobs)
+
+        try:
+            page = pool.apply_async(self._archive_page, (url, mean_wait_time))
+
+            min_observed_dt = datetime.date.today()
+            while min_observed_dt >= cutoff_dt:
+                soup = page.get()
+
+                # The articles we're processing from the just-fetched page
+                mc = soup.find('div', id='main-content')
+                articles = [
+                    (ar.h2.a['href'], dtp.parse(ar.p.span.text).date())
+                    for ar in mc.find_all('article', class_='post')
+                ]
+
+                page_urls = [x[0] for x in articles]
+                known = self._known_stg_episode_urls(page_urls) if len(page_urls) > 0 else set()
+
+                for article_url, article_dt in articles:
+                    if newest_dt is None or article_dt > newest_dt:
+                        newest_dt = article_dt
+                    if article_dt < min_observed_dt:
+                        min_observed_dt = article_dt
+
+                caught_up = can_stop and len(page_urls) > 0 and \
+                            len(known) == len(set(page_urls))
+
+                # Start on the next page, unless this one is our last
+                try:
+                    url = soup.find('div', class_='pagination').a['href']
+                except (AttributeError, KeyError, TypeError):
+                    url = None
+
+                if url is not None and not caught_up and min_observed_dt >= cutoff_dt:
+                    page = pool.apply_async(self._archive_page, (url, mean_wait_time))
+
+                # Only fetch what we don't already have, and nothing older
+                # than the cutoff; known urls are skipped without a request
+                new = [
+                    (article_url, article_dt)
+                    for article_url, article_dt in articles
+                    if article_url not in known and article_dt >= cutoff_dt
+                ]
+
+                self._load_articles(cur, pool, new)
+
+                if caught_up:
+                    logger.info('Caught up with the archive at %s' % (min_observed_dt,))
+                    stopped = True
+                    break
+
+                if url is None:
+                    logger.info('Reached the end of the archive at %s' % (min_observed_dt,))
+                    break
+        finally:
+            pool.close()
+            pool.join()
+
+        self._save_crawl_state(state, cutoff_dt, newest_dt, stopped, deep)
         
         return
 
     @staticmethod
     def get_transcript_from_soup(soup):
-        ps = soup.find('article').find('div', class_='entry-content').find_all('p')
+        ps = soup.find('div', class_='entry-content').find_all('p')
 
         strs = map(lambda x: x.get_text(), ps)
 
         return '\n'.join(strs)
 
+    @staticmethod
+    def get_media_url_from_soup(soup):
+        # Find the video page URL we're going to use, first one way
+        # and then another for two different ways they seem to have
+        # put these links into pages
+
+        # way #1
+        links = soup.find('div', class_='custom-links-post').find_all('a')
+        for lk in links:
+            if LISTEN_RX.search(lk.img['src']):
+                return lk['href'] # take the first one we get
+            elif WATCH_RX.search(lk.img['src']):
+                return lk['href'] # take the first one we get
+            else:
+                pass
+        
+        # way #2
+        imgs = soup.find('div', class_='entry-content').find_all('img')
+        lb = filter(lambda x: LISTEN_RX.search(x['src']), imgs)
+
+        if len(lb) > 0 and lb[0].parent.name == 'a':
+            return lb[0].parent['href']
+
+        return None
+
     def process(self, audio_dir='.', allow_audio_failure=False,
-                mean_wait_time=2, mode='unprocessed'):
+                mean_wait_time=2, mode='unprocessed', commit_every=20,
+                jobs=4, segment_jobs=4):
         cur = self.db.cursor()
 
         if mode not in ('unprocessed', 'reprocess'):
@@ -221,29 +628,90 @@ class RushScraper(object):
             order by se.published_dt desc;
             ''')
         else:
-            cur.execute('delete from episodes;')
+            cur.execute('delete from episode;')
+            self.transcripts.clear()
             self.db.commit()
             
             cur.execute('select stg_episode_id from stg_episode order by published_dt desc;')
 
         ids = map(lambda x: x[0], cur.fetchall())
-        
-        for i in ids:
-            time.sleep(random.uniform(0, 2*mean_wait_time))
-            
-            self.process_stg_episode(i, audio_dir,allow_audio_failure)
+
+        # Episodes are prepared here one at a time (the page parsed and the
+        # media looked up, politely), and their audio extracted in a pool
+        # of jobs processes. They're saved in order as they finish, with
+        # only so many in flight at once
+        pool = multiprocessing.Pool(jobs)
+        episode_id = self.max_id_for_table('episode') + 1
+
+        try:
+            with storage.Batch(self.db, every=commit_every) as batch:
+                pending = collections.deque()
+
+                for i in ids:
+                    ep = self.prepare_stg_episode(i, episode_id, audio_dir,
+                                                  allow_audio_failure,
+                                                  mean_wait_time)
+                    if ep is None:
+                        continue
+
+                    episode_id += 1
+
+                    if ep['src'] is not None:
+                        args = (ep['src'], ep['media_local_path'], segment_jobs)
+                        job = pool.apply_async(extract_audio, args)
+                    else:
+                        job = None
+
+                    pending.append((ep, job))
+
+                    if len(pending) >= 2 * jobs:
+                        ep, job = pending.popleft()
+                        self._finish_episode(ep, job and job.get,
+                                             allow_audio_failure, commit=False)
+                        batch.tick()
+
+                while len(pending) > 0:
+                    ep, job = pending.popleft()
+                    self._finish_episode(ep, job and job.get,
+                                         allow_audio_failure, commit=False)
+                    batch.tick()
+        finally:
+            pool.close()
+            pool.join()
 
         return
 
     def process_stg_episode(self, stg_episode_id, audio_dir='.',
-                            allow_audio_failure=False):
+                            allow_audio_failure=False, mean_wait_time=0,
+                            commit=True, segment_jobs=4):
+        episode_id = self.max_id_for_table('episode') + 1
+
+        ep = self.prepare_stg_episode(stg_episode_id, episode_id, audio_dir,
+                                      allow_audio_failure, mean_wait_time)
+        if ep is None:
+            return
+
+        if ep['src'] is not None:
+            extract = lambda: extract_audio(ep['src'], ep['media_local_path'],
+                                            segment_jobs)
+        else:
+            extract = None
+
+        self._finish_episode(ep, extract, allow_audio_failure, commit)
+
+        return
+
+    def prepare_stg_episode(self, stg_episode_id, episode_id, audio_dir='.',
+                            allow_audio_failure=False, mean_wait_time=0):
+        # Everything for an episode short of getting its audio: returns a
+        # dict of what _finish_episode needs, or None if the episode can't
+        # be processed. src, the HLS playlist URL, is None if it couldn't
+        # be found but allow_audio_failure says to carry on anyway
         cur = self.db.cursor()
 
         if not self.has_stg_episode_id(stg_episode_id):
             raise ValueError("Bad stg_episode " + str(stg_episode_id))
 
-        episode_id = self.max_id_for_table('episode') + 1
-        
         # Get our cached copy of the page
         cur.execute('''
         select
@@ -255,45 +723,21 @@ class RushScraper(object):
         ''', (stg_episode_id,))
 
         res = cur.fetchone()
-        url, html = res[0], res[1]
-        soup = BeautifulSoup(html, 'lxml')
-        
+        url, html = res[0], self.codec.decompress(res[1])
+        soup = BeautifulSoup(html, 'lxml', parse_only=EPISODE_PAGE)
+
         try:
             # Extract the transcript
             try:
                 transcript = self.get_transcript_from_soup(soup)
             except AttributeError:
                 logger.warning('Could not find a transcript on %s' % (url,))
-                return
+                return None
 
-            # Find the video page URL we're going to use, first one way
-            # and then another for two different ways they seem to have
-            # put these links into pages
-            media_url = None
-            
-            # way #1
-            links = soup.find('div', class_='custom-links-post').find_all('a')
-            for lk in links:
-                if re.compile('listen', re.I).search(lk.img['src']):
-                    media_url = lk['href']
-                    break # take the first one we get
-                elif re.compile('watch', re.I).search(lk.img['src']):
-                    media_url = lk['href']
-                    break # take the first one we get
-                else:
-                    pass
-            
-            # way #2
-            if media_url is None:
-                imgs = soup.find('div', class_='entry-content').find_all('img')
-                lb = filter(lambda x: re.compile('listen', re.I).search(x['src']), imgs)
-
-                if len(lb) > 0 and lb[0].parent.name == 'a':
-                    media_url = lb[0].parent['href']
-            
+            media_url = self.get_media_url_from_soup(soup)
             if media_url is None:
                 logger.warning('Could not find a media page link on %s' % (url,))
-                return
+                return None
             
             # Parse it into the (show id, group id, episode id) we need, trying
             # several different ways of doing it because this godawful site has
@@ -302,16 +746,12 @@ class RushScraper(object):
             
             (scheme, host, path, params, query, frag) = urlparse.urlparse(media_url)
             
-            rx1 = re.compile('\!?/([0-9])+/([0-9]+)(/.*)?', re.I)
-            match1 = rx1.match(frag)
-
-            rx2 = re.compile('/videos/([0-9])+/([0-9]+)(/.*)?', re.I)
-            match2 = rx2.match(path)
+            match1 = MEDIA_FRAG_RX.match(frag)
+            match2 = MEDIA_VIDEOS_PATH_RX.match(path)
             
             # this is - no, really, it really is - for links of the form
             #   https://videos/XXXX/YYYYY
-            rx3 = re.compile('/([0-9])+/([0-9]+)(/.*)?', re.I)
-            match3 = rx3.match(path)
+            match3 = MEDIA_PATH_RX.match(path)
             
             if match1:
                 match = match1
@@ -321,7 +761,7 @@ class RushScraper(object):
                 match = match3
             else:
                 logger.warning('Could not process media page link on %s' % (url,))
-                return
+                return None
 
             rush_group_id = match.group(1)
             rush_episode_id = match.group(2)
@@ -335,8 +775,9 @@ class RushScraper(object):
             # possible all three are also provided in the page html.
             endpoint = 'https://www.rushlimbaugh.com/wp-admin/admin-ajax.php?action=ampmedia_get_episode_feed&showId={0}&groupId={1}&episodeId={2}'
 
-            resp = rq.get(endpoint.format(rush_show_id, rush_group_id,
-                                          rush_episode_id))
+            resp = self._get(endpoint.format(rush_show_id, rush_group_id,
+                                             rush_episode_id), mean_wait_time,
+                             cache=False)
             try:
                 rj = json.loads(resp.text)
                 mcs = rj['channel']['item']['media-group']['media-content']
@@ -345,37 +786,62 @@ class RushScraper(object):
                 srcs = filter(flt, mcs)
                 if len(srcs) == 0:
                     logger.warning('API response had no usable media on %s' % (url,))
-                    return
+                    return None
                 else:
                     src = srcs[0]['@attributes']['url']
-                
-                playlist = rq.get(src).text
-                playlist_file = tempfile.NamedTemporaryFile(suffix='.m3u8')
-                playlist_file.write(playlist)
-                playlist_file.seek(0, 0)
+            except:
+                if allow_audio_failure:
+                    src = None
+                else:
+                    raise
+        except:
+            logger.exception('Unsuccessfully processed ' + url)
+            return None
+
+        media_local_path = os.path.abspath(os.path.join(audio_dir, str(episode_id) + '.aac'))
+
+        return {
+            'url': url,
+            'episode_id': episode_id,
+            'stg_episode_id': stg_episode_id,
+            'rush_show_id': rush_show_id,
+            'rush_group_id': rush_group_id,
+            'rush_episode_id': rush_episode_id,
+            'transcript': transcript,
+            'media_url': media_url,
+            'api_response_json': resp.text,
+            'src': src,
+            'media_local_path': media_local_path
+        }
+
+    def _finish_episode(self, ep, extract, allow_audio_failure=False,
+                        commit=True):
+        # Get the audio for a prepared episode with extract(), which writes
+        # it to ep['media_local_path'] or raises, and save the episode
+        cur = self.db.cursor()
+        url = ep['url']
 
-                mp4_cmd = 'ffmpeg -y -protocol_whitelist file,http,https,tcp,tls,crypto -i {0} -c copy -bsf:a aac_adtstoasc {1}'
-                mp4_file = tempfile.NamedTemporaryFile(suffix='.mp4')
-                
-                with open(os.devnull, 'wb') as devnull:
-                    subprocess.check_call(mp4_cmd.format(playlist_file.name, mp4_file.name),
-                                          shell=True, stdout=devnull, stderr=devnull)
-
-                aac_cmd = 'ffmpeg -y -i {0} -vn -acodec copy {1}'
-                media_local_path = os.path.abspath(os.path.join(audio_dir, str(episode_id) + '.aac'))
-                with open(os.devnull, 'wb') as devnull:
-                    subprocess.check_call(aac_cmd.format(mp4_file.name, media_local_path),
-                                          shell=True, stdout=devnull, stderr=devnull)
+        try:
+            try:
+                if extract is None:
+                    raise ValueError("No media playlist found")
+
+                how = extract()
+                logger.debug('Extracted audio from %s with %s' % (ep['src'], how))
+
+                media_local_path = ep['media_local_path']
             except:
                 if allow_audio_failure:
+                    logger.warning('Failed to get audio for ' + url)
                     media_local_path = ''
                 else:
                     raise
 
             # Load our newly processed row into the sqlite db
-            vals = (episode_id, stg_episode_id, rush_show_id, rush_group_id,
-                    rush_episode_id, transcript, media_url, resp.text,
-                    media_local_path)
+            vals = (ep['episode_id'], ep['stg_episode_id'], ep['rush_show_id'],
+                    ep['rush_group_id'], ep['rush_episode_id'],
+                    self.codec.compress(ep['transcript']), ep['media_url'],
+                    ep['api_response_json'], media_local_path)
             try:
                 cur.execute('''
                 insert into episode
@@ -385,34 +851,42 @@ class RushScraper(object):
                 values
                     (?, ?, ?, ?, ?, ?, ?, ?, ?);
                 ''', vals)
+
+                self.transcripts.put(ep['episode_id'], ep['transcript'])
             except:
-                self.db.rollback()
+                # as in save_program_show_segment, there's only anything
+                # to roll back if we're committing as we go
+                if commit:
+                    self.db.rollback()
                 raise
             else:
-                self.db.commit()
+                if commit:
+                    self.db.commit()
         except:
             logger.exception('Unsuccessfully processed ' + url)
         else:
             logger.info('Successfully processed ' + url)
 
-        return
-
-    # AWS credentials are assumed to be in the environment
-    def s3_upload(self, bucket, prefix=''):
+    # AWS credentials are assumed to be in the environment. Objects already
+    # uploaded unchanged are skipped; see S3Sync
+    def s3_upload(self, bucket, prefix='', jobs=8):
         cur = self.db.cursor()
 
+        # Get the audio files and transcripts - we'll defer processing the
+        # transcripts into a WER-friendly format until it's time to actually
+        # compute the error rates
         cur.execute('''
         select
-            episode_id
+            media_local_path,
+            transcript
         from episode;
         ''')
 
-        ids = map(lambda x: x[0], cur.fetchall())
+        sync = S3Sync(self.db, bucket, prefix, jobs=jobs)
+        for media_local_path, transcript in cur.fetchall():
+            self._queue_episode_upload(sync, media_local_path, transcript)
 
-        for i in ids:
-            self.s3_upload_episode(i, bucket, prefix)
-
-        return
+        return sync.run()
 
     def s3_upload_episode(self, episode_id, bucket, prefix=''):
         cur = self.db.cursor()
@@ -431,17 +905,11 @@ class RushScraper(object):
         where
             episode_id = ?;
         ''', (episode_id,))
-        res = cur.fetchone()
-        media_local_path, transcript = res[0], res[1]
+        media_local_path, transcript = cur.fetchone()
 
-        # Upload to S3
-        bs = os.path.basename(media_local_path)
-        media_key = os.path.join(prefix, bs)
-        transcript_key = os.path.join(prefix, bs + '.transcript')
-        
-        s3 = boto3.client('s3')
-        s3.upload_file(media_local_path, bucket, media_key)
-        s3.upload_fileobj(StringIO(transcript.encode('utf-8')), bucket, transcript_key)
+        sync = S3Sync(self.db, bucket, prefix, jobs=1)
+        self._queue_episode_upload(sync, media_local_path, transcript)
+        sync.run()
 
         # Log it
         msg = 'Uploaded audio and transcript for episode %s to %s'
@@ -450,3 +918,9 @@ class RushScraper(object):
 
         return
 
+    def _queue_episode_upload(self, sync, media_local_path, transcript):
+        bs = os.path.basename(media_local_path)
+
+        sync.add_file(bs, media_local_path)
+        transcript = self.codec.decompress(transcript)
+        sync.add_data(bs + '.transcript', transcript.encode('utf-8'))
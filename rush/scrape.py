@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import sys
 import logging
 import argparse
 
+# shared with the other scrapers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scrape-common'))
+
 from rush_scraper import RushScraper
 
 logger = logging.getLogger(__name__)
@@ -16,14 +22,34 @@ def parse_args():
     spider_parser = subparsers.add_parser('spider')
     process_parser = subparsers.add_parser('process')
     s3upload_parser = subparsers.add_parser('s3upload')
+    compress_parser = subparsers.add_parser('compress')
+    index_parser = subparsers.add_parser('index')
+    search_parser = subparsers.add_parser('search')
+    export_parser = subparsers.add_parser('export')
 
     # Common arguments
-    for p in [initdb_parser, spider_parser, process_parser, s3upload_parser]:
+    for p in [initdb_parser, spider_parser, process_parser, s3upload_parser, compress_parser,
+              index_parser, search_parser, export_parser]:
         p.add_argument('-f', '--dbfile', required=True, help='Target file path for sqlite db')
         p.add_argument('--debug', action='store_true', help='More verbose logging output')
+
+    for p in [spider_parser, process_parser]:
+        p.add_argument('--cache-dir', default=None, help='Directory to cache fetched pages in')
+        p.add_argument('--rate', type=float, default=1,
+                       help='Max requests per second to the site')
+        p.add_argument('--burst', type=int, default=2,
+                       help='Requests allowed at once before rate limiting')
     
     # Spidering args
     spider_parser.add_argument('-c', '--cutoff-dt', default='2010-01-01', help='Oldest data to scrape')
+    spider_parser.add_argument('--incremental', action='store_true',
+                               help='Stop paging through the archive at already-seen articles')
+    spider_parser.add_argument('--deep-verify', action='store_true',
+                               help='Page through the whole archive even with --incremental')
+    spider_parser.add_argument('--deep-every', type=int, default=None,
+                               help='With --incremental, do a full crawl if the last was this many days ago')
+    spider_parser.add_argument('-j', '--jobs', type=int, default=4,
+                               help='Article pages to fetch in parallel')
     
     # Processing args
     process_parser.add_argument('-m', '--mode', default='unprocessed',
@@ -32,10 +58,44 @@ def parse_args():
     process_parser.add_argument('-d', '--audio-dir', default='.', help='Directory to write audio files')
     process_parser.add_argument('--allow-audio-failure', action='store_true',
                                 help='Allow processing to succeed even if fetching audio file fails')
+    process_parser.add_argument('-j', '--jobs', type=int, default=4,
+                                help='Episodes to extract audio for in parallel')
+    process_parser.add_argument('--segment-jobs', type=int, default=4,
+                                help='HLS segments to download in parallel per episode')
 
     # S3 parser - we're assuming creds are in the environment
     s3upload_parser.add_argument('-b', '--bucket', help='S3 bucket to write to')
     s3upload_parser.add_argument('-r', '--prefix', default='', help='Prefix in the S3 bucket')
+    s3upload_parser.add_argument('-j', '--jobs', type=int, default=8,
+                                 help='Files to upload in parallel')
+
+    # Compression args
+    compress_parser.add_argument('--train-dict', action='store_true',
+                                 help='Train a zstd dictionary on the stored text first')
+    compress_parser.add_argument('--no-vacuum', action='store_true',
+                                 help='Don\'t vacuum the database afterwards')
+
+    # Search args
+    index_parser.add_argument('--rebuild', action='store_true',
+                              help='Rebuild the transcript index from scratch')
+    search_parser.add_argument('query', nargs='+',
+                               help='Words or phrases to find, in FTS5 query syntax')
+    search_parser.add_argument('-i', '--min-dt', default=None, help='Oldest shows to search')
+    search_parser.add_argument('-a', '--max-dt', default=None, help='Newest shows to search')
+    search_parser.add_argument('-n', '--limit', type=int, default=20,
+                               help='Max matches to show')
+
+    # Export args
+    export_parser.add_argument('-o', '--out-dir', required=True,
+                               help='Directory to write shards and manifest to')
+    export_parser.add_argument('-i', '--min-dt', default=None, help='Oldest shows to export')
+    export_parser.add_argument('-a', '--max-dt', default=None, help='Newest shows to export')
+    export_parser.add_argument('--shard-size', type=int, default=2**30,
+                               help='Max bytes of audio per shard')
+    export_parser.add_argument('--format', default=None, choices=['parquet', 'jsonl'],
+                               help='Metadata format (default parquet if pyarrow is installed)')
+    export_parser.add_argument('-j', '--jobs', type=int, default=4,
+                               help='Shards to write in parallel')
 
     return parser.parse_args()
 
@@ -51,15 +111,45 @@ if __name__ == '__main__':
     logging.basicConfig(level=loglevel, format=fmt,
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-    scraper = RushScraper(dbpath=args.dbfile)
+    init_args = {'dbpath': args.dbfile, 'initdb': args.subcommand == 'initdb'}
 
-    if args.subcommand == 'initdb':
-        scraper.initdb()
-    elif args.subcommand == 'spider':
-        scraper.spider(cutoff_dt=args.cutoff_dt)
+    if args.subcommand in ('spider', 'process'):
+        init_args['cache_dir'] = args.cache_dir
+        init_args['rate'] = args.rate
+        init_args['burst'] = args.burst
+
+    scraper = RushScraper(**init_args)
+
+    # for initdb, the constructor has already done everything
+    if args.subcommand == 'spider':
+        scraper.spider(cutoff_dt=args.cutoff_dt, incremental=args.incremental,
+                       deep=args.deep_verify, deep_every=args.deep_every,
+                       jobs=args.jobs)
     elif args.subcommand == 'process':
         scraper.process(audio_dir=args.audio_dir, mode=args.mode,
-                        allow_audio_failure=args.allow_audio_failure)
+                        allow_audio_failure=args.allow_audio_failure,
+                        jobs=args.jobs, segment_jobs=args.segment_jobs)
     elif args.subcommand == 's3upload':
-        scraper.s3_upload(args.bucket, args.prefix)
+        scraper.s3_upload(args.bucket, args.prefix, jobs=args.jobs)
+    elif args.subcommand == 'compress':
+        scraper.compress(train=args.train_dict, vacuum=not args.no_vacuum)
+    elif args.subcommand == 'index':
+        scraper.index_transcripts(rebuild=args.rebuild)
+    elif args.subcommand == 'search':
+        matches = scraper.search(' '.join(args.query), min_dt=args.min_dt,
+                                 max_dt=args.max_dt, limit=args.limit)
+
+        for m in matches:
+            line = u'%s episode %s: %s' % (m['published_dt'], m['episode_id'],
+                                          m['media_local_path'])
+
+            print(line.encode('utf-8'))
+            print((u'    ' + m['snippet']).encode('utf-8'))
+    elif args.subcommand == 'export':
+        manifest = scraper.export(args.out_dir, min_dt=args.min_dt, max_dt=args.max_dt,
+                                  shard_size=args.shard_size, jobs=args.jobs,
+                                  fmt=args.format)
+
+        msg = 'Exported %s shards to %s'
+        logger.info(msg % (len(manifest['shards']), args.out_dir))
 
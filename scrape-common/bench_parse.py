@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+'''
+Compare parsing saved pages into full BeautifulSoup trees with parsing only
+the parts the scrapers read (see strain.py). Each page is parsed and has
+the scraper's fields extracted both ways, and the results are checked to
+be the same, so this also catches a strainer that drops something needed.
+
+Usage: ./bench_parse.py [-n REPEAT] KIND FILE [FILE ...]
+       ./bench_parse.py [-n REPEAT] --rush-db DBFILE [--limit N]
+
+KIND is one of the page kinds below; FILEs are saved copies of such pages.
+With --rush-db, the Rush episode pages stored in a scraper database's
+stg_episode table are used instead.
+'''
+
+import os
+import sys
+import time
+import argparse
+import sqlite3 as sq
+
+here = os.path.dirname(os.path.abspath(__file__))
+for d in ('npr-scrape', 'rush'):
+    sys.path.insert(0, os.path.join(here, os.pardir, d))
+sys.path.insert(0, here)
+
+from bs4 import BeautifulSoup
+
+import storage
+import npr_scraper as npr
+import rush_scraper as rush
+
+def _try(func, soup):
+    # extraction failing is a result too, and should fail the same way
+    # both ways
+    try:
+        return func(soup)
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return 'failed'
+
+def npr_archive(soup):
+    articles = soup.find_all('article', class_='program-show')
+
+    return [
+        (a['data-episode-id'],
+         a.find('h2', class_='program-show__title').a['href'],
+         [s.find_all('h3', class_='program-segment__title')[0].a['href']
+          for s in a.find_all('article', class_='program-segment')])
+        for a in articles
+    ], _try(lambda x: x.find('div', id='scrolllink').a['href'], soup)
+
+def npr_segment(soup):
+    return (
+        _try(npr.NPRScraper.get_transcript_from_soup, soup),
+        _try(lambda x: x.find('li', class_='audio-tool-transcript').a['href'], soup),
+        _try(lambda x: x.find_all('time', class_='audio-module-duration')[0].text, soup),
+        _try(lambda x: x.findAll('li', class_='audio-tool-download')[0].a['href'], soup)
+    )
+
+def rush_archive(soup):
+    mc = soup.find('div', id='main-content')
+
+    return [
+        (ar.h2.a['href'], ar.p.span.text)
+        for ar in mc.find_all('article', class_='post')
+    ], _try(lambda x: x.find('div', class_='pagination').a['href'], soup)
+
+def rush_episode(soup):
+    return (
+        _try(rush.RushScraper.get_transcript_from_soup, soup),
+        _try(rush.RushScraper.get_media_url_from_soup, soup)
+    )
+
+# kind: (strainer, extraction function)
+KINDS = {
+    'npr-archive': (npr.ARCHIVE_PAGE, npr_archive),
+    'npr-segment': (npr.SEGMENT_PAGE, npr_segment),
+    'npr-transcript': (npr.TRANSCRIPT_PAGE, npr_segment),
+    'rush-archive': (rush.ARCHIVE_PAGE, rush_archive),
+    'rush-episode': (rush.EPISODE_PAGE, rush_episode),
+}
+
+def measure(pages, strainer, extract, repeat):
+    'Best of repeat runs over all pages, in seconds, and the results'
+    best, results = None, None
+
+    for i in range(repeat):
+        t0 = time.time()
+        res = [
+            _try(extract, BeautifulSoup(page, 'lxml', parse_only=strainer))
+            for page in pages
+        ]
+        elapsed = time.time() - t0
+
+        if best is None or elapsed < best:
+            best, results = elapsed, res
+
+    return best, results
+
+def rush_pages(dbpath, limit):
+    db = sq.connect(dbpath)
+
+    try:
+        codec = storage.Codec(db)
+
+        cur = db.cursor()
+        cur.execute('select html from stg_episode limit ?;', (limit,))
+
+        return [codec.decompress(x[0]) for x in cur.fetchall()]
+    finally:
+        db.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark scraper page parsing')
+    parser.add_argument('kind', nargs='?', choices=sorted(KINDS.keys()),
+                        help='What kind of page the files are')
+    parser.add_argument('files', nargs='*', help='Saved pages to parse')
+    parser.add_argument('--rush-db', default=None,
+                        help='Use the episode pages in this Rush scraper database')
+    parser.add_argument('--limit', type=int, default=200,
+                        help='Max pages to take from --rush-db')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Times to parse each page each way; we report the best')
+
+    args = parser.parse_args()
+
+    if args.rush_db is None and (args.kind is None or len(args.files) == 0):
+        parser.error('Need a page kind and files, or --rush-db')
+
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.rush_db is not None:
+        kind, pages = 'rush-episode', rush_pages(args.rush_db, args.limit)
+    else:
+        kind, pages = args.kind, []
+
+        for path in args.files:
+            with open(path, 'rb') as f:
+                pages += [f.read()]
+
+    if len(pages) == 0:
+        sys.exit('No pages to parse')
+
+    strainer, extract = KINDS[kind]
+
+    full, full_res = measure(pages, None, extract, args.repeat)
+    strained, strained_res = measure(pages, strainer, extract, args.repeat)
+
+    mismatches = [
+        i for i, (x, y) in enumerate(zip(full_res, strained_res))
+        if x != y
+    ]
+
+    print('%-14s %6s %12s %14s %8s' % ('kind', 'pages', 'full (ms)',
+                                       'strained (ms)', 'speedup'))
+    print('%-14s %6d %12.1f %14.1f %7.1fx' % (kind, len(pages), 1000 * full,
+                                              1000 * strained, full / strained))
+
+    for i in mismatches:
+        label = args.files[i] if args.rush_db is None else 'page %s' % (i,)
+        print('Results differ for %s' % (label,))
+
+    sys.exit(1 if len(mismatches) > 0 else 0)
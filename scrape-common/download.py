@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests as rq
+
+logger = logging.getLogger(__name__)
+
+class DownloadError(Exception):
+    pass
+
+# what a dropped or failed transfer can raise: a connection broken part way
+# through a body comes from urllib3 rather than requests itself
+TRANSIENT = (rq.exceptions.RequestException,
+             rq.packages.urllib3.exceptions.HTTPError,
+             IOError, DownloadError)
+
+# Downloads files so that a dropped connection costs at most one part of the
+# file instead of the whole thing. Data goes to path + '.part', with the
+# parts done so far recorded in path + '.part.json'; a later call for the
+# same URL and path picks up from there, as long as the server says the file
+# hasn't changed. Files the server will serve in ranges are fetched as
+# several parts in parallel. The result is checked against the server's
+# Content-Length and hashed before being renamed into place, so nothing at
+# path is ever partial.
+class Downloader(object):
+    def __init__(self, part_size=8 * 2**20, jobs=4, retries=5, backoff=2,
+                 timeout=(10, 60), get=None):
+        self.part_size = part_size
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # get(url, headers) makes a streaming GET; callers can supply their
+        # own to rate limit, reuse sessions, etc
+        if get is not None:
+            self.get = get
+        else:
+            self.get = lambda url, headers: rq.get(url, headers=headers,
+                                                   stream=True,
+                                                   timeout=self.timeout)
+
+    def _probe(self, url):
+        # What we need to know before starting: the length, whether ranges
+        # work, and something identifying this version of the file
+        resp = self.get(url, {'Range': 'bytes=0-0'})
+
+        try:
+            resp.raise_for_status()
+
+            validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+
+            if resp.status_code == 206:
+                total = resp.headers.get('Content-Range', '').split('/')[-1]
+                length = int(total) if total.isdigit() else None
+                return length, length is not None, validator
+
+            length = resp.headers.get('Content-Length')
+            return int(length) if length is not None else None, False, validator
+        finally:
+            resp.close()
+
+    def _load_state(self, state_path, url, length, validator):
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if state.get('url') != url or state.get('length') != length or \
+           state.get('validator') != validator:
+            return None
+
+        # parts done are recorded by where they start, which only means
+        # the same thing with the same part size
+        if state.get('part_size') != self.part_size:
+            return None
+
+        return state
+
+    def _save_state(self, state_path, state):
+        tmp = state_path + '.tmp'
+
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+
+        os.rename(tmp, state_path)
+
+    def _copy(self, resp, f, expected=None):
+        # read the undecoded body, so the byte count matches Content-Length
+        n = 0
+
+        while True:
+            block = resp.raw.read(2**16, decode_content=False)
+            if not block:
+                break
+
+            f.write(block)
+            n += len(block)
+
+        if expected is not None and n != expected:
+            msg = "Got %s bytes, expected %s"
+            raise DownloadError(msg % (n, expected))
+
+        return n
+
+    def _with_retries(self, what, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except TRANSIENT:
+                if attempt == self.retries:
+                    raise
+
+                delay = self.backoff * 2**attempt
+                logger.warning('Failed to fetch %s; retrying in %ss' % (what, delay))
+                time.sleep(delay)
+
+    def _fetch_part(self, url, part_path, lo, hi):
+        headers = {'Range': 'bytes=%s-%s' % (lo, hi)}
+        resp = self.get(url, headers)
+
+        try:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise DownloadError("Server ignored range request")
+
+            with open(part_path, 'r+b') as f:
+                f.seek(lo)
+                self._copy(resp, f, hi - lo + 1)
+        finally:
+            resp.close()
+
+    def _fetch_whole(self, url, part_path, length):
+        resp = self.get(url, {})
+
+        try:
+            resp.raise_for_status()
+
+            with open(part_path, 'wb') as f:
+                self._copy(resp, f, length)
+        finally:
+            resp.close()
+
+    def _sha256(self, path):
+        h = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(2**20)
+                if not block:
+                    break
+                h.update(block)
+
+        return h.hexdigest()
+
+    def download(self, url, path):
+        '''
+        Download url to path, resuming an earlier attempt if there is one.
+        Returns (bytes, sha256 hex digest); raises if it can't finish.
+        '''
+        part_path = path + '.part'
+        state_path = path + '.part.json'
+
+        length, ranges, validator = self._with_retries(url, self._probe, url)
+
+        if not ranges or length is None or length == 0:
+            # no way to resume or split it, so just fetch it in one go
+            self._with_retries(url, self._fetch_whole, url, part_path, length)
+        else:
+            state = self._load_state(state_path, url, length, validator)
+
+            if state is None or not os.path.exists(part_path):
+                state = {'url': url, 'length': length, 'validator': validator,
+                         'part_size': self.part_size, 'done': []}
+
+                with open(part_path, 'wb') as f:
+                    f.truncate(length)
+
+                self._save_state(state_path, state)
+            else:
+                logger.info('Resuming download of %s' % (url,))
+
+            parts = [
+                (lo, min(lo + self.part_size, length) - 1)
+                for lo in range(0, length, self.part_size)
+                if lo not in state['done']
+            ]
+
+            lock = threading.Lock()
+
+            def fetch(part):
+                lo, hi = part
+                what = '%s bytes %s-%s' % (url, lo, hi)
+
+                self._with_retries(what, self._fetch_part, url, part_path, lo, hi)
+
+                with lock:
+                    state['done'] += [lo]
+                    self._save_state(state_path, state)
+
+            if len(parts) == 1 or self.jobs <= 1:
+                for part in parts:
+                    fetch(part)
+            else:
+                pool = ThreadPool(min(self.jobs, len(parts)))
+
+                try:
+                    pool.map(fetch, parts)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        size = os.path.getsize(part_path)
+        if length is not None and size != length:
+            msg = "Downloaded %s bytes of %s, expected %s"
+            raise DownloadError(msg % (size, url, length))
+
+        digest = self._sha256(part_path)
+
+        os.rename(part_path, path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+        return size, digest
@@ -0,0 +1,283 @@
+import os
+import gzip
+import json
+import time
+import tarfile
+import hashlib
+import logging
+import datetime
+import collections
+import multiprocessing
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Exports a scraper's corpus as a set of shards for ASR training and
+# evaluation, rather than as many small loose files: each shard is a tar of
+# audio files, up to shard_size bytes of them, and a metadata file with one
+# row per audio file in the tar (its name there, its transcript and
+# whatever else the scraper has about it). The metadata is Parquet if
+# pyarrow is installed, and gzipped JSON lines if not.
+#
+# The shards are written in a pool of processes. A manifest.json in the
+# output directory lists them - what goes in each, and for finished ones
+# their sizes and sha256s - and is rewritten as each one finishes, so an
+# interrupted export picks up where it left off if run again with the same
+# settings. The split into shards is fixed when an export starts, so rows
+# added to the database since then aren't in it; export to a new directory
+# for those.
+MANIFEST = 'manifest.json'
+
+def _sha256(path):
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(2**20)
+            if not block:
+                break
+            h.update(block)
+
+    return h.hexdigest()
+
+def _write_metadata(path, rows, fmt):
+    if fmt == 'parquet':
+        cols = sorted(rows[0].keys()) if len(rows) > 0 else []
+        table = pa.Table.from_arrays([pa.array([r[c] for r in rows]) for c in cols],
+                                     names=cols)
+
+        pq.write_table(table, path)
+    else:
+        with gzip.open(path, 'wb') as f:
+            for r in rows:
+                f.write((json.dumps(r, sort_keys=True) + '\n').encode('utf-8'))
+
+def write_shard(out_dir, name, rows, fmt):
+    '''
+    Write shard name to out_dir: the audio file at each row's audio_path
+    into name.tar as row['audio'], and the rows, less their audio_path, as
+    its metadata. Nothing is left under the final names unless this
+    succeeds. Returns the shard's entry for the manifest.
+    '''
+    tar_name = name + '.tar'
+    meta_name = name + ('.parquet' if fmt == 'parquet' else '.jsonl.gz')
+    tar_path = os.path.join(out_dir, tar_name)
+    meta_path = os.path.join(out_dir, meta_name)
+
+    meta = []
+    try:
+        with tarfile.open(tar_path + '.part', 'w') as tar:
+            for row in rows:
+                info = tar.gettarinfo(row['audio_path'], row['audio'])
+
+                # so the same rows always make the same tar
+                info.uid, info.gid, info.uname, info.gname = 0, 0, '', ''
+
+                with open(row['audio_path'], 'rb') as f:
+                    tar.addfile(info, f)
+
+                meta += [dict((k, v) for k, v in row.items() if k != 'audio_path')]
+
+        _write_metadata(meta_path + '.part', meta, fmt)
+
+        os.rename(tar_path + '.part', tar_path)
+        os.rename(meta_path + '.part', meta_path)
+    except:
+        for path in (tar_path + '.part', meta_path + '.part'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    return {
+        'tar': tar_name,
+        'tar_bytes': os.path.getsize(tar_path),
+        'tar_sha256': _sha256(tar_path),
+        'metadata': meta_name,
+        'metadata_bytes': os.path.getsize(meta_path),
+        'metadata_sha256': _sha256(meta_path),
+        'rows': len(rows)
+    }
+
+def _write_shard(args):
+    # for the process pool
+    return write_shard(*args)
+
+class ShardExporter(object):
+    '''
+    Export rows to sharded tars and metadata files in out_dir. The scraper
+    supplies what to export as a list of (key, audio path) pairs, in the
+    order they should go in, and a function taking a list of keys and
+    returning their rows: dicts of the values to put in the metadata, all
+    with the same fields, the key among them under the name key. Audio
+    files that don't exist are left out.
+    '''
+
+    def __init__(self, out_dir, key, shard_size=2**30, jobs=4, fmt=None,
+                 params=None):
+        if fmt is None:
+            fmt = 'parquet' if pa is not None else 'jsonl'
+
+        if fmt not in ('parquet', 'jsonl'):
+            raise ValueError("Bad metadata format %s" % (fmt,))
+        if fmt == 'parquet' and pa is None:
+            raise ValueError("Parquet output needs the pyarrow package")
+
+        self.out_dir = out_dir
+        self.key = key
+        self.shard_size = shard_size
+        self.jobs = jobs
+        self.fmt = fmt
+
+        # anything else that decides what's in the export, like the
+        # scraper's filters; resuming needs the same settings
+        self.params = dict(params or {})
+        self.params.update({'shard_size': shard_size, 'format': fmt})
+
+        self.manifest_path = os.path.join(out_dir, MANIFEST)
+
+    def plan(self, items):
+        'Split (key, audio path) pairs into shards; returns lists of keys'
+        shards, current, size = [], [], 0
+        missing = 0
+
+        for key, path in items:
+            if path is None or not os.path.exists(path):
+                missing += 1
+                continue
+
+            # tar adds a header per file and pads it to 512 bytes
+            nbytes = 512 * (2 + (os.path.getsize(path) + 511) // 512)
+
+            if len(current) > 0 and size + nbytes > self.shard_size:
+                shards += [current]
+                current, size = [], 0
+
+            current += [key]
+            size += nbytes
+
+        if len(current) > 0:
+            shards += [current]
+
+        if missing > 0:
+            logger.warning('Leaving out %s rows with no audio file' % (missing,))
+
+        return shards
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+
+        with open(self.manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        if manifest['params'] != json.loads(json.dumps(self.params)):
+            msg = "%s has an export with different settings %s"
+            raise ValueError(msg % (self.out_dir, manifest['params']))
+
+        return manifest
+
+    def _save_manifest(self, manifest):
+        # written whole and renamed over the old one, so an interruption
+        # can't leave it half-written
+        tmp = self.manifest_path + '.part'
+
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+        os.rename(tmp, self.manifest_path)
+
+    def _done(self, shard):
+        return 'tar_sha256' in shard and \
+               os.path.exists(os.path.join(self.out_dir, shard['tar'])) and \
+               os.path.exists(os.path.join(self.out_dir, shard['metadata']))
+
+    def _rows(self, keys, fetch, every=500):
+        # a few hundred at a time, to stay under sqlite's limit on query
+        # parameters, and in the shard's order whatever order they come in
+        rows = []
+        for i in range(0, len(keys), every):
+            rows += fetch(keys[i:i + every])
+
+        order = dict((k, i) for i, k in enumerate(keys))
+        rows.sort(key=lambda x: order[x[self.key]])
+
+        return rows
+
+    def run(self, items, fetch):
+        '''
+        Export the rows, resuming an earlier run into the same directory if
+        there is one. Returns the manifest.
+        '''
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+
+        manifest = self._load_manifest()
+
+        if manifest is None:
+            manifest = {
+                'params': self.params,
+                'created_dt': datetime.datetime.utcnow().isoformat(),
+                'shards': [
+                    {'name': 'shard-%06d' % (i,), 'keys': keys}
+                    for i, keys in enumerate(self.plan(items))
+                ]
+            }
+
+            self._save_manifest(manifest)
+
+        todo = [s for s in manifest['shards'] if not self._done(s)]
+        done = len(manifest['shards']) - len(todo)
+
+        msg = '%s shards to write, %s already written'
+        logger.info(msg % (len(todo), done))
+
+        paths = dict(items)
+        start, nbytes = time.time(), 0
+
+        # This process reads the rows for each shard and the pool writes
+        # them, with only so many shards' rows in memory at once
+        pool = multiprocessing.Pool(self.jobs)
+
+        try:
+            pending = collections.deque()
+            queue = collections.deque(todo)
+
+            while len(queue) > 0 or len(pending) > 0:
+                while len(queue) > 0 and len(pending) < 2 * self.jobs:
+                    shard = queue.popleft()
+
+                    # rows gone from the export since it started (deleted,
+                    # say, or reprocessed unsuccessfully) are left out
+                    rows = self._rows(shard['keys'], fetch)
+                    rows = [x for x in rows if x[self.key] in paths]
+
+                    for row in rows:
+                        row['audio_path'] = paths[row[self.key]]
+                        row['audio'] = str(row[self.key]) + \
+                                       os.path.splitext(row['audio_path'])[1]
+
+                    args = (self.out_dir, shard['name'], rows, self.fmt)
+                    pending.append((shard, pool.apply_async(_write_shard, (args,))))
+
+                shard, job = pending.popleft()
+                shard.update(job.get())
+                self._save_manifest(manifest)
+
+                done += 1
+                nbytes += shard['tar_bytes']
+
+                elapsed = max(time.time() - start, 1e-6)
+                msg = 'Wrote %s (%s of %s shards), %.1f MB/s'
+                vals = (shard['name'], done, len(manifest['shards']),
+                        nbytes / 2.0**20 / elapsed)
+                logger.info(msg % vals)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return manifest
@@ -0,0 +1,281 @@
+import os
+import time
+import logging
+import subprocess
+import collections
+from multiprocessing.pool import ThreadPool
+
+import m3u8
+import requests as rq
+
+logger = logging.getLogger(__name__)
+
+# Pulls the audio out of an HLS stream as a plain ADTS (.aac) file in one
+# pass: segments are downloaded several at a time and the AAC frames in them
+# written straight to the output, in order, without ever putting the
+# MPEG-TS or a remuxed copy on disk. That covers the usual case of clear
+# (unencrypted) MPEG-TS segments with an ADTS audio track, or segments that
+# are ADTS already. For anything else - encrypted or fragmented-MP4 streams,
+# other codecs - we hand the whole job to one ffmpeg instead.
+
+TS_PACKET_SIZE = 188
+
+# PMT stream types
+STREAM_TYPE_ADTS = 0x0F
+
+class NeedsFfmpeg(Exception):
+    'The stream is in a form we don\'t demux ourselves'
+    pass
+
+class TsAudioDemuxer(object):
+    '''
+    Extracts the ADTS elementary stream from MPEG-TS data fed to it in
+    order, in pieces of any size. Follows the PAT to the first program's
+    PMT, and from there to its AAC track.
+    '''
+
+    def __init__(self):
+        self.pmt_pid = None
+        self.audio_pid = None
+        self.leftover = bytearray()
+
+    def _section(self, payload, pusi):
+        # PSI sections start after a pointer field; we assume, as is
+        # always the case in practice for HLS, that PAT and PMT sections
+        # fit in one packet
+        if not pusi or len(payload) < 1:
+            return None
+
+        start = 1 + payload[0]
+        section = payload[start:]
+        if len(section) < 3:
+            return None
+
+        length = ((section[1] & 0x0F) << 8) | section[2]
+        return section[:3 + length]
+
+    def _parse_pat(self, payload, pusi):
+        section = self._section(payload, pusi)
+        if section is None or section[0] != 0x00:
+            return
+
+        # program entries run from byte 8 to the CRC
+        for i in range(8, len(section) - 4, 4):
+            program = (section[i] << 8) | section[i + 1]
+            if program != 0: # 0 is the network information table
+                self.pmt_pid = ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+                return
+
+    def _parse_pmt(self, payload, pusi):
+        section = self._section(payload, pusi)
+        if section is None or section[0] != 0x02:
+            return
+
+        info_length = ((section[10] & 0x0F) << 8) | section[11]
+        i, types = 12 + info_length, []
+
+        while i + 5 <= len(section) - 4:
+            stream_type = section[i]
+            pid = ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+            es_info_length = ((section[i + 3] & 0x0F) << 8) | section[i + 4]
+
+            if stream_type == STREAM_TYPE_ADTS:
+                self.audio_pid = pid
+                return
+
+            types += [stream_type]
+            i += 5 + es_info_length
+
+        raise NeedsFfmpeg("No ADTS audio track; stream types %s" % (types,))
+
+    def _es_data(self, payload, pusi):
+        # a PES packet starts in a packet with PUSI set, and its header
+        # comes before the audio; the rest is the elementary stream
+        if not pusi:
+            return payload
+
+        if len(payload) < 9 or payload[0:3] != bytearray(b'\x00\x00\x01'):
+            raise ValueError("Bad PES header")
+
+        return payload[9 + payload[8]:]
+
+    def feed(self, data):
+        'Demux some more of the stream, returning the ADTS bytes in it'
+        data = self.leftover + bytearray(data)
+        out = bytearray()
+
+        pos = 0
+        while pos + TS_PACKET_SIZE <= len(data):
+            if data[pos] != 0x47:
+                raise ValueError("Lost MPEG-TS sync at offset %s" % (pos,))
+
+            pusi = bool(data[pos + 1] & 0x40)
+            pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+            afc = (data[pos + 3] >> 4) & 0x03
+
+            start = pos + 4
+            if afc & 0x02: # adaptation field before the payload
+                start += 1 + data[pos + 4]
+
+            if afc & 0x01 and start < pos + TS_PACKET_SIZE:
+                payload = data[start:pos + TS_PACKET_SIZE]
+
+                if pid == 0:
+                    self._parse_pat(payload, pusi)
+                elif pid == self.pmt_pid and self.audio_pid is None:
+                    self._parse_pmt(payload, pusi)
+                elif pid == self.audio_pid and self.audio_pid is not None:
+                    out += self._es_data(payload, pusi)
+
+            pos += TS_PACKET_SIZE
+
+        self.leftover = data[pos:]
+
+        return bytes(out)
+
+def _id3_length(data):
+    # ID3v2 tags, which packed audio segments start with to carry their
+    # timestamps, store their size as a 28-bit "synchsafe" integer
+    if len(data) < 10 or data[:3] != bytearray(b'ID3'):
+        return 0
+
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+class HlsAudioExtractor(object):
+    def __init__(self, jobs=4, retries=3, backoff=2, timeout=(10, 60),
+                 ffmpeg='ffmpeg'):
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.ffmpeg = ffmpeg
+
+    def _fetch(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                resp = rq.get(url, timeout=self.timeout)
+                resp.raise_for_status()
+
+                return resp.content
+            except rq.exceptions.RequestException:
+                if attempt == self.retries:
+                    raise
+
+                delay = self.backoff * 2**attempt
+                logger.warning('Failed to fetch %s; retrying in %ss' % (url, delay))
+                time.sleep(delay)
+
+    def media_playlist(self, url):
+        '''
+        The media playlist for url, choosing the highest-bandwidth variant
+        (as ffmpeg would) if it's a master playlist
+        '''
+        playlist = m3u8.loads(self._fetch(url).decode('utf-8'), uri=url)
+
+        if playlist.is_variant:
+            # a separate audio rendition is all we need, if there is one
+            audio = [x for x in playlist.media if x.type == 'AUDIO' and x.uri]
+
+            if len(audio) > 0:
+                url = audio[0].absolute_uri
+            else:
+                best = max(playlist.playlists,
+                           key=lambda x: x.stream_info.bandwidth or 0)
+                url = best.absolute_uri
+
+            playlist = m3u8.loads(self._fetch(url).decode('utf-8'), uri=url)
+
+        if any(k is not None and k.method != 'NONE' for k in playlist.keys):
+            raise NeedsFfmpeg("Stream is encrypted")
+        if playlist.segment_map:
+            raise NeedsFfmpeg("Stream is fragmented MP4")
+
+        return playlist
+
+    def _segments(self, urls):
+        # Fetch ahead of what we're writing, but only so far, so memory use
+        # stays bounded however long the stream is
+        pool = ThreadPool(self.jobs)
+
+        try:
+            pending = collections.deque()
+
+            for url in urls:
+                pending.append(pool.apply_async(self._fetch, (url,)))
+
+                if len(pending) >= 2 * self.jobs:
+                    yield pending.popleft().get()
+
+            while len(pending) > 0:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _demux(self, playlist, out):
+        demuxer, written = None, 0
+
+        urls = [seg.absolute_uri for seg in playlist.segments]
+        for data in self._segments(urls):
+            data = bytearray(data)
+
+            if demuxer is None and len(data) > 0 and data[0] != 0x47:
+                # packed audio: ADTS already, perhaps after an ID3 tag
+                chunk = bytes(data[_id3_length(data):])
+            else:
+                demuxer = demuxer or TsAudioDemuxer()
+                chunk = demuxer.feed(data)
+
+            out.write(chunk)
+            written += len(chunk)
+
+        return written
+
+    def _ffmpeg(self, url, out):
+        cmd = [self.ffmpeg, '-nostdin', '-loglevel', 'error',
+               '-protocol_whitelist', 'file,http,https,tcp,tls,crypto',
+               '-i', url, '-vn', '-acodec', 'copy', '-f', 'adts', 'pipe:1']
+
+        subprocess.check_call(cmd, stdout=out)
+
+    def extract(self, url, path):
+        '''
+        Write the audio of the HLS stream at url to path as ADTS; nothing is
+        left at path unless this succeeds. Returns how it was done, 'native'
+        or 'ffmpeg'.
+        '''
+        tmp = path + '.part'
+
+        try:
+            try:
+                playlist = self.media_playlist(url)
+
+                with open(tmp, 'wb') as out:
+                    if self._demux(playlist, out) == 0:
+                        raise NeedsFfmpeg("No audio found")
+
+                how = 'native'
+            except (NeedsFfmpeg, ValueError) as exc:
+                logger.info('Using ffmpeg for %s: %s' % (url, exc))
+
+                with open(tmp, 'wb') as out:
+                    self._ffmpeg(url, out)
+
+                how = 'ffmpeg'
+
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return how
+
+def extract_audio(url, path, jobs=4):
+    'HlsAudioExtractor(jobs).extract(url, path), as a function for process pools'
+    return HlsAudioExtractor(jobs=jobs).extract(url, path)
@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# An on-disk cache of GET responses for the scrapers. Almost everything they
+# fetch never changes once it's published, so each URL's body is kept
+# compressed on disk with its validators, and is served from there until
+# its TTL runs out. After that it's revalidated with If-None-Match /
+# If-Modified-Since, which for unchanged pages costs a 304 and no body.
+#
+# TTLs come from rules, a list of (regex, seconds) pairs matched against the
+# URL in order; the first match wins, seconds of None means forever, and
+# URLs matching no rule get default_ttl.
+class CachedResponse(object):
+    'Enough of a requests Response for the scrapers, served from the cache'
+
+    from_cache = True
+    status_code = 200
+    ok = True
+
+    def __init__(self, url, content, headers, encoding):
+        self.url = url
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    def raise_for_status(self):
+        pass
+
+class HttpCache(object):
+    # response headers we keep, and the request headers they turn into
+    # when revalidating
+    validators = (('etag', 'If-None-Match'),
+                  ('last-modified', 'If-Modified-Since'))
+
+    def __init__(self, path, rules=None, default_ttl=0):
+        self.path = path
+        self.rules = [(re.compile(rx), ttl) for rx, ttl in (rules or [])]
+        self.default_ttl = default_ttl
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def ttl(self, url):
+        for rx, ttl in self.rules:
+            if rx.search(url):
+                return ttl
+
+        return self.default_ttl
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.path, key[:2], key)
+
+        return base + '.json', base + '.z'
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+
+            with open(body_path, 'rb') as f:
+                body = zlib.decompress(f.read())
+        except (IOError, OSError, ValueError, zlib.error):
+            return None, None
+
+        # guard against hash collisions, however unlikely
+        if meta.get('url') != url:
+            return None, None
+
+        return meta, body
+
+    def _write(self, path, data):
+        # write then rename, so a reader never sees a partial file
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError: # another thread beat us to it
+                pass
+
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def _store(self, url, meta, body=None):
+        meta_path, body_path = self._paths(url)
+
+        if body is not None:
+            self._write(body_path, zlib.compress(body))
+
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def get(self, url, fetch):
+        '''
+        Get url through the cache. On a miss, or to revalidate, call
+        fetch(headers), which should make the request with the given extra
+        headers and return the requests Response.
+        '''
+        meta, body = self._load(url)
+        now = time.time()
+
+        if meta is not None:
+            ttl = self.ttl(url)
+
+            if ttl is None or now - meta['fetched_ts'] < ttl:
+                logger.debug('Cache hit for ' + url)
+                return CachedResponse(url, body, meta['headers'], meta['encoding'])
+
+        headers = {}
+        if meta is not None:
+            for name, header in self.validators:
+                if name in meta['headers']:
+                    headers[header] = meta['headers'][name]
+
+        resp = fetch(headers)
+
+        if resp.status_code == 304 and meta is not None:
+            logger.debug('Revalidated ' + url)
+
+            meta['fetched_ts'] = now
+            self._store(url, meta)
+
+            return CachedResponse(url, body, meta['headers'], meta['encoding'])
+
+        # only cache plain successes; anything else may well be transient
+        if resp.status_code == 200:
+            keep = dict((k.lower(), v) for k, v in resp.headers.items()
+                        if k.lower() in ('etag', 'last-modified', 'content-type'))
+
+            meta = {
+                'url': url,
+                'fetched_ts': now,
+                'headers': keep,
+                'encoding': resp.encoding or resp.apparent_encoding
+            }
+
+            self._store(url, meta, resp.content)
+
+        resp.from_cache = False
+        return resp
@@ -0,0 +1,213 @@
+import os
+import time
+import hashlib
+import logging
+import datetime
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+logger = logging.getLogger(__name__)
+
+# Uploads a scraper's files to S3, skipping ones it has already uploaded.
+# What's been uploaded is recorded in an upload_manifest table in the
+# scraper's own sqlite database, with each object's size and sha256, so a
+# re-run can tell what's unchanged without asking S3. Files also have their
+# mtime recorded, so that unchanged ones don't even need hashing again.
+#
+# Queue things with add_file and add_data, then call run. Uploads happen in
+# a pool of threads sharing one client, with big files sent as multipart
+# uploads in parallel parts; the calling thread does all the database work.
+class S3Sync(object):
+    manifest_ddl = '''
+    create table if not exists upload_manifest
+    (
+        bucket text not null,
+        key text not null,
+
+        size integer not null,
+        mtime real,
+        checksum text not null,
+        uploaded_dt text not null,
+
+        primary key (bucket, key)
+    );
+    '''
+
+    def __init__(self, db, bucket, prefix='', jobs=8, part_size=8 * 2**20,
+                 part_jobs=4, commit_every=50, progress_interval=30):
+        self.db = db
+        self.bucket = bucket
+        self.prefix = prefix
+        self.jobs = jobs
+        self.commit_every = commit_every
+        self.progress_interval = progress_interval
+
+        # boto3 clients, unlike sessions and resources, are safe to share
+        # between threads
+        self.s3 = boto3.client('s3')
+        self.config = TransferConfig(multipart_threshold=part_size,
+                                     multipart_chunksize=part_size,
+                                     max_concurrency=part_jobs)
+
+        self.items = []
+
+        self.db.executescript(self.manifest_ddl)
+
+    def key(self, name):
+        return os.path.join(self.prefix, name)
+
+    def add_file(self, name, path, checksum=None):
+        'Queue the file at path for upload as name; checksum is its sha256 if known'
+        self.items += [(self.key(name), path, None, checksum)]
+
+    def add_data(self, name, data):
+        'Queue a byte string for upload as name'
+        self.items += [(self.key(name), None, data, None)]
+
+    def _manifest(self):
+        cur = self.db.cursor()
+
+        cur.execute('''
+        select
+            key,
+            size,
+            mtime,
+            checksum
+        from upload_manifest
+        where
+            bucket = ?;
+        ''', (self.bucket,))
+
+        return dict((x[0], x[1:]) for x in cur.fetchall())
+
+    @staticmethod
+    def _sha256(path):
+        h = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(2**20)
+                if not block:
+                    break
+                h.update(block)
+
+        return h.hexdigest()
+
+    def _plan(self):
+        # Work out which items need uploading: (key, path, data, size,
+        # mtime, checksum) for each one that does
+        manifest = self._manifest()
+        todo = []
+
+        for key, path, data, checksum in self.items:
+            prev = manifest.get(key)
+
+            if data is not None:
+                size, mtime = len(data), None
+                checksum = hashlib.sha256(data).hexdigest()
+            else:
+                st = os.stat(path)
+                size, mtime = st.st_size, st.st_mtime
+
+                if prev is not None and prev[0] == size and prev[1] == mtime:
+                    continue
+
+                if checksum is None:
+                    checksum = self._sha256(path)
+
+            if prev is not None and prev[0] == size and prev[2] == checksum:
+                # the same content, just touched; remember the new mtime so
+                # we don't hash it again next time
+                if mtime != prev[1]:
+                    self._record(key, size, mtime, checksum)
+
+                continue
+
+            todo += [(key, path, data, size, mtime, checksum)]
+
+        return todo
+
+    def _upload(self, item):
+        key, path, data = item[0], item[1], item[2]
+
+        try:
+            if data is not None:
+                self.s3.upload_fileobj(BytesIO(data), self.bucket, key,
+                                       Config=self.config)
+            else:
+                self.s3.upload_file(path, self.bucket, key, Config=self.config)
+        except Exception:
+            logger.exception('Failed to upload s3://%s/%s' % (self.bucket, key))
+            return item, False
+
+        return item, True
+
+    def _record(self, key, size, mtime, checksum):
+        cur = self.db.cursor()
+
+        cur.execute('''
+        insert or replace into upload_manifest
+            (bucket, key, size, mtime, checksum, uploaded_dt)
+        values
+            (?, ?, ?, ?, ?, ?);
+        ''', (self.bucket, key, size, mtime, checksum,
+              datetime.datetime.utcnow().isoformat()))
+
+    def _progress(self, done, total, nbytes, start):
+        elapsed = max(time.time() - start, 1e-6)
+
+        msg = 'Uploaded %s of %s objects, %.1f MB at %.2f MB/s'
+        vals = (done, total, nbytes / 2.0**20, nbytes / 2.0**20 / elapsed)
+        logger.info(msg % vals)
+
+    def run(self):
+        '''
+        Upload everything queued that isn't already in S3 unchanged, and
+        clear the queue. Returns a dict of counts: uploaded, skipped,
+        failed, and bytes uploaded.
+        '''
+        todo = self._plan()
+        self.db.commit()
+
+        skipped = len(self.items) - len(todo)
+        logger.info('%s objects to upload, %s unchanged' % (len(todo), skipped))
+
+        stats = {'uploaded': 0, 'skipped': skipped, 'failed': 0, 'bytes': 0}
+        start = last_report = time.time()
+
+        pool = ThreadPool(self.jobs)
+
+        try:
+            for item, ok in pool.imap_unordered(self._upload, todo):
+                if not ok:
+                    stats['failed'] += 1
+                    continue
+
+                key, size, mtime, checksum = item[0], item[3], item[4], item[5]
+                self._record(key, size, mtime, checksum)
+
+                stats['uploaded'] += 1
+                stats['bytes'] += size
+
+                if stats['uploaded'] % self.commit_every == 0:
+                    self.db.commit()
+
+                if time.time() - last_report >= self.progress_interval:
+                    self._progress(stats['uploaded'], len(todo), stats['bytes'], start)
+                    last_report = time.time()
+        finally:
+            self.db.commit()
+
+            pool.close()
+            pool.join()
+
+        self._progress(stats['uploaded'], len(todo), stats['bytes'], start)
+        if stats['failed'] > 0:
+            logger.warning('%s objects failed to upload' % (stats['failed'],))
+
+        self.items = []
+
+        return stats
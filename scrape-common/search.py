@@ -0,0 +1,106 @@
+import logging
+
+from storage import Batch
+
+logger = logging.getLogger(__name__)
+
+# A full-text index over a scraper's transcripts, as an sqlite FTS5 table
+# whose rowids are the ids of the rows the transcripts belong to. The
+# transcripts themselves are stored compressed (see storage.Codec), which
+# sqlite can't see into, so this can't be an external-content table kept up
+# by triggers: the index keeps its own copy of the text, which is also what
+# snippets are cut from, and the scrapers update it from Python alongside
+# each write to a transcript.
+class TranscriptIndex(object):
+    def __init__(self, db, name='transcript_fts'):
+        self.db = db
+        self.name = name
+
+    @property
+    def ddl(self):
+        return '''
+        create virtual table if not exists %s using fts5
+        (
+            transcript,
+            tokenize = 'porter unicode61'
+        );
+        ''' % (self.name,)
+
+    def create(self):
+        self.db.executescript(self.ddl)
+
+    def put(self, rowid, text):
+        'Index text as that of row rowid, replacing anything indexed for it'
+        self.remove(rowid)
+
+        if text is not None:
+            self.db.execute('''
+            insert into %s
+                (rowid, transcript)
+            values
+                (?, ?);
+            ''' % (self.name,), (rowid, text))
+
+    def remove(self, rowid):
+        self.db.execute('delete from %s where rowid = ?;' % (self.name,), (rowid,))
+
+    def clear(self):
+        self.db.execute('delete from %s;' % (self.name,))
+
+    def optimize(self):
+        'Merge the index\'s segments, for faster queries after a lot of writes'
+        self.db.execute('insert into %s (%s) values (\'optimize\');' % (self.name, self.name))
+        self.db.commit()
+
+    def build(self, codec, table, key, column, rebuild=False, every=500):
+        '''
+        Index the values of table.column (decompressed with codec) for rows
+        not indexed yet, or for all rows if rebuild, a batch of rows at a
+        time; rows since deleted are dropped from the index. Returns how
+        many rows were indexed.
+        '''
+        cur = self.db.cursor()
+
+        if rebuild:
+            self.clear()
+        else:
+            cur.execute('''
+            delete from %s
+            where
+                rowid not in (select %s from %s where %s is not null);
+            ''' % (self.name, key, table, column))
+
+        cur.execute('''
+        select
+            %s
+        from %s
+        where
+            %s is not null and
+            %s not in (select rowid from %s);
+        ''' % (key, table, column, key, self.name))
+        keys = [x[0] for x in cur.fetchall()]
+
+        select = 'select %s, %s from %s where %s in (%%s);' % (key, column, table, key)
+
+        with Batch(self.db, every=every) as batch:
+            for i in range(0, len(keys), every):
+                ids = keys[i:i + every]
+
+                cur.execute(select % (','.join(['?'] * len(ids)),), ids)
+                for k, val in cur.fetchall():
+                    self.put(k, codec.decompress(val))
+
+                batch.tick(len(ids))
+
+                msg = 'Indexed %s of %s rows of %s.%s'
+                vals = (min(i + every, len(keys)), len(keys), table, column)
+                logger.info(msg % vals)
+
+        if len(keys) > 0:
+            self.optimize()
+
+        return len(keys)
+
+    def snippet(self, tokens=16):
+        'SQL for a snippet of the matching text, with matches in [brackets]'
+        return 'snippet(%s, 0, \'[\', \']\', \'...\', %d)' % (self.name, tokens)
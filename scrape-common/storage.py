@@ -0,0 +1,267 @@
+import zlib
+import logging
+import datetime
+import sqlite3 as sq
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+try:
+    text_type = unicode
+except NameError: # python 3
+    text_type = str
+
+logger = logging.getLogger(__name__)
+
+# sqlite settings for the scrapers' databases, which get big (gigabytes of
+# pages and transcripts) and are written a row at a time by long-running
+# loops. WAL lets status queries read while a scrape is writing, and with
+# it synchronous=NORMAL is still safe against corruption: a crash can only
+# lose the last few commits, which the scrapers will redo anyway.
+PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -64 * 2**10), # in KB when negative, so 64 MB
+    ('temp_store', 'memory'),
+    ('mmap_size', 2**28)
+]
+
+def connect(dbpath, pragmas=None):
+    'Open a scraper database with our settings'
+    db = sq.connect(dbpath)
+
+    for name, value in (PRAGMAS if pragmas is None else pragmas):
+        db.execute('pragma %s = %s;' % (name, value))
+
+    return db
+
+def columns(db, table):
+    cur = db.cursor()
+    cur.execute('pragma table_info(%s);' % (table,))
+
+    return [x[1] for x in cur.fetchall()]
+
+def add_columns(db, table, cols):
+    '''
+    Add any of cols, a list of (name, type) pairs, that table doesn't have
+    yet; for bringing databases made by older versions up to date
+    '''
+    have = columns(db, table)
+
+    for name, tp in cols:
+        if name not in have:
+            logger.info('Adding column %s to table %s' % (name, table))
+            db.execute('alter table %s add column %s %s;' % (table, name, tp))
+
+    db.commit()
+
+class Batch(object):
+    '''
+    Commits every so many writes rather than after each one, for loops
+    writing many independent rows. Call tick() after each write; whatever's
+    pending is committed on leaving the with block, exception or not,
+    since the rows written so far are good whatever stopped the loop.
+
+        with Batch(db, every=100) as batch:
+            for row in rows:
+                db.execute(...)
+                batch.tick()
+    '''
+
+    def __init__(self, db, every=100):
+        self.db = db
+        self.every = every
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tp, val, traceback):
+        self.commit()
+        return False
+
+    def tick(self, n=1):
+        self.pending += n
+
+        if self.pending >= self.every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+# Compressed storage for the big text columns: pages' HTML and transcripts,
+# which are most of a scraper database by size. Values are stored as BLOBs
+# of a one-byte tag and the compressed UTF-8 text, with zstd if it's
+# installed and zlib if not. zstd can also use a dictionary trained on
+# samples of the column, which helps a lot with many small similar values
+# like pages from one site; dictionaries are kept in the database, and the
+# newest is used for compressing. Values stored before compression was added
+# are plain TEXT, and are passed through as they are, so old and new rows
+# can sit side by side until compress_column gets to them.
+ZLIB_TAG = b'Z'
+ZSTD_TAG = b'S'
+
+class Codec(object):
+    dict_ddl = '''
+    create table if not exists compression_dict
+    (
+        dict_id integer primary key,
+
+        data blob not null,
+        created_dt text not null
+    );
+    '''
+
+    def __init__(self, db, method=None, level=None):
+        if method is None:
+            method = 'zstd' if zstd is not None else 'zlib'
+
+        if method not in ('zstd', 'zlib'):
+            raise ValueError("Bad compression method %s" % (method,))
+        if method == 'zstd' and zstd is None:
+            raise ValueError("zstd compression needs the zstandard package")
+
+        self.db = db
+        self.method = method
+
+        if level is not None:
+            self.level = level
+        else:
+            self.level = 9 if method == 'zstd' else 6
+
+        self.db.executescript(self.dict_ddl)
+        self._load_dicts()
+
+    def _load_dicts(self):
+        cur = self.db.cursor()
+        cur.execute('''
+        select
+            data
+        from compression_dict
+        order by dict_id;
+        ''')
+
+        # by zstd's own dictionary ids, which are what frames refer to
+        self.dicts = {}
+        self.current_dict = None
+
+        if zstd is None:
+            return
+
+        for (data,) in cur.fetchall():
+            d = zstd.ZstdCompressionDict(bytes(data))
+
+            self.dicts[d.dict_id()] = d
+            self.current_dict = d
+
+    def train(self, samples, size=2**17):
+        '''
+        Train a zstd dictionary on samples (a list of strings) and use it
+        for compressing from now on. Needs at least a few hundred samples
+        to be worthwhile.
+        '''
+        if zstd is None:
+            raise ValueError("Dictionary training needs the zstandard package")
+
+        samples = [x.encode('utf-8') if isinstance(x, text_type) else x
+                   for x in samples]
+        d = zstd.train_dictionary(size, samples)
+
+        with self.db:
+            self.db.execute('''
+            insert into compression_dict
+                (data, created_dt)
+            values
+                (?, ?);
+            ''', (sq.Binary(d.as_bytes()), datetime.datetime.now().isoformat()))
+
+        self.dicts[d.dict_id()] = d
+        self.current_dict = d
+
+        return d.dict_id()
+
+    def compress(self, text):
+        'Text, or None, as a value to store'
+        if text is None:
+            return None
+
+        data = text.encode('utf-8') if isinstance(text, text_type) else text
+
+        # compressor objects aren't thread-safe, so make one per call
+        if self.method == 'zstd':
+            cctx = zstd.ZstdCompressor(level=self.level, dict_data=self.current_dict)
+            ret = ZSTD_TAG + cctx.compress(data)
+        else:
+            ret = ZLIB_TAG + zlib.compress(data, self.level)
+
+        return sq.Binary(ret)
+
+    def decompress(self, value):
+        'The text of a stored value, compressed or not'
+        if value is None or isinstance(value, text_type):
+            return value
+
+        data = bytes(value)
+        tag, body = data[:1], data[1:]
+
+        if tag == ZLIB_TAG:
+            ret = zlib.decompress(body)
+        elif tag == ZSTD_TAG:
+            if zstd is None:
+                raise ValueError("Value is zstd-compressed, but zstandard isn't installed")
+
+            dict_id = zstd.get_frame_parameters(body).dict_id
+            if dict_id != 0 and dict_id not in self.dicts:
+                raise ValueError("Value needs unknown zstd dictionary %s" % (dict_id,))
+
+            dctx = zstd.ZstdDecompressor(dict_data=self.dicts.get(dict_id))
+            ret = dctx.decompress(body)
+        else:
+            raise ValueError("Unknown compression tag %r" % (tag,))
+
+        return ret.decode('utf-8')
+
+def compress_column(db, codec, table, key, column, every=500):
+    '''
+    Compress the values of table.column not already compressed, a batch of
+    rows (identified by the key column) at a time; returns how many rows
+    were compressed. Run VACUUM afterwards to give the space back.
+    '''
+    cur = db.cursor()
+    cur.execute('select %s from %s where typeof(%s) = \'text\';' % (key, table, column))
+    keys = [x[0] for x in cur.fetchall()]
+
+    select = 'select %s, %s from %s where %s in (%%s);' % (key, column, table, key)
+    update = 'update %s set %s = ? where %s = ?;' % (table, column, key)
+
+    with Batch(db, every=every) as batch:
+        for i in range(0, len(keys), every):
+            ids = keys[i:i + every]
+
+            cur.execute(select % (','.join(['?'] * len(ids)),), ids)
+            rows = [(codec.compress(val), k) for k, val in cur.fetchall()]
+
+            cur.executemany(update, rows)
+            batch.tick(len(rows))
+
+            msg = 'Compressed %s of %s rows of %s.%s'
+            vals = (min(i + every, len(keys)), len(keys), table, column)
+            logger.info(msg % vals)
+
+    return len(keys)
+
+def sample_column(db, codec, table, column, n=1000):
+    'Up to n random values of table.column, decompressed, for training'
+    cur = db.cursor()
+    cur.execute('''
+    select %s
+    from %s
+    where %s is not null
+    order by random()
+    limit ?;
+    ''' % (column, table, column), (n,))
+
+    return [codec.decompress(x[0]) for x in cur.fetchall()]
@@ -0,0 +1,55 @@
+from bs4 import SoupStrainer
+
+# Most of what the scrapers parse is page furniture they never look at, and
+# building BeautifulSoup objects for it is where most of their CPU time goes.
+# A strainer makes BeautifulSoup build only the elements it matches (and
+# everything inside them), so a page is parsed down to just the parts a
+# scraper reads; the usual find/find_all calls then work as before on the
+# smaller tree.
+def _classes(value):
+    # while parsing, class arrives as the raw attribute string
+    if isinstance(value, list):
+        return value
+
+    return value.split()
+
+class _Strainer(SoupStrainer):
+    # BeautifulSoup asks its parse_only strainer about each top-level tag
+    # as it's parsed, by calling search_tag(name, attrs) before bs4 4.13
+    # and allow_tag_creation(nsprefix, name, attrs) since; neither lets a
+    # plain SoupStrainer match one tag by id and another by class, so both
+    # are overridden here. The names passed to the constructor keep stray
+    # text between the matched tags out of the tree, as they always have.
+    def __init__(self, selectors):
+        self.selectors = tuple(selectors)
+        super(_Strainer, self).__init__(sorted(set(x[0] for x in self.selectors)))
+
+    def _match(self, name, attrs):
+        attrs = attrs or {}
+
+        for tag, attr, value in self.selectors:
+            if name != tag or attr not in attrs:
+                continue
+
+            if attr == 'class':
+                if value in _classes(attrs[attr]):
+                    return True
+            elif attrs[attr] == value:
+                return True
+
+        return False
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return self._match(markup_name, markup_attrs)
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self._match(name, attrs)
+
+def strainer(*selectors):
+    '''
+    A SoupStrainer keeping elements matching any of selectors, each of
+    which is a (tag name, attribute, value) triple like ('div', 'id',
+    'main-content'). For the class attribute the value need only be one
+    of the element's classes.
+    '''
+    return _Strainer(selectors)
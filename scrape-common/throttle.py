@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+
+try:
+    import urlparse
+except ImportError: # python 3
+    import urllib.parse as urlparse
+
+logger = logging.getLogger(__name__)
+
+# Politeness for scrapers that make requests from several threads at once:
+# rather than every request sleeping a random amount, each host gets a token
+# bucket refilled at some rate, and a request only waits if its host's
+# bucket is empty.
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+
+        self.rate = float(rate)
+        self.burst = burst
+
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        'Take a token, sleeping until one is available; returns time waited'
+        waited = 0
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+class HostThrottle(object):
+    '''
+    Token buckets by host: rate is requests per second allowed to any one
+    host, and rates optionally overrides it for particular hosts
+    '''
+
+    def __init__(self, rate, burst=1, rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates if rates is not None else {}
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                rate = self.rates.get(host, self.rate)
+                self.buckets[host] = TokenBucket(rate, self.burst)
+
+            return self.buckets[host]
+
+    def wait(self, url):
+        host = urlparse.urlparse(url).netloc
+
+        waited = self.bucket(host).acquire()
+        if waited > 0:
+            logger.debug('Waited %.2fs for %s' % (waited, host))
+
+        return waited